@@ -4,6 +4,7 @@ import os
 import logging
 import docker
 from .app import Repo2Docker
+from . import batch
 from . import __version__
 from .utils import validate_and_generate_port_mapping, is_valid_docker_image_name
 
@@ -342,6 +343,11 @@ def make_r2d(argv=None):
 
 
 def main():
+    # `repo2docker batch <file.yaml>` builds many repositories at once
+    if sys.argv[1:2] == ["batch"]:
+        batch.main(sys.argv[2:])
+        return
+
     r2d = make_r2d()
     r2d.initialize()
     try:
@@ -14,16 +14,21 @@ import os
 import getpass
 import shutil
 import tempfile
+import threading
 import time
 
+from concurrent.futures import Future
+
 import docker
+import requests
 from urllib.parse import urlparse
 from docker.utils import kwargs_from_env
 from docker.errors import DockerException
+from docker.transport import UnixHTTPAdapter
 import escapism
 from pythonjsonlogger import jsonlogger
 
-from traitlets import Any, Dict, Int, List, Unicode, Bool, default
+from traitlets import Any, Dict, Float, Int, List, Unicode, Bool, default
 from traitlets.config import Application
 
 from . import __version__
@@ -38,9 +43,77 @@ from .buildpacks import (
     PythonBuildPack,
     RBuildPack,
 )
+from .buildpacks.context import DIGEST_LABEL
+from .progress import PushProgress, describe_push
 from . import contentproviders
+from .contentproviders.cache import DownloadCache
+from .contentproviders.doi import DoiResolver
+from .contentproviders.download import HTTPConnectionPool
+from .contentproviders.mirror import MirrorCache
 from .utils import ByteSpecification, chdir
 
+# API versions negotiated with docker daemons, keyed by the daemon's URL.
+# Creating a client with version="auto" costs a round-trip to the daemon so
+# we only do it once per process.
+_docker_api_versions = {}
+
+
+class _SinglePoolUnixHTTPAdapter(UnixHTTPAdapter):
+    """Transport adapter that keeps one connection pool per socket
+
+    docker-py keeps a separate connection pool for every URL requested over
+    a unix socket, so each new endpoint or image name opens a new connection
+    to the daemon. All requests go to the same socket, so one pool is enough.
+    """
+
+    def get_connection(self, url, proxies=None):
+        return super().get_connection("http+docker://localhost", proxies)
+
+
+def make_docker_client(**kwargs):
+    """Create a docker API client configured from the environment
+
+    Extra keyword arguments are passed to `docker.APIClient`. The API version
+    is negotiated with the daemon the first time a client for a particular
+    daemon is created and reused for all later clients.
+    """
+    kwargs = dict(kwargs_from_env(), **kwargs)
+    base_url = kwargs.get("base_url")
+    kwargs.setdefault("version", _docker_api_versions.get(base_url, "auto"))
+    client = docker.APIClient(**kwargs)
+    if isinstance(client.api_version, str):
+        _docker_api_versions[base_url] = client.api_version
+
+    adapter = client.get_adapter(client.base_url)
+    if type(adapter) is UnixHTTPAdapter:
+        client.mount(
+            "http+docker://",
+            _SinglePoolUnixHTTPAdapter(
+                "http+unix://" + adapter.socket_path,
+                timeout=adapter.timeout,
+                max_pool_size=adapter.max_pool_size,
+            ),
+        )
+        adapter.close()
+    return client
+
+
+def _in_background(func, *args):
+    """Call `func` in a daemon thread, returns a Future for the result"""
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
 
 class Repo2Docker(Application):
     """An application for converting git repositories to docker images"""
@@ -88,6 +161,31 @@ class Repo2Docker(Application):
         """,
     )
 
+    push_progress_interval = Float(
+        1.5,
+        config=True,
+        help="""
+        Seconds between progress reports while pushing an image.
+
+        Each report only contains the layers that changed since the previous
+        one, together with the total bytes pushed, throughput and estimated
+        time left.
+        """,
+    )
+
+    prefetch_images = Bool(
+        True,
+        config=True,
+        help="""
+        Pull the base image and the `cache_from` images before building.
+
+        Once the build pack is picked and an image has to be built, the
+        images that do not exist locally are pulled at the same time, also
+        while waiting for `build_semaphore`. Images named in the Dockerfile
+        of a repository are still pulled by the build.
+        """,
+    )
+
     buildpacks = List(
         [
             LegacyBinderDockerBuildPack,
@@ -128,6 +226,75 @@ class Repo2Docker(Application):
         config=True,
     )
 
+    ignore_patterns = List(
+        [],
+        config=True,
+        help="""
+        Patterns of files in the repository to exclude from the build context.
+
+        Patterns use the same syntax as `.gitignore` files, are relative to
+        the root of the repository and are applied after the patterns read
+        from `.r2dignore` files in the repository. For example
+        `[".git/", "*.pyc"]`.
+
+        Repositories built from a Dockerfile use the `.dockerignore`
+        handling of docker itself.
+        """,
+    )
+
+    reproducible_context = Bool(
+        False,
+        config=True,
+        help="""
+        Build a reproducible build context and reuse images built from it.
+
+        Modification times, permissions and owner names of the files sent
+        to docker are normalised. A digest of the build context is stored in
+        the `repo2docker.context-digest` label of the image. If an image with
+        the same digest already exists it is tagged with the name of the
+        image to build instead of building it again.
+
+        Does not apply to repositories built from a Dockerfile.
+        """,
+    )
+
+    reuse_environment_images = Bool(
+        False,
+        config=True,
+        help="""
+        Build the environment of a repository as a separate image and reuse it.
+
+        The environment image contains everything that is installed before
+        the contents of the repository are copied into the image: the base
+        image, system packages and the packages installed from files like
+        `environment.yml` or `requirements.txt`. It is tagged
+        `r2d-environment:<fingerprint>`, where the fingerprint is a digest of
+        the buildpack, the Dockerfile of the environment image, the build
+        arguments and the content of those files. Repositories with the same
+        fingerprint share one environment image and only build the layers
+        that contain the repository.
+
+        Does not apply to repositories built from a Dockerfile.
+        """,
+    )
+
+    build_semaphore = Any(
+        None,
+        allow_none=True,
+        help="""
+        Semaphore that is held while docker builds the image.
+
+        Used to limit the number of concurrent builds when several instances
+        share a process. `None` means builds are not limited.
+        """,
+    )
+
+    timings = Dict(
+        help="""
+        Seconds spent fetching and building during the last call to `build()`.
+        """
+    )
+
     default_buildpack = Any(
         PythonBuildPack,
         config=True,
@@ -277,6 +444,148 @@ class Repo2Docker(Application):
         config=True,
     )
 
+    shallow_fetch = Bool(
+        False,
+        help="""
+        Fetch only the history needed to check out the given ref.
+
+        Git repositories are fetched at depth 1 when possible, with deeper
+        fetches and finally a full clone as fallbacks. The checkout then has
+        a shallow history, which breaks tools that need it such as
+        `git describe` or setuptools_scm. Off by default, which clones the
+        full history.
+        """,
+        config=True,
+    )
+
+    submodule_jobs = Int(
+        4,
+        help="""
+        Number of git submodules to fetch at the same time.
+        """,
+        config=True,
+    )
+
+    submodule_depth = Int(
+        0,
+        help="""
+        Depth at which git submodules are fetched.
+
+        If the pinned commit of a submodule can not be fetched at this depth
+        its full history is fetched. Shallow submodules break tools that need
+        their history such as `git describe` or setuptools_scm, so the
+        default of 0 fetches the full history.
+        """,
+        config=True,
+    )
+
+    ref_cache_ttl = Float(
+        60,
+        help="""
+        Seconds for which the commit a git ref points to is remembered.
+
+        Before fetching a git repository the ref is resolved with
+        `git ls-remote` to check if an image for that commit already exists.
+        """,
+        config=True,
+    )
+
+    doi_cache = Unicode(
+        "",
+        help="""
+        JSON file in which to remember the URLs DOIs resolve to.
+
+        Within one run each DOI is resolved at most once, with this file
+        resolved DOIs are also reused by later runs.
+        """,
+        config=True,
+    )
+
+    doi_cache_ttl = Float(
+        24 * 60 * 60,
+        help="""
+        Seconds for which a resolved DOI in `doi_cache` is reused.
+        """,
+        config=True,
+    )
+
+    download_workers = Int(
+        4,
+        help="""
+        Number of files of a Zenodo, Figshare or Dataverse record that are
+        downloaded at the same time.
+        """,
+        config=True,
+    )
+
+    http_timeout = Float(
+        60,
+        help="""
+        Seconds to wait for a connection to, or data from, the hosts of
+        Zenodo, Figshare and Dataverse records before giving up.
+        """,
+        config=True,
+    )
+
+    download_cache = Unicode(
+        "",
+        help="""
+        Directory in which to keep the files of Zenodo, Figshare and
+        Dataverse records.
+
+        Files are stored by their checksum, so fetching a record again or
+        another record that shares files with it does not download them
+        again. Concurrent builds on one host can share the directory. Leave
+        empty to download every time.
+        """,
+        config=True,
+    )
+
+    download_cache_size = ByteSpecification(
+        0,
+        help="""
+        Total size of the download cache.
+
+        The least recently used files are removed when the cache grows
+        beyond this size. Set to 0 for no limit.
+        """,
+        config=True,
+    )
+
+    git_mirror_cache = Unicode(
+        "",
+        help="""
+        Directory in which to keep bare mirrors of git repositories.
+
+        Each remote repository is mirrored once, later builds only fetch new
+        commits into the mirror and clone from it. Concurrent builds on one
+        host can share the directory. Leave empty to clone from the remote
+        every time.
+        """,
+        config=True,
+    )
+
+    git_mirror_cache_size = ByteSpecification(
+        0,
+        help="""
+        Total size of the git mirror cache.
+
+        The least recently used mirrors are removed when the cache grows
+        beyond this size. Set to 0 for no limit.
+        """,
+        config=True,
+    )
+
+    git_mirror_cache_max_age = Float(
+        0,
+        help="""
+        Seconds after which an unused git mirror is removed.
+
+        Set to 0 to keep mirrors regardless of their age.
+        """,
+        config=True,
+    )
+
     output_image_spec = Unicode(
         "",
         help="""
@@ -367,52 +676,191 @@ class Repo2Docker(Application):
         config=True,
     )
 
-    def fetch(self, url, ref, checkout_path):
-        """Fetch the contents of `url` and place it in `checkout_path`.
+    image_index = Any(
+        None,
+        allow_none=True,
+        help="""
+        An optional `repo2docker.images.ImageIndex` used to check if an
+        image already exists without asking docker.
 
-        The `ref` parameter specifies what "version" of the contents should be
-        fetched. In the case of a git repository `ref` is the SHA-1 of a commit.
+        Useful for processes that perform many builds. The index has to be
+        started by whoever creates it.
+        """,
+    )
+
+    docker_client = Any(
+        help="""
+        The `docker.APIClient` used to talk to the docker daemon.
 
-        Iterate through possible content providers until a valid provider,
-        based on URL, is found.
+        Created on first use and shared by all steps of repo2docker, so
+        connections to the daemon are reused.
         """
-        picked_content_provider = None
+    )
+
+    doi_resolver = Any(
+        help="""
+        The `DoiResolver` shared by the DOI based content providers.
+        """
+    )
+
+    http_pool = Any(
+        help="""
+        The `HTTPConnectionPool` used by the DOI based content providers.
+
+        Connections to the same host are kept open between requests and the
+        number and latency of the requests to each host are recorded.
+        """
+    )
+
+    mirror_cache = Any(
+        allow_none=True,
+        help="""
+        The `MirrorCache` of git repositories in `git_mirror_cache`, None if
+        that is not set.
+        """,
+    )
+
+    file_cache = Any(
+        allow_none=True,
+        help="""
+        The `DownloadCache` of the files in `download_cache`, None if that is
+        not set.
+        """,
+    )
+
+    @default("mirror_cache")
+    def _default_mirror_cache(self):
+        if not self.git_mirror_cache:
+            return None
+        return MirrorCache(
+            self.git_mirror_cache,
+            max_size=self.git_mirror_cache_size,
+            max_age=self.git_mirror_cache_max_age,
+        )
+
+    @default("file_cache")
+    def _default_file_cache(self):
+        if not self.download_cache:
+            return None
+        return DownloadCache(self.download_cache, max_size=self.download_cache_size)
+
+    @default("http_pool")
+    def _default_http_pool(self):
+        return HTTPConnectionPool(timeout=self.http_timeout)
+
+    @default("doi_resolver")
+    def _default_doi_resolver(self):
+        return DoiResolver(cache_file=self.doi_cache or None, ttl=self.doi_cache_ttl)
+
+    @default("docker_client")
+    def _default_docker_client(self):
+        return make_docker_client()
+
+    def _docker_high_level_client(self):
+        """A `docker.DockerClient` that shares `docker_client`"""
+        # DockerClient.__init__ only creates an APIClient, which would ignore
+        # the settings `docker_client` was created with, so skip it
+        client = docker.DockerClient.__new__(docker.DockerClient)
+        client.api = self.docker_client
+        return client
+
+    def pick_content_provider(self, url, ref):
+        """The content provider that can fetch `url`, and its spec.
+
+        Detection has two phases. First each provider cheaply rules out URLs
+        it can not handle, without any network requests. Then the remaining
+        providers are asked in turn to `detect` the URL, which may involve
+        network requests, until a valid provider is found.
+        """
+        extra_args = {
+            "shallow": self.shallow_fetch,
+            "submodule_jobs": self.submodule_jobs,
+            "submodule_depth": self.submodule_depth,
+            "ref_cache_ttl": self.ref_cache_ttl,
+            "doi_resolver": self.doi_resolver,
+            "http_pool": self.http_pool,
+            "download_workers": self.download_workers,
+            "mirror_cache": self.mirror_cache,
+            "download_cache": self.file_cache,
+        }
+
+        candidates = []
+        timings = []
         for ContentProvider in self.content_providers:
             cp = ContentProvider()
-            spec = cp.detect(url, ref=ref)
+            if cp.may_detect(url, ref=ref):
+                candidates.append(cp)
+            else:
+                timings.append("{} skipped".format(ContentProvider.__name__))
+
+        for cp in candidates:
+            start = time.monotonic()
+            spec = cp.detect(url, ref=ref, extra_args=extra_args)
+            timings.append(
+                "{} {:.3f}s".format(cp.__class__.__name__, time.monotonic() - start)
+            )
             if spec is not None:
-                picked_content_provider = cp
+                self.log.info("Content provider detection: %s\n", ", ".join(timings))
                 self.log.info(
                     "Picked {cp} content "
                     "provider.\n".format(cp=cp.__class__.__name__)
                 )
-                break
+                return cp, spec
 
-        if picked_content_provider is None:
-            self.log.error(
-                "No matching content provider found for " "{url}.".format(url=url)
-            )
+        self.log.info("Content provider detection: %s\n", ", ".join(timings))
+        self.log.error(
+            "No matching content provider found for " "{url}.".format(url=url)
+        )
+        return None, None
+
+    def fetch(self, url, ref, checkout_path, content_provider=None):
+        """Fetch the contents of `url` and place it in `checkout_path`.
+
+        The `ref` parameter specifies what "version" of the contents should be
+        fetched. In the case of a git repository `ref` is the SHA-1 of a commit.
+
+        `content_provider` is the provider and spec returned by
+        `pick_content_provider`, which is called if it is not given.
+        """
+        if content_provider is None:
+            content_provider = self.pick_content_provider(url, ref)
+        picked_content_provider, spec = content_provider
 
         for log_line in picked_content_provider.fetch(
             spec, checkout_path, yield_output=self.json_logs
         ):
             self.log.info(log_line, extra=dict(phase="fetching"))
+        self._log_http_metrics()
 
         if not self.output_image_spec:
-            self.output_image_spec = (
-                "r2d" + escapism.escape(self.repo, escape_char="-").lower()
+            self.output_image_spec = self._default_image_spec(
+                picked_content_provider.content_id
             )
-            # if we are building from a subdirectory include that in the
-            # image name so we can tell builds from different sub-directories
-            # apart.
-            if self.subdir:
-                self.output_image_spec += escapism.escape(
-                    self.subdir, escape_char="-"
-                ).lower()
-            if picked_content_provider.content_id is not None:
-                self.output_image_spec += picked_content_provider.content_id
-            else:
-                self.output_image_spec += str(int(time.time()))
+
+    def _log_http_metrics(self):
+        """Log the number and latency of the HTTP requests made so far"""
+        for host, metrics in sorted(self.http_pool.metrics().items()):
+            self.log.info(
+                "{requests} HTTP requests to {host} over {connections} "
+                "connections, {latency:.3f}s average latency\n".format(
+                    host=host, **metrics
+                ),
+                extra=dict(phase="fetching"),
+            )
+
+    def _default_image_spec(self, content_id):
+        """The name of the image if none was given"""
+        image_spec = "r2d" + escapism.escape(self.repo, escape_char="-").lower()
+        # if we are building from a subdirectory include that in the
+        # image name so we can tell builds from different sub-directories
+        # apart.
+        if self.subdir:
+            image_spec += escapism.escape(self.subdir, escape_char="-").lower()
+        if content_id is not None:
+            image_spec += content_id
+        else:
+            image_spec += str(int(time.time()))
+        return image_spec
 
     def json_excepthook(self, etype, evalue, traceback):
         """Called on an uncaught exception when using json logging
@@ -456,47 +904,29 @@ class Repo2Docker(Application):
 
     def push_image(self):
         """Push docker image to registry"""
-        client = docker.APIClient(version="auto", **kwargs_from_env())
-        # Build a progress setup for each layer, and only emit per-layer
-        # info every 1.5s
-        progress_layers = {}
-        layers = {}
-        last_emit_time = time.time()
-        for chunk in client.push(self.output_image_spec, stream=True):
-            # each chunk can be one or more lines of json events
-            # split lines here in case multiple are delivered at once
-            for line in chunk.splitlines():
-                line = line.decode("utf-8", errors="replace")
-                try:
-                    progress = json.loads(line)
-                except Exception as e:
-                    self.log.warning("Not a JSON progress line: %r", line)
-                    continue
-                if "error" in progress:
-                    self.log.error(progress["error"], extra=dict(phase="failed"))
-                    raise docker.errors.ImageLoadError(progress["error"])
-                if "id" not in progress:
-                    continue
-                # deprecated truncated-progress data
-                if "progressDetail" in progress and progress["progressDetail"]:
-                    progress_layers[progress["id"]] = progress["progressDetail"]
-                else:
-                    progress_layers[progress["id"]] = progress["status"]
-                # include full progress data for each layer in 'layers' data
-                layers[progress["id"]] = progress
-                if time.time() - last_emit_time > 1.5:
-                    self.log.info(
-                        "Pushing image\n",
-                        extra=dict(
-                            progress=progress_layers, layers=layers, phase="pushing"
-                        ),
-                    )
-                    last_emit_time = time.time()
+        client = self.docker_client
+        # Only report the layers that changed, every push_progress_interval
+        progress = PushProgress(interval=self.push_progress_interval)
+        for event in client.push(self.output_image_spec, stream=True, decode=True):
+            if "error" in event:
+                self.log.error(event["error"], extra=dict(phase="failed"))
+                raise docker.errors.ImageLoadError(event["error"])
+            progress.update(event)
+            if progress.due():
+                self._log_push_progress(progress.delta())
+        if progress.layers:
+            self._log_push_progress(progress.delta())
         self.log.info(
             "Successfully pushed {}".format(self.output_image_spec),
             extra=dict(phase="pushing"),
         )
 
+    def _log_push_progress(self, delta):
+        self.log.info(
+            "Pushing image: {}\n".format(describe_push(delta["push"])),
+            extra=dict(delta, phase="pushing"),
+        )
+
     def run_image(self):
         """Run docker container from built image
 
@@ -510,7 +940,7 @@ class Repo2Docker(Application):
 
         Returns running container
         """
-        client = docker.from_env(version="auto")
+        client = self._docker_high_level_client()
 
         docker_host = os.environ.get("DOCKER_HOST")
         if docker_host:
@@ -547,10 +977,7 @@ class Repo2Docker(Application):
 
         container_volumes = {}
         if self.volumes:
-            api_client = docker.APIClient(
-                version="auto", **docker.utils.kwargs_from_env()
-            )
-            image = api_client.inspect_image(self.output_image_spec)
+            image = self.docker_client.inspect_image(self.output_image_spec)
             image_workdir = image["ContainerConfig"]["WorkingDir"]
 
             for k, v in self.volumes.items():
@@ -614,29 +1041,86 @@ class Repo2Docker(Application):
         # always return False for dry runs.
         if self.dry_run:
             return False
-        # check if we already have an image for this content
-        client = docker.APIClient(version="auto", **kwargs_from_env())
-        for image in client.images():
-            if image["RepoTags"] is not None:
-                for tag in image["RepoTags"]:
-                    if tag == self.output_image_spec + ":latest":
-                        return True
-        return False
+        repository, tag = docker.utils.parse_repository_tag(self.output_image_spec)
+        image_spec = "{}:{}".format(repository, tag or "latest")
+        if self.image_index is not None and self.image_index.live:
+            return image_spec in self.image_index
+        # check if we already have an image for this content by asking for
+        # it directly, listing all images is slow on busy hosts
+        try:
+            self.docker_client.inspect_image(image_spec)
+        except docker.errors.NotFound:
+            return False
+        return True
+
+    def _reuse_image_by_digest(self, client, digest):
+        """Tag an existing image built from the same build context
+
+        Returns True if an image was found.
+        """
+        images = client.images(filters={"label": "{}={}".format(DIGEST_LABEL, digest)})
+        if not images:
+            return False
+        repository, tag = docker.utils.parse_repository_tag(self.output_image_spec)
+        client.tag(images[0]["Id"], repository, tag)
+        self.log.info(
+            "Reusing existing image {} with the same build context ({}), not "
+            "building.\n".format(images[0]["Id"], digest),
+            extra=dict(phase="building"),
+        )
+        return True
+
+    def _pull_image(self, client, image_spec):
+        """Pull `image_spec` unless it exists locally
+
+        Errors are only logged, the build will report them if the image is
+        really needed.
+        """
+        repository, tag = docker.utils.parse_repository_tag(image_spec)
+        tag = tag or "latest"
+        if tag.startswith("sha256:"):
+            image_spec = "{}@{}".format(repository, tag)
+        else:
+            image_spec = "{}:{}".format(repository, tag)
+        try:
+            try:
+                client.inspect_image(image_spec)
+                return
+            except docker.errors.NotFound:
+                pass
+
+            self.log.info(
+                "Pulling {} in the background\n".format(image_spec),
+                extra=dict(phase="fetching"),
+            )
+            for line in client.pull(repository, tag=tag, stream=True, decode=True):
+                if "error" in line:
+                    raise DockerException(line["error"])
+        except (DockerException, requests.exceptions.RequestException) as e:
+            self.log.warning(
+                "Could not pull {}: {}\n".format(image_spec, e),
+                extra=dict(phase="fetching"),
+            )
+
+    def _wait_for_docker(self, docker_connected):
+        """Wait for the connection to the docker daemon, exit if it failed"""
+        try:
+            return docker_connected.result()
+        except DockerException as e:
+            self.log.error(
+                "\nDocker client initialization error: %s.\nCheck if docker is running on the host.\n",
+                e,
+            )
+            self.exit(1)
 
     def build(self):
         """
         Build docker image
         """
-        # Check if r2d can connect to docker daemon
+        # Connecting to the docker daemon does not depend on the repository,
+        # so it happens while the repository is being fetched
         if not self.dry_run:
-            try:
-                docker_client = docker.APIClient(version="auto", **kwargs_from_env())
-            except DockerException as e:
-                self.log.error(
-                    "\nDocker client initialization error: %s.\nCheck if docker is running on the host.\n",
-                    e,
-                )
-                self.exit(1)
+            docker_connected = _in_background(lambda: self.docker_client)
 
         # If the source to be executed is a directory, continue using the
         # directory. In the case of a local directory, it is used as both the
@@ -651,8 +1135,42 @@ class Repo2Docker(Application):
             else:
                 checkout_path = self.git_workdir
 
+        self.timings = {}
         try:
-            self.fetch(self.repo, self.ref, checkout_path)
+            start = time.perf_counter()
+            content_provider = self.pick_content_provider(self.repo, self.ref)
+
+            # the name of the image only depends on the content ID, if the
+            # provider knows it before fetching and the image exists there
+            # is no need to fetch anything
+            content_id = None
+            if not self.dry_run:
+                content_id = content_provider[0].resolve_content_id(content_provider[1])
+            if content_id is not None:
+                default_image_spec = not self.output_image_spec
+                if default_image_spec:
+                    self.output_image_spec = self._default_image_spec(content_id)
+                self._wait_for_docker(docker_connected)
+                if self.find_image():
+                    self.timings["resolve"] = time.perf_counter() - start
+                    self.log.info(
+                        "Reusing existing image ({}), not "
+                        "fetching or building.".format(self.output_image_spec)
+                    )
+                    return
+                if default_image_spec:
+                    # named after what is actually fetched, in case the ref
+                    # moved in the meantime
+                    self.output_image_spec = ""
+
+            self.fetch(
+                self.repo, self.ref, checkout_path, content_provider=content_provider
+            )
+            self.timings["fetch"] = time.perf_counter() - start
+
+            # Check if r2d can connect to docker daemon
+            if not self.dry_run:
+                docker_client = self._wait_for_docker(docker_connected)
 
             if self.find_image():
                 self.log.info(
@@ -684,6 +1202,11 @@ class Repo2Docker(Application):
                     picked_buildpack = self.default_buildpack()
 
                 picked_buildpack.appendix = self.appendix
+                picked_buildpack.ignore_patterns = self.ignore_patterns
+                picked_buildpack.reproducible_context = self.reproducible_context
+                picked_buildpack.reuse_environment_images = (
+                    self.reuse_environment_images
+                )
                 # Add metadata labels
                 picked_buildpack.labels["repo2docker.version"] = self.version
                 repo_label = "local" if os.path.isdir(self.repo) else self.repo
@@ -692,46 +1215,78 @@ class Repo2Docker(Application):
 
                 if self.dry_run:
                     print(picked_buildpack.render())
-                else:
-                    self.log.debug(
-                        picked_buildpack.render(), extra=dict(phase="building")
+                    return
+
+                self.log.debug(picked_buildpack.render(), extra=dict(phase="building"))
+                if self.user_id == 0:
+                    raise ValueError(
+                        "Root as the primary user in the image is not permitted."
                     )
-                    if self.user_id == 0:
-                        raise ValueError(
-                            "Root as the primary user in the image is not permitted."
-                        )
 
-                    build_args = {
-                        "NB_USER": self.user_name,
-                        "NB_UID": str(self.user_id),
-                    }
-                    if self.target_repo_dir:
-                        build_args["REPO_DIR"] = self.target_repo_dir
-                    self.log.info(
-                        "Using %s builder\n",
-                        bp.__class__.__name__,
-                        extra=dict(phase="building"),
+                build_args = {"NB_USER": self.user_name, "NB_UID": str(self.user_id)}
+                if self.target_repo_dir:
+                    build_args["REPO_DIR"] = self.target_repo_dir
+                extra_build_kwargs = self.extra_build_kwargs
+                if self.reproducible_context:
+                    digest = picked_buildpack.get_context_digest(
+                        build_args, extra_build_kwargs
                     )
+                    if digest is not None:
+                        if self._reuse_image_by_digest(docker_client, digest):
+                            return
+                        labels = dict(extra_build_kwargs.get("labels", {}))
+                        labels[DIGEST_LABEL] = digest
+                        extra_build_kwargs = dict(extra_build_kwargs, labels=labels)
+
+                # the build will run, pull the images it needs meanwhile
+                pulls = []
+                if self.prefetch_images:
+                    images = [picked_buildpack.base_image] + list(self.cache_from)
+                    pulls = [
+                        _in_background(self._pull_image, docker_client, image_spec)
+                        for image_spec in images
+                        if image_spec
+                    ]
 
-                    for l in picked_buildpack.build(
-                        docker_client,
-                        self.output_image_spec,
-                        self.build_memory_limit,
-                        build_args,
-                        self.cache_from,
-                        self.extra_build_kwargs,
-                    ):
-                        if "stream" in l:
-                            self.log.info(l["stream"], extra=dict(phase="building"))
-                        elif "error" in l:
-                            self.log.info(l["error"], extra=dict(phase="failure"))
-                            raise docker.errors.BuildError(l["error"], build_log="")
-                        elif "status" in l:
-                            self.log.info(
-                                "Fetching base image...\r", extra=dict(phase="building")
-                            )
-                        else:
-                            self.log.info(json.dumps(l), extra=dict(phase="building"))
+                self.log.info(
+                    "Using %s builder\n",
+                    bp.__class__.__name__,
+                    extra=dict(phase="building"),
+                )
+
+                build_lines = picked_buildpack.build(
+                    docker_client,
+                    self.output_image_spec,
+                    self.build_memory_limit,
+                    build_args,
+                    self.cache_from,
+                    extra_build_kwargs,
+                )
+
+            # The build itself does not depend on the working directory any
+            # more, so other threads can use `chdir` while docker is building
+            if self.build_semaphore is not None:
+                self.build_semaphore.acquire()
+            try:
+                for pull in pulls:
+                    pull.result()
+                start = time.perf_counter()
+                for l in build_lines:
+                    if "stream" in l:
+                        self.log.info(l["stream"], extra=dict(phase="building"))
+                    elif "error" in l:
+                        self.log.info(l["error"], extra=dict(phase="failure"))
+                        raise docker.errors.BuildError(l["error"], build_log="")
+                    elif "status" in l:
+                        self.log.info(
+                            "Fetching base image...\r", extra=dict(phase="building")
+                        )
+                    else:
+                        self.log.info(json.dumps(l), extra=dict(phase="building"))
+                self.timings["build"] = time.perf_counter() - start
+            finally:
+                if self.build_semaphore is not None:
+                    self.build_semaphore.release()
 
         finally:
             # Cleanup checkout if necessary
@@ -0,0 +1,261 @@
+"""Build many repositories in one process
+
+    repo2docker batch repos.yaml
+
+reads a list of repositories in the format of
+`tests/external/reproductions.repos.yaml`:
+
+    - name: Binder Examples - Requirements
+      url: https://github.com/binder-examples/requirements
+      ref: master
+      verify: python -c 'import matplotlib'
+
+and builds all of them. Fetching happens on a pool of threads while the
+number of builds the docker daemon runs at the same time is limited
+separately. All builds share one logger, docker client, image index, HTTP
+connection pool, DOI resolver, git mirror cache and download cache. A
+summary of each build (durations, image ID, errors) is written as JSON at
+the end.
+"""
+import argparse
+import json
+import logging
+import os
+import shlex
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from docker.constants import DEFAULT_MAX_POOL_SIZE
+from docker.errors import DockerException
+from ruamel.yaml import YAML
+
+from .app import Repo2Docker, make_docker_client
+from .images import ImageIndex
+
+
+def load_jobs(path):
+    """Read the list of repositories to build from a YAML file"""
+    with open(path) as f:
+        repos = YAML(typ="safe").load(f) or []
+    jobs = []
+    for n, repo in enumerate(repos):
+        if "url" not in repo:
+            raise ValueError("Entry {} in {} has no url".format(n, path))
+        url = repo["url"]
+        if os.path.exists(url):
+            # relative paths would break as soon as a build changes the
+            # working directory
+            url = os.path.abspath(url)
+        jobs.append(
+            {
+                "name": repo.get("name", url),
+                "url": url,
+                "ref": repo.get("ref"),
+                "verify": repo.get("verify"),
+            }
+        )
+    return jobs
+
+
+class BatchBuilder:
+    """Build a list of repositories with bounded concurrency.
+
+    `workers` jobs are processed at the same time, of which at most
+    `concurrent_builds` can be building an image. The other workers fetch
+    repositories or wait for a build slot.
+
+    All builds log to `log` and share the HTTP connection pool, DOI
+    resolver and caches of a Repo2Docker instance created from `config`.
+    """
+
+    def __init__(
+        self, config=None, workers=4, concurrent_builds=2, verify=True, log=None
+    ):
+        self.config = config
+        self.workers = workers
+        self.verify = verify
+        self.build_semaphore = threading.BoundedSemaphore(concurrent_builds)
+        self.log = log if log is not None else logging.getLogger("repo2docker")
+        self.docker_client = None
+        self.image_index = None
+        shared = Repo2Docker(config=config)
+        self.shared = {
+            name: getattr(shared, name)
+            for name in ["http_pool", "doi_resolver", "mirror_cache", "file_cache"]
+        }
+
+    def start(self):
+        """Connect to docker and start following image events"""
+        self.docker_client = make_docker_client(
+            max_pool_size=max(DEFAULT_MAX_POOL_SIZE, self.workers + 1)
+        )
+        self.image_index = ImageIndex(self.docker_client)
+        self.image_index.start()
+
+    def close(self):
+        if self.image_index is not None:
+            self.image_index.close()
+        if self.docker_client is not None:
+            self.docker_client.close()
+
+    def make_app(self, job):
+        """Create the Repo2Docker instance that builds `job`"""
+        app = Repo2Docker(
+            config=self.config,
+            docker_client=self.docker_client,
+            image_index=self.image_index,
+            build_semaphore=self.build_semaphore,
+            log=self.log,
+            **self.shared
+        )
+        app.repo = job["url"]
+        app.ref = job["ref"]
+        app.output_image_spec = ""
+        app.run = False
+        app.push = False
+        app.cleanup_checkout = not os.path.exists(job["url"])
+        return app
+
+    def run_job(self, job):
+        """Build one repository, returns a summary of the result"""
+        result = dict(job, success=False, image=None, image_id=None, error=None)
+        app = self.make_app(job)
+        start = time.perf_counter()
+        try:
+            app.build()
+            result["image"] = app.output_image_spec
+            result["image_id"] = self.docker_client.inspect_image(
+                app.output_image_spec
+            )["Id"]
+            if self.verify and job["verify"]:
+                verify_start = time.perf_counter()
+                self.run_verify(app, job["verify"])
+                app.timings["verify"] = time.perf_counter() - verify_start
+            result["success"] = True
+        except (Exception, SystemExit) as e:
+            self.log.error("Building %s failed: %s\n", job["name"], e)
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["durations"] = dict(app.timings, total=time.perf_counter() - start)
+        return result
+
+    def run_verify(self, app, verify):
+        """Run the `verify` command in a container of the image"""
+        app.run_cmd = shlex.split(verify)
+        container = app.start_container()
+        try:
+            exit_code = container.wait()["StatusCode"]
+        finally:
+            container.remove(force=True)
+        if exit_code:
+            raise RuntimeError("{!r} exited with status {}".format(verify, exit_code))
+
+    def run(self, jobs):
+        """Build all jobs, returns the list of results in the same order"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.run_job, jobs))
+
+
+def summarize(results, duration):
+    """The summary of a batch that is written as JSON"""
+    failed = [r for r in results if not r["success"]]
+    return {
+        "duration": duration,
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "builds": results,
+    }
+
+
+def get_argparser():
+    argparser = argparse.ArgumentParser(
+        prog="repo2docker batch",
+        description="Build all repositories listed in a YAML file",
+    )
+    argparser.add_argument(
+        "repos", help="YAML file with a list of entries with url, ref and verify"
+    )
+    argparser.add_argument(
+        "--config",
+        default="repo2docker_config.py",
+        help="Path to config file for repo2docker",
+    )
+    argparser.add_argument(
+        "--json-logs",
+        default=False,
+        action="store_true",
+        help="Emit JSON logs instead of human readable logs",
+    )
+    argparser.add_argument("--debug", help="Turn on debug logging", action="store_true")
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of repositories to fetch and build at the same time",
+    )
+    argparser.add_argument(
+        "--concurrent-builds",
+        type=int,
+        default=2,
+        help="Maximum number of images docker builds at the same time",
+    )
+    argparser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="Do not run the verify command of each repository",
+    )
+    argparser.add_argument(
+        "--summary", help="Write the JSON summary to this file instead of stdout"
+    )
+    return argparser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[2:]
+    args = get_argparser().parse_args(argv)
+
+    # configure logging once, all builds share the logger
+    r2d = Repo2Docker()
+    if args.debug:
+        r2d.log_level = logging.DEBUG
+    r2d.load_config_file(args.config)
+    r2d.json_logs = args.json_logs
+    r2d.initialize()
+
+    jobs = load_jobs(args.repos)
+    batch = BatchBuilder(
+        config=r2d.config,
+        workers=args.workers,
+        concurrent_builds=args.concurrent_builds,
+        verify=args.verify,
+        log=r2d.log,
+    )
+    try:
+        batch.start()
+    except DockerException as e:
+        r2d.log.error(
+            "\nDocker client initialization error: %s.\n"
+            "Check if docker is running on the host.\n",
+            e,
+        )
+        sys.exit(1)
+
+    start = time.perf_counter()
+    try:
+        results = batch.run(jobs)
+    finally:
+        batch.close()
+    summary = summarize(results, time.perf_counter() - start)
+
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    if summary["failed"]:
+        sys.exit(1)
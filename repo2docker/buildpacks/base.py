@@ -1,20 +1,26 @@
 import textwrap
 import jinja2
-import tarfile
-import io
 import os
 import re
 import logging
 import string
 import sys
 import hashlib
+import json
 import escapism
 import xml.etree.ElementTree as ET
 
+import docker
+
 from traitlets import Dict
 
-TEMPLATE = r"""
-FROM buildpack-deps:bionic
+from .context import CHUNK_SIZE, BuildContext, IgnoreRules
+
+# The Dockerfile is rendered from two parts: the environment, which only
+# depends on the files returned by `get_preassemble_script_files`, and the
+# part that adds the rest of the repository on top of it.
+ENVIRONMENT_TEMPLATE = r"""
+FROM {{ base_image }}
 
 # avoid prompts from apt
 ENV DEBIAN_FRONTEND=noninteractive
@@ -149,7 +155,9 @@ RUN chown -R ${NB_USER}:${NB_USER} ${REPO_DIR}
 {% for sd in preassemble_script_directives -%}
 {{ sd }}
 {% endfor %}
+"""
 
+REPO_TEMPLATE = r"""
 # Copy and chown stuff. This doubles the size of the repo, because
 # you can't actually copy as USER, only as root! Thanks, Docker!
 USER root
@@ -199,10 +207,33 @@ CMD ["jupyter", "notebook", "--ip", "0.0.0.0"]
 {% endif %}
 """
 
+TEMPLATE = ENVIRONMENT_TEMPLATE + REPO_TEMPLATE
+
 ENTRYPOINT_FILE = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "repo2docker-entrypoint"
 )
 
+# Files in the repository (or binder directory) that list files to exclude
+# from the build context. `.dockerignore` is not read: docker anchors its
+# patterns at the root, unlike `.gitignore`, so the same file would exclude
+# different files.
+IGNORE_FILES = [".r2dignore"]
+
+# Environment images are tagged `ENVIRONMENT_IMAGE:<fingerprint>` and carry
+# the fingerprint in a label
+ENVIRONMENT_IMAGE = "r2d-environment"
+ENVIRONMENT_LABEL = "repo2docker.environment-fingerprint"
+
+
+def _update_hash(sha, *items):
+    """Add `items`, strings or bytes, to the hashlib object `sha`"""
+    for item in items:
+        if isinstance(item, str):
+            item = item.encode("utf-8")
+        # prefix with the length so that items can not run together
+        sha.update(b"%d:" % len(item))
+        sha.update(item)
+
 
 class BuildPack:
     """
@@ -221,10 +252,17 @@ class BuildPack:
 
     """
 
+    # The image the Dockerfile starts FROM
+    base_image = "buildpack-deps:bionic"
+
     def __init__(self):
         self.log = logging.getLogger("repo2docker")
         self.appendix = ""
         self.labels = {}
+        self.ignore_patterns = []
+        self.reproducible_context = False
+        self.reuse_environment_images = False
+        self._context_digest = None
         if sys.platform.startswith("win"):
             self.log.warning(
                 "Windows environment detected. Note that Windows "
@@ -504,6 +542,28 @@ class BuildPack:
         """Locate a file"""
         return os.path.join(self.binder_dir, path)
 
+    def get_ignore_patterns(self):
+        """
+        Ordered list of patterns for files that are not sent to docker.
+
+        Patterns use the `.gitignore` syntax and are relative to the root
+        of the repository. They are read from `.r2dignore` files in the root
+        of the repository and in the binder directory, followed by
+        `ignore_patterns` (which is set from the configuration of
+        repo2docker). Later patterns take precedence.
+        """
+        patterns = []
+        dirs = [""]
+        if self.binder_dir:
+            dirs.append(self.binder_dir)
+        for d in dirs:
+            for fname in IGNORE_FILES:
+                path = os.path.join(d, fname)
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        patterns.extend(f.read().splitlines())
+        return patterns + list(self.ignore_patterns)
+
     def detect(self):
         return True
 
@@ -511,7 +571,24 @@ class BuildPack:
         """
         Render BuildPack into Dockerfile
         """
-        t = jinja2.Template(TEMPLATE)
+        return self._render(TEMPLATE)
+
+    def render_environment(self):
+        """
+        Render the part of the Dockerfile that builds the environment image
+        """
+        return self._render(ENVIRONMENT_TEMPLATE)
+
+    def render_repo(self, environment_image):
+        """
+        Render a Dockerfile that adds the repository to `environment_image`
+        """
+        # build arguments have to be declared again after a FROM
+        header = "FROM {}\n\nARG NB_USER\nARG NB_UID\n".format(environment_image)
+        return header + self._render(REPO_TEMPLATE)
+
+    def _render(self, template):
+        t = jinja2.Template(template)
 
         build_script_directives = []
         last_user = "root"
@@ -555,6 +632,7 @@ class BuildPack:
         }
 
         return t.render(
+            base_image=self.base_image,
             packages=sorted(self.get_packages()),
             path=self.get_path(),
             build_env=self.get_build_env(),
@@ -600,23 +678,8 @@ class BuildPack:
             src_path,
         )
 
-    def build(
-        self,
-        client,
-        image_spec,
-        memory_limit,
-        build_args,
-        cache_from,
-        extra_build_kwargs,
-    ):
-        tarf = io.BytesIO()
-        tar = tarfile.open(fileobj=tarf, mode="w")
-        dockerfile_tarinfo = tarfile.TarInfo("Dockerfile")
-        dockerfile = self.render().encode("utf-8")
-        dockerfile_tarinfo.size = len(dockerfile)
-
-        tar.addfile(dockerfile_tarinfo, io.BytesIO(dockerfile))
-
+    @staticmethod
+    def _tar_filter(build_args):
         def _filter_tar(tar):
             # We need to unset these for build_script_files we copy into tar
             # Otherwise they seem to vary each time, preventing effective use
@@ -628,17 +691,160 @@ class BuildPack:
             tar.gid = int(build_args.get("NB_UID", 1000))
             return tar
 
+        return _filter_tar
+
+    def get_build_context(self, build_args, dockerfile=None):
+        """
+        The build context to send to the docker daemon.
+
+        The context contains the rendered Dockerfile (or `dockerfile` if
+        given), the build script files, the entrypoint and the contents of
+        the repository (below `src/`).
+        """
+        if dockerfile is None:
+            dockerfile = self.render()
+        # The build context is generated while it is being uploaded to the
+        # docker daemon so that we never hold the whole repository in memory
+        context = BuildContext(reproducible=self.reproducible_context)
+        context.add_bytes("Dockerfile", dockerfile.encode("utf-8"))
+
+        _filter_tar = self._tar_filter(build_args)
         for src in sorted(self.get_build_script_files()):
             dest_path, src_path = self.generate_build_context_filename(src)
-            tar.add(src_path, dest_path, filter=_filter_tar)
+            context.add(src_path, dest_path, filter=_filter_tar)
 
-        tar.add(ENTRYPOINT_FILE, "repo2docker-entrypoint", filter=_filter_tar)
+        context.add(ENTRYPOINT_FILE, "repo2docker-entrypoint", filter=_filter_tar)
 
-        tar.add(".", "src/", filter=_filter_tar)
+        ignore = IgnoreRules(self.get_ignore_patterns())
 
-        tar.close()
-        tarf.seek(0)
+        def _filter_src(tar):
+            # Excluding a directory here means it is never walked, which is
+            # what makes ignoring large directories cheap
+            path = tar.name.partition("/")[2]
+            if path and ignore.match(path, tar.isdir()):
+                return None
+            return _filter_tar(tar)
+
+        context.add(".", "src/", filter=_filter_src)
+        return context
+
+    def get_environment_context(self, build_args):
+        """
+        The build context of the environment image.
+
+        Only contains the files needed by `render_environment()`: the build
+        script files and the pre-assemble script files from the repository.
+        """
+        context = BuildContext(reproducible=self.reproducible_context)
+        context.add_bytes("Dockerfile", self.render_environment().encode("utf-8"))
+
+        _filter_tar = self._tar_filter(build_args)
+        for src in sorted(self.get_build_script_files()):
+            dest_path, src_path = self.generate_build_context_filename(src)
+            context.add(src_path, dest_path, filter=_filter_tar)
 
+        for src in sorted(self.get_preassemble_script_files()):
+            context.add(src, "src/" + src, filter=_filter_tar)
+        return context
+
+    def get_environment_fingerprint(self, build_args):
+        """
+        Fingerprint of everything that goes into the environment image.
+
+        Covers the buildpack, the rendered environment part of the Dockerfile,
+        the build arguments and the content of the build script and
+        pre-assemble script files. Repositories with the same fingerprint
+        can share the environment image even if the rest of their content
+        differs.
+        """
+        sha = hashlib.sha256()
+
+        def update(*items):
+            _update_hash(sha, *items)
+
+        def update_file(path):
+            file_sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    file_sha.update(chunk)
+            update(file_sha.digest())
+
+        cls = type(self)
+        update(cls.__module__ + "." + cls.__qualname__, self.render_environment())
+        for key, value in sorted(build_args.items()):
+            update(key, value)
+        for src in sorted(self.get_build_script_files()):
+            dest_path, src_path = self.generate_build_context_filename(src)
+            update(dest_path)
+            update_file(src_path)
+        for src in sorted(self.get_preassemble_script_files()):
+            update(src)
+            update_file(src)
+        return sha.hexdigest()
+
+    def get_context_digest(self, build_args, extra_build_kwargs=None):
+        """
+        Digest of the build context without sending it to docker.
+
+        Besides the context it covers the build arguments and the extra
+        build kwargs, which change the image built from the same context.
+        Only meaningful when `reproducible_context` is set, otherwise
+        modification times make the digest change on every checkout.
+        """
+        context = self.get_build_context(build_args)
+        for _ in context:
+            pass
+        self._context_digest = context.digest
+
+        sha = hashlib.sha256()
+        _update_hash(sha, context.digest)
+        for key, value in sorted(build_args.items()):
+            _update_hash(sha, key, value)
+        _update_hash(
+            sha, json.dumps(extra_build_kwargs or {}, sort_keys=True, default=str)
+        )
+        return "sha256:" + sha.hexdigest()
+
+    def _environment_build(self, client, build_args, build_kwargs):
+        """The name of the environment image and the kwargs to build it
+
+        The kwargs are None if the environment image already exists.
+        """
+        fingerprint = self.get_environment_fingerprint(build_args)
+        image = "{}:{}".format(ENVIRONMENT_IMAGE, fingerprint)
+        try:
+            client.inspect_image(image)
+        except docker.errors.NotFound:
+            pass
+        else:
+            return image, None
+
+        build_kwargs = dict(
+            build_kwargs,
+            fileobj=self.get_environment_context(build_args),
+            tag=image,
+            custom_context=True,
+        )
+        # labels meant for the final image (like the context digest) do not
+        # describe the environment image
+        build_kwargs["labels"] = {ENVIRONMENT_LABEL: fingerprint}
+        return image, build_kwargs
+
+    def build(
+        self,
+        client,
+        image_spec,
+        memory_limit,
+        build_args,
+        cache_from,
+        extra_build_kwargs,
+    ):
+        """
+        Build the image, returns an iterator over the lines of the build log.
+
+        Everything that depends on the working directory is done before
+        returning, the builds only start once the iterator is consumed.
+        """
         # If you work on this bit of code check the corresponding code in
         # buildpacks/docker.py where it is duplicated
         if not isinstance(memory_limit, int):
@@ -655,9 +861,6 @@ class BuildPack:
             limits = {"memory": memory_limit, "memswap": memory_limit}
 
         build_kwargs = dict(
-            fileobj=tarf,
-            tag=image_spec,
-            custom_context=True,
             buildargs=build_args,
             decode=True,
             forcerm=True,
@@ -665,11 +868,54 @@ class BuildPack:
             container_limits=limits,
             cache_from=cache_from,
         )
-
         build_kwargs.update(extra_build_kwargs)
 
-        for line in client.build(**build_kwargs):
-            yield line
+        # list of (log message, build kwargs) for the builds to run
+        builds = []
+        dockerfile = None
+        if self.reuse_environment_images:
+            environment_image, environment_kwargs = self._environment_build(
+                client, build_args, build_kwargs
+            )
+            if environment_kwargs is None:
+                message = "Reusing environment image {}\n"
+            else:
+                message = "Building environment image {}\n"
+            builds.append((message.format(environment_image), environment_kwargs))
+            dockerfile = self.render_repo(environment_image)
+
+        context = self.get_build_context(build_args, dockerfile=dockerfile)
+        builds.append(
+            (
+                None,
+                dict(
+                    build_kwargs, fileobj=context, tag=image_spec, custom_context=True
+                ),
+            )
+        )
+
+        # the digest is computed from the full Dockerfile, only compare it
+        # with a context that contains the same Dockerfile
+        if dockerfile is None:
+            return self._run_builds(client, builds, context)
+        return self._run_builds(client, builds)
+
+    def _run_builds(self, client, builds, context=None):
+        for message, build_kwargs in builds:
+            if message is not None:
+                yield {"stream": message}
+            if build_kwargs is not None:
+                yield from client.build(**build_kwargs)
+
+        if (
+            context is not None
+            and self._context_digest
+            and context.digest not in (None, self._context_digest)
+        ):
+            self.log.warning(
+                "The repository changed while it was being built, the build "
+                "context digest {} is out of date.\n".format(self._context_digest)
+            )
 
 
 class BaseImage(BuildPack):
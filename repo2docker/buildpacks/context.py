@@ -0,0 +1,290 @@
+"""Streaming producer for the docker build context
+
+The build context is a tar archive that is uploaded to the docker daemon.
+Instead of assembling the whole archive in memory before starting the upload
+we generate it block by block while walking the repository. This keeps memory
+use bounded, independent of the size of the repository, and lets the daemon
+start receiving data before the walk has finished.
+"""
+import hashlib
+import os
+import re
+import stat
+import tarfile
+
+# Amount of tar data to collect before handing it to the docker client. Files
+# are read in pieces of this size as well, which bounds the memory used.
+CHUNK_SIZE = 256 * 1024
+
+# Image label used to record the digest of the build context of an image
+DIGEST_LABEL = "repo2docker.context-digest"
+
+
+def _translate(pattern):
+    """Translate a gitignore style glob into a regular expression"""
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern[i : i + 2] == "*/":
+                # "**/" matches zero or more directories
+                res.append("(?:.*/)?")
+                i += 2
+            elif pattern[i : i + 1] == "*":
+                # a trailing "**" (or one not followed by a slash)
+                # matches everything
+                res.append(".*")
+                i += 1
+            else:
+                res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                res.append(re.escape(c))
+            else:
+                stuff = pattern[i:j].replace("\\", "\\\\")
+                if stuff.startswith("!"):
+                    stuff = "^" + stuff[1:]
+                res.append("[{}]".format(stuff))
+                i = j + 1
+        elif c == "\\" and i < n:
+            res.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+    return "".join(res)
+
+
+class IgnoreRules:
+    """Decide which paths to leave out of the build context.
+
+    Patterns use the syntax of `.gitignore` files: blank lines and lines
+    starting with `#` are skipped, `!` negates a pattern, a trailing `/`
+    only matches directories and patterns that contain a `/` (other than a
+    trailing one) are anchored to the root of the repository. The last
+    pattern that matches a path decides its fate.
+
+    The rules are meant to be used during a top-down walk: once a directory
+    is excluded its contents are never visited, so (like git) a file can not
+    be re-included when one of its parent directories is excluded.
+    """
+
+    def __init__(self, patterns=()):
+        rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if pattern.startswith("./"):
+                pattern = pattern[2:]
+            anchored = "/" in pattern
+            regex = _translate(pattern.lstrip("/"))
+            if not anchored:
+                regex = "(?:.*/)?" + regex
+            rules.append((negate, dir_only, regex))
+
+        # Consecutive rules with the same outcome are combined into a single
+        # regular expression so that matching a path costs one regex search
+        # per group instead of one per pattern.
+        self._groups = []
+        for negate, dir_only, regex in rules:
+            if self._groups and self._groups[-1][:2] == [negate, dir_only]:
+                self._groups[-1][2].append(regex)
+            else:
+                self._groups.append([negate, dir_only, [regex]])
+        self._groups = [
+            (negate, dir_only, re.compile("|".join(regexes)))
+            for negate, dir_only, regexes in reversed(self._groups)
+        ]
+
+    def __bool__(self):
+        return bool(self._groups)
+
+    def match(self, path, is_dir=False):
+        """Return True if `path` (relative to the repository root) is ignored"""
+        for negate, dir_only, regex in self._groups:
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(path):
+                return not negate
+        return False
+
+
+def _gettarinfo(path, arcname):
+    """Create a TarInfo for the file at `path`.
+
+    Mirrors `tarfile.TarFile.gettarinfo` for the file types that make sense
+    in a build context. Returns `None` for sockets, devices and other special
+    files.
+    """
+    st = os.lstat(path)
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.mtime = st.st_mtime
+    if stat.S_ISREG(st.st_mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(path)
+    else:
+        return None
+    return tarinfo
+
+
+class BuildContext:
+    """A tar archive that is generated while it is being read.
+
+    Entries are registered with `add()` and `add_bytes()`, nothing is read
+    from disk until the instance is iterated over. Iterating yields chunks of
+    bytes that together form a valid tar archive. Each iteration walks the
+    file system afresh. The instance can be passed
+    directly as `fileobj` to `docker.APIClient.build(custom_context=True)`.
+
+    A SHA256 digest of the archive is computed while it is generated and
+    available as `digest` once the archive has been read completely. With
+    `reproducible=True` modification times, permissions and owner names are
+    normalised so that the same content always produces the same archive,
+    and hence the same digest.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, reproducible=False):
+        self.chunk_size = chunk_size
+        self.reproducible = reproducible
+        self.digest = None
+        self._entries = []
+
+    def add_bytes(self, arcname, data):
+        """Add a regular file called `arcname` with `data` as content"""
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = len(data)
+        self._entries.append((tarinfo, data))
+
+    def add(self, path, arcname, filter=None):
+        """Add the file or directory at `path` under the name `arcname`
+
+        Directories are added recursively. `filter` works like the argument
+        of the same name of `tarfile.TarFile.add`: it is called with each
+        TarInfo and can return a modified TarInfo or `None` to exclude the
+        entry (and for directories all their contents). Relative paths are
+        resolved when they are added, not when the archive is generated.
+        """
+        self._entries.append((os.path.abspath(path), arcname.rstrip("/"), filter))
+
+    def _walk(self, path, arcname):
+        """Yield (tarinfo, path) for `path` and everything below it.
+
+        Directories are yielded before their contents, and the contents are
+        visited in sorted order, like `tarfile.TarFile.add` does.
+        """
+        tarinfo = _gettarinfo(path, arcname)
+        if tarinfo is None:
+            return
+        # give the filter a chance to prune a directory before we descend
+        tarinfo = yield tarinfo, path
+        if tarinfo is not None and tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                yield from self._walk(
+                    os.path.join(path, name), "{}/{}".format(arcname, name)
+                )
+
+    def _members(self):
+        """Yield (tarinfo, source) for all entries after filtering"""
+        for entry in self._entries:
+            if len(entry) == 2:
+                yield entry
+                continue
+            path, arcname, filter = entry
+            members = self._walk(path, arcname)
+            try:
+                tarinfo, path = next(members)
+                while True:
+                    if filter is not None:
+                        tarinfo = filter(tarinfo)
+                    if tarinfo is not None:
+                        yield tarinfo, path
+                    tarinfo, path = members.send(tarinfo)
+            except StopIteration:
+                pass
+
+    @staticmethod
+    def _normalise(tarinfo):
+        """Remove all metadata from `tarinfo` that does not affect the build"""
+        tarinfo.mtime = 0
+        tarinfo.uname = ""
+        tarinfo.gname = ""
+        if tarinfo.isdir() or tarinfo.mode & 0o111:
+            tarinfo.mode = 0o755
+        else:
+            tarinfo.mode = 0o644
+        return tarinfo
+
+    def _blocks(self):
+        """Yield the tar archive as a sequence of byte strings"""
+        offset = 0
+        for tarinfo, source in self._members():
+            if self.reproducible:
+                tarinfo = self._normalise(tarinfo)
+            # use a fixed format so the archive does not depend on the
+            # version of Python
+            header = tarinfo.tobuf(
+                tarfile.GNU_FORMAT, tarfile.ENCODING, "surrogateescape"
+            )
+            offset += len(header)
+            yield header
+            if not tarinfo.isreg():
+                continue
+            if isinstance(source, bytes):
+                yield source
+            else:
+                yield from self._read_file(source, tarinfo.size)
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+                blocks += 1
+            offset += blocks * tarfile.BLOCKSIZE
+
+        # end of archive marker, padded to a full record like tarfile does
+        offset += tarfile.BLOCKSIZE * 2
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        remainder = offset % tarfile.RECORDSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+
+    def _read_file(self, path, size):
+        """Yield exactly `size` bytes read from `path`"""
+        with open(path, "rb") as f:
+            while size > 0:
+                data = f.read(min(size, self.chunk_size))
+                if not data:
+                    raise OSError("{} changed size while adding it".format(path))
+                size -= len(data)
+                yield data
+
+    def __iter__(self):
+        self.digest = None
+        sha = hashlib.sha256()
+        buf = bytearray()
+        for block in self._blocks():
+            buf += block
+            if len(buf) >= self.chunk_size:
+                sha.update(buf)
+                yield bytes(buf)
+                del buf[:]
+        if buf:
+            sha.update(buf)
+            yield bytes(buf)
+        self.digest = "sha256:" + sha.hexdigest()
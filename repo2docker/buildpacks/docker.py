@@ -9,6 +9,9 @@ class DockerBuildPack(BuildPack):
     """Docker BuildPack"""
 
     dockerfile = "Dockerfile"
+    # the base image is named in the repository's Dockerfile, docker pulls
+    # it during the build so nothing is pulled in advance
+    base_image = None
 
     def detect(self):
         """Check if current repo should be built with the Docker BuildPack"""
@@ -20,6 +23,10 @@ class DockerBuildPack(BuildPack):
         with open(Dockerfile) as f:
             return f.read()
 
+    def get_context_digest(self, build_args, extra_build_kwargs=None):
+        """The build context of Dockerfile builds is assembled by docker-py"""
+        return None
+
     def build(
         self,
         client,
@@ -29,7 +36,11 @@ class DockerBuildPack(BuildPack):
         cache_from,
         extra_build_kwargs,
     ):
-        """Build a Docker image based on the Dockerfile in the source repo."""
+        """Build a Docker image based on the Dockerfile in the source repo.
+
+        Returns an iterator over the lines of the build log, the build starts
+        once it is consumed.
+        """
         # If you work on this bit of code check the corresponding code in
         # buildpacks/base.py where it is duplicated
         if not isinstance(memory_limit, int):
@@ -59,5 +70,4 @@ class DockerBuildPack(BuildPack):
 
         build_kwargs.update(extra_build_kwargs)
 
-        for line in client.build(**build_kwargs):
-            yield line
+        return self._run_builds(client, [(None, build_kwargs)])
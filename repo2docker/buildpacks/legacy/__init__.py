@@ -16,6 +16,8 @@ class LegacyBinderDockerBuildPack(DockerBuildPack):
     """Legacy build pack for compatibility to first version of Binder."""
 
     dockerfile = "._binder.Dockerfile"
+    # replaces the FROM line of the repository's Dockerfile
+    base_image = "andrewosh/binder-base@sha256:eabde24f4c55174832ed8795faa40cea62fc9e2a4a9f1ee1444f8a2e4f9710ee"
 
     legacy_prependix = dedent(
         r"""
@@ -63,10 +65,7 @@ class LegacyBinderDockerBuildPack(DockerBuildPack):
         the Dockerfile.
 
         """
-        segments = [
-            "FROM andrewosh/binder-base@sha256:eabde24f4c55174832ed8795faa40cea62fc9e2a4a9f1ee1444f8a2e4f9710ee",
-            self.legacy_prependix,
-        ]
+        segments = ["FROM {}".format(self.base_image), self.legacy_prependix]
         with open("Dockerfile") as f:
             for line in f:
                 if line.strip().startswith("FROM"):
@@ -0,0 +1,175 @@
+"""
+Extract ZIP and tar archives of records into the checkout
+
+Tar archives are read as a stream, so they are unpacked while they are
+being downloaded. ZIP archives keep their index at the end and are
+extracted from a temporary file. In both cases a single top-level directory
+is stripped while extracting, and the size of every file is checked.
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from .base import ContentProviderException
+
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+CHUNK_SIZE = 1024 * 1024
+
+
+def archive_kind(filename):
+    """"zip", "tar" or None depending on the extension of `filename`"""
+    name = filename.lower()
+    if name.endswith(".zip"):
+        return "zip"
+    if name.endswith(TAR_SUFFIXES):
+        return "tar"
+    return None
+
+
+class _Extractor:
+    """Write the members of an archive below `output_dir`.
+
+    Members are assumed to share one top-level directory which is stripped.
+    As soon as a member shows up outside of it, the files extracted so far
+    are moved into that directory and the remaining members are extracted
+    with their full names.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = os.path.abspath(output_dir)
+        self.prefix = None
+        self.strip = True
+
+    def _target(self, name, is_dir=False):
+        """Path to extract member `name` to, None to skip it"""
+        parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+        if not parts:
+            return None
+        if ".." in parts or os.path.isabs(name):
+            raise ContentProviderException(
+                "Archive member {} is outside of the archive".format(name)
+            )
+        if self.strip:
+            if self.prefix is None:
+                self.prefix = parts[0]
+            if parts[0] != self.prefix or (len(parts) == 1 and not is_dir):
+                self._unstrip()
+        if self.strip:
+            parts = parts[1:]
+            if not parts:
+                # the top-level directory itself
+                return None
+        target = os.path.join(self.output_dir, *parts)
+        # symlinks extracted earlier must not lead outside of output_dir
+        parent = os.path.realpath(os.path.dirname(target))
+        if os.path.commonpath([parent, os.path.realpath(self.output_dir)]) != (
+            os.path.realpath(self.output_dir)
+        ):
+            raise ContentProviderException(
+                "Archive member {} is outside of the archive".format(name)
+            )
+        return target
+
+    def _unstrip(self):
+        """Move what was extracted so far back into the top-level directory"""
+        self.strip = False
+        extracted = os.listdir(self.output_dir)
+        if not extracted:
+            return
+        tmp = tempfile.mkdtemp(prefix=".unstrip-", dir=self.output_dir)
+        for name in extracted:
+            os.rename(os.path.join(self.output_dir, name), os.path.join(tmp, name))
+        os.rename(tmp, os.path.join(self.output_dir, self.prefix))
+
+    def directory(self, name, mode=None):
+        target = self._target(name, is_dir=True)
+        if target is not None:
+            os.makedirs(target, exist_ok=True)
+            if mode:
+                os.chmod(target, mode | 0o700)
+
+    def file(self, name, src, size, mode=None):
+        """Write the contents of file object `src`, which must be `size` bytes"""
+        target = self._target(name)
+        if target is None:
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        written = 0
+        with open(target, "wb") as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                written += len(chunk)
+        if written != size:
+            raise ContentProviderException(
+                "Archive member {} has {} bytes instead of {}".format(
+                    name, written, size
+                )
+            )
+        if mode:
+            os.chmod(target, mode | 0o600)
+
+    def link(self, name, linkname, symbolic=True):
+        target = self._target(name)
+        if target is None:
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if symbolic:
+            os.symlink(linkname, target)
+        else:
+            # hard links point at a member extracted earlier
+            source = self._target(linkname)
+            if source is None or not os.path.isfile(source):
+                raise ContentProviderException(
+                    "Archive member {} links to missing {}".format(name, linkname)
+                )
+            shutil.copy2(source, target)
+
+
+def extract_tar(src, output_dir):
+    """Extract the tar archive read from the file object `src`.
+
+    The archive is read strictly sequentially, `src` can be a network
+    stream. Compression is detected automatically. Raises `tarfile.ReadError`
+    before anything is extracted if `src` is not a tar archive.
+    """
+    extractor = _Extractor(output_dir)
+    tar = tarfile.open(fileobj=src, mode="r|*")
+    try:
+        with tar:
+            for member in tar:
+                mode = member.mode & 0o777
+                if member.isdir():
+                    extractor.directory(member.name, mode)
+                elif member.isfile():
+                    extractor.file(
+                        member.name, tar.extractfile(member), member.size, mode
+                    )
+                elif member.issym():
+                    extractor.link(member.name, member.linkname)
+                elif member.islnk():
+                    extractor.link(member.name, member.linkname, symbolic=False)
+                # devices, FIFOs, ... have no place in a repository
+    except (tarfile.TarError, EOFError) as e:
+        raise ContentProviderException("Could not extract archive: {}".format(e))
+
+
+def extract_zip(path, output_dir):
+    """Extract the ZIP archive at `path`, checking size and CRC of each file"""
+    extractor = _Extractor(output_dir)
+    try:
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                # permissions are only recorded by ZIP files made on unix
+                mode = (info.external_attr >> 16) & 0o777
+                if info.is_dir():
+                    extractor.directory(info.filename, mode)
+                else:
+                    with archive.open(info) as src:
+                        extractor.file(info.filename, src, info.file_size, mode)
+    except (zipfile.BadZipFile, EOFError) as e:
+        raise ContentProviderException("Could not extract archive: {}".format(e))
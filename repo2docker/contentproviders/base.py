@@ -32,6 +32,27 @@ class ContentProvider:
         """
         return None
 
+    def resolve_content_id(self, spec):
+        """Determine `content_id` for `spec` without fetching the contents.
+
+        Providers that can cheaply find out which version of the contents
+        `fetch` would provide return its content ID here, after which
+        `content_id` returns the same value. This lets repo2docker skip the
+        fetch if an image for this content ID already exists. Returns None
+        if the content ID is only known after fetching.
+        """
+        return None
+
+    def may_detect(self, repo, ref=None):
+        """Cheaply determine if `detect` could accept `repo`.
+
+        Only the strings are looked at, no network requests are made.
+        Returning False promises that `detect` would return `None`, so
+        repo2docker does not call it. Providers that can not tell without
+        doing I/O return True.
+        """
+        return True
+
     def detect(self, repo, ref=None, extra_args=None):
         """Determine compatibility between source and this provider.
 
@@ -0,0 +1,212 @@
+"""
+A cache of the files downloaded for DOI based records
+
+Files are stored once per content, under the checksum the archive publishes
+for them. Files without a checksum are stored under their URL and size.
+Fetching a record again, or another record that shares files with it,
+downloads nothing.
+
+Files are downloaded into the cache and hardlinked into checkouts, so
+editing a checkout in place can change the cached file. That is why files
+with a checksum are hashed again each time they are taken from the cache
+and removed if they no longer match. Files without a checksum can not be
+verified, they are copied into checkouts instead.
+
+Blobs are only ever added by renaming a complete file into place and
+removed with a single unlink, so several builds on one host can share the
+cache without locking: a blob that disappears while it is linked is just a
+cache miss.
+"""
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+
+
+def parse_checksum(value):
+    """`(algorithm, hex digest)` of a checksum from a record's metadata.
+
+    Understands "md5:<digest>", a bare MD5 digest and Dataverse style
+    `{"type": "MD5", "value": <digest>}`. Returns None for anything else
+    and for algorithms hashlib does not know.
+    """
+    if isinstance(value, dict):
+        value = "{}:{}".format(value.get("type", ""), value.get("value", ""))
+    if not isinstance(value, str) or not value:
+        return None
+    if ":" in value:
+        algorithm, digest = value.split(":", 1)
+    else:
+        algorithm, digest = "md5", value
+    algorithm = algorithm.lower().replace("-", "")
+    digest = digest.strip().lower()
+    if algorithm not in hashlib.algorithms_available:
+        return None
+    if not re.fullmatch(r"[0-9a-f]+", digest):
+        return None
+    return algorithm, digest
+
+
+def file_checksum(path, algorithm, chunk_size=1024 * 1024):
+    """The hex digest of the file at `path`"""
+    sha = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hardlink `src` to `dst`, copy it if that is not possible"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class DownloadCache:
+    """Downloaded files below `path`, at most `max_size` bytes of them.
+
+    The least recently used files are evicted when the cache grows beyond
+    `max_size`. A value of 0 means no limit.
+    """
+
+    def __init__(self, path, max_size=0):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.log = logging.getLogger("repo2docker")
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, checksum=None, url=None, size=None):
+        """The key of a file, None if it can not be cached.
+
+        `checksum` is an `(algorithm, hex digest)` tuple. Without it the URL
+        and the size are used, files of unknown size are not cached.
+        """
+        if checksum is not None:
+            return "{}-{}".format(*checksum)
+        if url is None or size is None:
+            return None
+        url_key = "{} {}".format(url, size).encode("utf-8")
+        return "url-{}".format(hashlib.sha256(url_key).hexdigest())
+
+    def blob_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, size=None, checksum=None):
+        """Path of the cached file for `key`, None if it is not cached.
+
+        If `checksum`, an `(algorithm, hex digest)` tuple, is given the file
+        is hashed and removed from the cache if it does not match.
+        """
+        blob = self.blob_path(key)
+        try:
+            if size is not None and os.stat(blob).st_size != int(size):
+                return None
+            if checksum is not None and file_checksum(blob, checksum[0]) != (
+                checksum[1]
+            ):
+                self.log.warning("Removing corrupt %s from the download cache\n", blob)
+                os.remove(blob)
+                return None
+            # the modification time records when a blob was last used
+            os.utime(blob)
+        except (OSError, ValueError):
+            return None
+        return blob
+
+    def link(self, key, dst, size=None, checksum=None):
+        """Put the cached file for `key` at `dst`, False if there is none"""
+        blob = self.get(key, size, checksum)
+        if blob is None:
+            return False
+        try:
+            self.put(blob, dst, checksum)
+        except FileNotFoundError:
+            # evicted by another build in the mean time
+            return False
+        return True
+
+    def put(self, blob, dst, checksum=None):
+        """Put a cached or `spool` file at `dst`.
+
+        Files with a `checksum` are hardlinked if possible as they are
+        verified when they are used again, other files are copied.
+        """
+        if checksum is not None:
+            link_or_copy(blob, dst)
+        else:
+            shutil.copyfile(blob, dst)
+
+    @contextmanager
+    def spool(self):
+        """A file to download to, which `add` moves into the cache.
+
+        Yields its path, the file is removed afterwards unless it was added.
+        """
+        fd, spool = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        os.close(fd)
+        try:
+            yield spool
+        finally:
+            if os.path.exists(spool):
+                os.remove(spool)
+
+    def add(self, key, src):
+        """Add the complete file `src` to the cache as `key`.
+
+        `src` is copied, unless it is a `spool` file which is moved. Call
+        `evict` once all files of a record are added.
+        """
+        blob = self.blob_path(key)
+        if os.path.dirname(os.path.abspath(src)) == self.path:
+            # a spool file, it is not needed any more
+            os.chmod(src, 0o644)
+            os.replace(src, blob)
+        else:
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            os.close(fd)
+            try:
+                shutil.copyfile(src, tmp)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, blob)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        return blob
+
+    def evict(self, keep=()):
+        """Remove the least recently used files until the cache fits
+        `max_size`, except for those in `keep`"""
+        if not self.max_size:
+            return []
+        blobs = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            blobs.append((stat.st_mtime, entry.path, stat.st_size))
+            total += stat.st_size
+        blobs.sort()
+
+        removed = []
+        for _, blob, size in blobs:
+            if total <= self.max_size:
+                break
+            if blob in keep:
+                continue
+            self.log.debug("Removing %s from the download cache\n", blob)
+            try:
+                os.remove(blob)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(blob)
+        return removed
@@ -1,12 +1,28 @@
 import os
 import json
-import shutil
 
+from functools import lru_cache
 from urllib.request import Request
 from urllib.parse import urlparse, urlunparse, parse_qs
 
 from .doi import DoiProvider
-from ..utils import copytree, deep_get
+from ..utils import deep_get, flatten_directory
+
+
+@lru_cache(maxsize=None)
+def _installations():
+    """The known Dataverse installations and a dict of them by netloc.
+
+    Loaded once per process.
+    """
+    data_file = os.path.join(os.path.dirname(__file__), "dataverse.json")
+    with open(data_file, "r") as fp:
+        hosts = json.load(fp)["installations"]
+    by_netloc = {}
+    for host in hosts:
+        # the first installation with a netloc wins
+        by_netloc.setdefault(urlparse(host["url"]).netloc, host)
+    return hosts, by_netloc
 
 
 class Dataverse(DoiProvider):
@@ -14,16 +30,18 @@ class Dataverse(DoiProvider):
     Provide contents of a Dataverse dataset.
     
     This class loads a a list of existing Dataverse installations from the internal
-    file dataverse.json. This file is manually updated with the following command:
+    file dataverse.json, once per process. This file is manually updated with the
+    following command:
 
         python setup.py generate_dataverse_file
     """
 
-    def __init__(self):
-        data_file = os.path.join(os.path.dirname(__file__), "dataverse.json")
-        with open(data_file, "r") as fp:
-            self.hosts = json.load(fp)["installations"]
-        super().__init__()
+    @property
+    def hosts(self):
+        return _installations()[0]
+
+    def _is_host_url(self, url):
+        return urlparse(url).netloc in _installations()[1]
 
     def detect(self, doi, ref=None, extra_args=None):
         """Trigger this provider for things that resolve to a Dataverse dataset.
@@ -39,19 +57,13 @@ class Dataverse(DoiProvider):
         - doi:10.7910/DVN/6ZXAGT/3YRRYJ
 
         """
+        self.use_extra_args(extra_args)
         url = self.doi2url(doi)
         # Parse the url, to get the base for later API calls
         parsed_url = urlparse(url)
 
         # Check if the url matches any known Dataverse installation, bail if not.
-        host = next(
-            (
-                host
-                for host in self.hosts
-                if urlparse(host["url"]).netloc == parsed_url.netloc
-            ),
-            None,
-        )
+        host = _installations()[1].get(parsed_url.netloc)
         if host is None:
             return
 
@@ -65,7 +77,7 @@ class Dataverse(DoiProvider):
             if new_doi == doi:
                 # tough luck :( Avoid inifite recursion and exit.
                 return
-            return self.detect(new_doi)
+            return self.detect(new_doi, extra_args=extra_args)
         elif parsed_url.path.startswith("/api/access/datafile"):
             # Raw url pointing to a datafile is a typical output from an External Tool integration
             entity_id = os.path.basename(parsed_url.path)
@@ -110,25 +122,33 @@ class Dataverse(DoiProvider):
         resp = self.urlopen(req)
         record = json.loads(resp.read().decode("utf-8"))["data"]
 
+        file_refs = []
         for fobj in deep_get(record, "latestVersion.files"):
             file_url = "{}/api/access/datafile/{}".format(
                 host["url"], deep_get(fobj, "dataFile.id")
             )
             filename = os.path.join(fobj.get("directoryLabel", ""), fobj["label"])
+            data_file = fobj.get("dataFile", {})
+            file_refs.append(
+                {
+                    "download": file_url,
+                    "filename": filename,
+                    "checksum": data_file.get("checksum", data_file.get("md5")),
+                    "size": data_file.get("filesize"),
+                }
+            )
+        fetch_map = {
+            "download": "download",
+            "filename": "filename",
+            "checksum": "checksum",
+            "size": "size",
+        }
 
-            file_ref = {"download": file_url, "filename": filename}
-            fetch_map = {key: key for key in file_ref.keys()}
-
-            for line in self.fetch_file(file_ref, fetch_map, output_dir):
-                yield line
+        yield from self.fetch_files(file_refs, fetch_map, output_dir)
 
-        new_subdirs = os.listdir(output_dir)
         # if there is only one new subdirectory move its contents
         # to the top level directory
-        if len(new_subdirs) == 1 and os.path.isdir(new_subdirs[0]):
-            d = new_subdirs[0]
-            copytree(os.path.join(output_dir, d), output_dir)
-            shutil.rmtree(os.path.join(output_dir, d))
+        flatten_directory(output_dir)
 
     @property
     def content_id(self):
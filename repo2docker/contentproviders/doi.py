@@ -2,22 +2,110 @@ import os
 import json
 import shutil
 import logging
+import tarfile
+import tempfile
+import threading
+import time
 
+from contextlib import ExitStack
 from os import makedirs
 from os import path
 from urllib import request  # urlopen, Request
 from urllib.error import HTTPError
-from zipfile import ZipFile, is_zipfile
+from zipfile import is_zipfile
 
+from .archive import archive_kind, extract_tar, extract_zip
 from .base import ContentProvider
-from ..utils import copytree, deep_get
+from .cache import parse_checksum
+from .download import Downloader
+from ..utils import deep_get
 from ..utils import normalize_doi, is_doi
 from .. import __version__
 
 
+class DoiResolver:
+    """Resolve DOIs to the URL doi.org redirects to, remembering the answers.
+
+    One resolver is shared by all DOI based content providers of a run so
+    that each DOI is looked up at most once. If `cache_file` is given,
+    resolved DOIs are also stored in that JSON file and reused by later runs
+    for `ttl` seconds.
+    """
+
+    def __init__(self, cache_file=None, ttl=24 * 60 * 60):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        # DOI -> (URL, time it was resolved)
+        self._urls = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._urls = {}
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as f:
+                self._urls = {doi: tuple(entry) for doi, entry in json.load(f).items()}
+        except (OSError, ValueError, AttributeError, TypeError):
+            # a missing or broken cache is the same as an empty one
+            pass
+
+    def _save(self):
+        """Write the resolved DOIs to `cache_file`, atomically"""
+        directory = path.dirname(path.abspath(self.cache_file))
+        resolved = {doi: entry for doi, entry in self._urls.items() if entry[0] != doi}
+        # keep what other processes added since the cache was loaded
+        self._load()
+        self._urls.update(resolved)
+        urls = {doi: entry for doi, entry in self._urls.items() if entry[0] != doi}
+        try:
+            makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=".doi-cache", delete=False
+            ) as f:
+                json.dump(urls, f)
+            os.replace(f.name, self.cache_file)
+        except OSError as e:
+            logging.getLogger("repo2docker").warning(
+                "Could not write DOI cache %s: %s", self.cache_file, e
+            )
+
+    def resolve(self, doi, urlopen):
+        """The URL `doi` redirects to, or `doi` if it does not resolve.
+
+        `urlopen` is used to ask doi.org if the DOI has not been resolved
+        within the last `ttl` seconds.
+        """
+        with self._lock:
+            if self._urls is None:
+                self._load()
+            cached = self._urls.get(doi)
+        if cached is not None and time.time() - cached[1] < self.ttl:
+            return cached[0]
+
+        try:
+            url = urlopen("https://doi.org/{}".format(doi)).url
+        # If the DOI doesn't resolve, just return URL
+        except HTTPError:
+            url = doi
+        with self._lock:
+            self._urls[doi] = (url, time.time())
+            if self.cache_file and url != doi:
+                self._save()
+        return url
+
+
 class DoiProvider(ContentProvider):
     """Provide contents of a repository identified by a DOI and some helper functions."""
 
+    # shared with the other providers if passed to `detect`, see
+    # `use_extra_args`
+    doi_resolver = None
+    http_pool = None
+    download_cache = None
+    # number of files downloaded at the same time
+    download_workers = 4
+
     def urlopen(self, req, headers=None):
         """A urlopen() helper"""
         # someone passed a string, not a request
@@ -29,20 +117,43 @@ class DoiProvider(ContentProvider):
             for key, value in headers.items():
                 req.add_header(key, value)
 
+        if self.http_pool is not None:
+            return self.http_pool.urlopen(req)
         return request.urlopen(req)
 
+    def resolve_content_id(self, spec):
+        """The ID of the record, which `detect` already found"""
+        return self.content_id
+
+    def use_extra_args(self, extra_args):
+        """Use the DOI resolver, connection pool, download cache and number
+        of download workers passed to `detect`, if any"""
+        extra_args = extra_args or {}
+        for name in ["doi_resolver", "http_pool", "download_cache", "download_workers"]:
+            if extra_args.get(name) is not None:
+                setattr(self, name, extra_args[name])
+
+    def may_detect(self, repo, ref=None):
+        """DOIs and URLs of the hosts this provider knows about"""
+        return bool(is_doi(repo)) or self._is_host_url(repo)
+
+    def _is_host_url(self, url):
+        return any(
+            url.startswith(prefix)
+            for host in getattr(self, "hosts", [])
+            for prefix in host.get("hostname", [])
+        )
+
     def doi2url(self, doi):
         # Transform a DOI to a URL
         # If not a doi, assume we have a URL and return
         if is_doi(doi):
             doi = normalize_doi(doi)
-
-            try:
-                resp = self.urlopen("https://doi.org/{}".format(doi))
-            # If the DOI doesn't resolve, just return URL
-            except HTTPError:
-                return doi
-            return resp.url
+            resolver = self.doi_resolver
+            if resolver is None:
+                # nothing to share the answer with
+                resolver = DoiResolver()
+            return resolver.resolve(doi, self.urlopen)
         else:
             # Just return what is actulally just a URL
             return doi
@@ -50,41 +161,164 @@ class DoiProvider(ContentProvider):
     def fetch_file(self, file_ref, host, output_dir, unzip=False):
         # the assumption is that `unzip=True` means that this is the only
         # file related to a record
-        file_url = deep_get(file_ref, host["download"])
-        fname = deep_get(file_ref, host["filename"])
-        logging.debug("Downloading file {} as {}\n".format(file_url, fname))
-        with self.urlopen(file_url) as src:
-            if path.dirname(fname):
-                sub_dir = path.join(output_dir, path.dirname(fname))
-                if not path.exists(sub_dir):
-                    yield "Creating {}\n".format(sub_dir)
-                    makedirs(sub_dir, exist_ok=True)
+        yield from self.fetch_files([file_ref], host, output_dir, unzip=unzip)
 
+    def fetch_files(self, file_refs, host, output_dir, unzip=False):
+        """Download the files of a record to `output_dir`.
+
+        Up to `download_workers` files are downloaded at the same time. They
+        are checked against their checksum if `host` says where to find it
+        in a file reference. With a `download_cache` files are downloaded
+        into the cache and linked from there. If `unzip` is True and there
+        is only one file which is a ZIP or tar archive it is extracted, a tar
+        archive already while it is downloaded.
+        """
+        jobs = []
+        for file_ref in file_refs:
+            file_url = deep_get(file_ref, host["download"])
+            fname = deep_get(file_ref, host["filename"])
+            logging.debug("Downloading file {} as {}\n".format(file_url, fname))
+            checksum = parse_checksum(_file_metadata(file_ref, host.get("checksum")))
+            size = _file_metadata(file_ref, host.get("size"))
             dst_fname = path.join(output_dir, fname)
-            with open(dst_fname, "wb") as dst:
-                yield "Fetching {}\n".format(fname)
-                shutil.copyfileobj(src, dst)
-            # first close the newly written file, then continue
-            # processing it
-            if unzip and is_zipfile(dst_fname):
-                yield "Extracting {}\n".format(fname)
-                zfile = ZipFile(dst_fname)
-                zfile.extractall(path=output_dir)
-                zfile.close()
-
-                # delete downloaded file ...
-                os.remove(dst_fname)
-                # ... and any directories we might have created,
-                # in which case sub_dir will be defined
-                if path.dirname(fname):
-                    shutil.rmtree(sub_dir)
-
-                new_subdirs = os.listdir(output_dir)
-                # if there is only one new subdirectory move its contents
-                # to the top level directory
-                if len(new_subdirs) == 1:
-                    d = new_subdirs[0]
-                    copytree(path.join(output_dir, d), output_dir)
-                    shutil.rmtree(path.join(output_dir, d))
-
-                yield "Fetched files: {}\n".format(os.listdir(output_dir))
+            jobs.append((file_url, dst_fname, fname, checksum, size))
+
+        downloader = Downloader(self.urlopen, workers=self.download_workers)
+        if unzip and len(jobs) == 1:
+            kind = archive_kind(jobs[0][2])
+            if kind == "tar":
+                done = yield from self._fetch_tar(downloader, jobs[0], output_dir)
+                if done:
+                    return
+            elif kind == "zip":
+                done = yield from self._fetch_zip(downloader, jobs[0], output_dir)
+                if done:
+                    return
+
+        for _, dst_fname, _, _, _ in jobs:
+            sub_dir = path.dirname(dst_fname)
+            if not path.exists(sub_dir):
+                yield "Creating {}\n".format(sub_dir)
+                makedirs(sub_dir, exist_ok=True)
+        missing = []
+        used = []
+        for job in jobs:
+            file_url, dst_fname, fname, checksum, size = job
+            key = self._cache_key(job)
+            if key is not None and self.download_cache.link(
+                key, dst_fname, size, checksum
+            ):
+                yield "Using cached {}\n".format(fname)
+                used.append(self.download_cache.blob_path(key))
+            else:
+                missing.append(job)
+
+        with ExitStack() as stack:
+            # files that can be cached are downloaded into the cache
+            spools = []
+            downloads = []
+            for job in missing:
+                file_url, dst_fname, fname, checksum, _ = job
+                spool = None
+                if self._cache_key(job) is not None:
+                    spool = stack.enter_context(self.download_cache.spool())
+                spools.append(spool)
+                downloads.append((file_url, spool or dst_fname, fname, checksum))
+            yield from downloader.download_all(downloads)
+            for job, spool in zip(missing, spools):
+                if spool is not None:
+                    _, dst_fname, _, checksum, _ = job
+                    self.download_cache.put(spool, dst_fname, checksum)
+                    used.append(self.download_cache.add(self._cache_key(job), spool))
+        if used:
+            self.download_cache.evict(keep=used)
+
+    def _cache_key(self, job):
+        if self.download_cache is None:
+            return None
+        file_url, _, _, checksum, size = job
+        return self.download_cache.key(checksum, file_url, size)
+
+    def _fetch_tar(self, downloader, job, output_dir):
+        """Extract a tar archive while it is downloaded, returns False if it
+        is not a tar archive"""
+        file_url, _, fname, checksum, size = job
+        key = self._cache_key(job)
+        blob = None if key is None else self.download_cache.get(key, size, checksum)
+        try:
+            if blob is not None:
+                yield "Extracting cached {}\n".format(fname)
+                with open(blob, "rb") as src:
+                    extract_tar(src, output_dir)
+            else:
+                yield "Extracting {} while downloading\n".format(fname)
+                with ExitStack() as stack:
+                    copy = None
+                    if key is not None:
+                        # keep a copy of the archive for the cache
+                        spool = stack.enter_context(self.download_cache.spool())
+                        copy = stack.enter_context(open(spool, "wb"))
+                    src = stack.enter_context(
+                        downloader.open_stream(file_url, checksum, copy_to=copy)
+                    )
+                    extract_tar(src, output_dir)
+                    src.verify()
+                    if copy is not None:
+                        copy.close()
+                        blob = self.download_cache.add(key, spool)
+                        self.download_cache.evict(keep=[blob])
+        except tarfile.ReadError:
+            # not an archive after all, the file is downloaded as it is
+            return False
+        yield "Fetched files: {}\n".format(os.listdir(output_dir))
+        return True
+
+    def _fetch_zip(self, downloader, job, output_dir):
+        """Download and extract a ZIP archive, a file that is not a ZIP
+        archive is put in place as it is"""
+        file_url, dst_fname, fname, checksum, size = job
+        key = self._cache_key(job)
+        # the index of a ZIP file is at its end, so it is downloaded to a
+        # file first, in the cache if there is one
+        with ExitStack() as stack:
+            blob = None
+            if key is not None:
+                blob = self.download_cache.get(key, size, checksum)
+            if blob is not None:
+                yield "Using cached {}\n".format(fname)
+                archive = blob
+            else:
+                if key is not None:
+                    archive = stack.enter_context(self.download_cache.spool())
+                else:
+                    spool_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                    archive = path.join(spool_dir, path.basename(fname))
+                yield from downloader.download_all(
+                    [(file_url, archive, fname, checksum)]
+                )
+            is_zip = is_zipfile(archive)
+            if not is_zip:
+                makedirs(path.dirname(dst_fname), exist_ok=True)
+                if key is not None:
+                    self.download_cache.put(archive, dst_fname, checksum)
+                else:
+                    shutil.move(archive, dst_fname)
+            if key is not None and blob is None:
+                archive = self.download_cache.add(key, archive)
+                self.download_cache.evict(keep=[archive])
+            if not is_zip:
+                return True
+            yield "Extracting {}\n".format(fname)
+            extract_zip(archive, output_dir)
+        yield "Fetched files: {}\n".format(os.listdir(output_dir))
+        return True
+
+
+def _file_metadata(file_ref, key):
+    """The value at `key` of a file reference, None if it has none"""
+    if key is None:
+        return None
+    try:
+        return deep_get(file_ref, key)
+    except (KeyError, IndexError, TypeError):
+        return None
@@ -0,0 +1,553 @@
+"""
+Download the files of DOI based records
+
+`HTTPConnectionPool` keeps HTTP connections open between requests to the
+same host, asks for JSON metadata to be compressed and records how many
+requests were made to each host and how long they took. `Downloader`
+fetches many files at the same time with a bounded number of workers.
+Interrupted transfers are resumed with Range requests and hosts that answer
+429 or 503 are given increasingly more time between requests. Files are
+checked against the checksum the archive publishes for them while they are
+downloaded.
+"""
+import hashlib
+import http.client
+import io
+import queue
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from os import path
+from urllib import request
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+from .base import ContentProviderException
+from ..progress import format_bytes
+
+# statuses after which a request is retried later
+THROTTLE_STATUSES = {429, 503}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+# errors after which a download is resumed
+TRANSFER_ERRORS = (OSError, http.client.HTTPException)
+
+
+def _status(response):
+    """The HTTP status of a response, also for those that are not HTTP"""
+    status = getattr(response, "status", None)
+    if status is None:
+        status = response.getcode()
+    return status
+
+
+def _hasher(checksum):
+    """A hashlib object for the `(algorithm, hex digest)` tuple `checksum`"""
+    if checksum is None:
+        return None
+    return hashlib.new(checksum[0])
+
+
+def _verify(hasher, checksum, url):
+    if hasher is not None and hasher.hexdigest() != checksum[1]:
+        raise ContentProviderException(
+            "Checksum of {} is {}:{} instead of {}:{}".format(
+                url, checksum[0], hasher.hexdigest(), *checksum
+            )
+        )
+
+
+def _retry_after(error):
+    """Seconds to wait according to the Retry-After header of `error`"""
+    try:
+        return float(error.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class _PooledResponse:
+    """A response that gives its connection back to the pool when done.
+
+    A gzip compressed body is decompressed while it is read.
+    """
+
+    def __init__(self, response, url, release):
+        self._response = response
+        self._release = release
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._decoder = None
+        self._decoded = b""
+        if (self.headers.get("Content-Encoding") or "").lower() == "gzip":
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # they describe the compressed body
+            del self.headers["Content-Encoding"]
+            del self.headers["Content-Length"]
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            data = self._response.read(amt)
+        else:
+            data = self._read_decoded(amt)
+        if self._response.isclosed():
+            # the whole body was read
+            self.close()
+        return data
+
+    def _read_decoded(self, amt):
+        while amt is None or len(self._decoded) < amt:
+            chunk = self._response.read(64 * 1024)
+            if not chunk:
+                self._decoded += self._decoder.flush()
+                break
+            self._decoded += self._decoder.decompress(chunk)
+        if amt is None:
+            data, self._decoded = self._decoded, b""
+        else:
+            data, self._decoded = self._decoded[:amt], self._decoded[amt:]
+        return data
+
+    def close(self):
+        if self._release is None:
+            return
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        self._release(reusable)
+        self._release = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HTTPConnectionPool:
+    """Open HTTP(S) URLs over connections that are kept alive per host.
+
+    `urlopen` follows redirects and raises `HTTPError` for error statuses,
+    like `urllib.request.urlopen`. Requests that have to go through a proxy
+    are handed to `urllib.request.urlopen`. `timeout` is the number of
+    seconds to wait for a connection or for data from the server.
+    """
+
+    def __init__(self, timeout=60, max_idle=8):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        # (scheme, host, port) -> idle connections
+        self._idle = {}
+        # host -> [requests, new connections, seconds until the responses]
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            with self._lock:
+                if self._ssl_context is None:
+                    self._ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=self._ssl_context
+            )
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _record(self, host, latency, new_connection):
+        with self._lock:
+            metrics = self._metrics.setdefault(host, [0, 0, 0.0])
+            metrics[0] += 1
+            metrics[1] += int(new_connection)
+            metrics[2] += latency
+
+    def metrics(self):
+        """Number of requests, number of new connections and the mean time
+        in seconds until the response arrived, per host"""
+        with self._lock:
+            return {
+                host: {
+                    "requests": requests,
+                    "connections": connections,
+                    "latency": latency / requests,
+                }
+                for host, (requests, connections, latency) in self._metrics.items()
+            }
+
+    def _checkout(self, key):
+        """An idle connection to `key` if there is one, else a new one"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _checkin(self, key, conn, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def _request(self, url, headers):
+        """Send one GET request, retrying once if a kept alive connection died"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        while True:
+            conn, reused = self._checkout(key)
+            start = time.monotonic()
+            try:
+                conn.request("GET", target, headers=headers)
+                response = conn.getresponse()
+            except TRANSFER_ERRORS:
+                conn.close()
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    continue
+                raise
+            self._record(parts.hostname, time.monotonic() - start, not reused)
+            return _PooledResponse(
+                response, url, lambda reusable: self._checkin(key, conn, reusable)
+            )
+
+    def urlopen(self, req, headers=None, max_redirects=10):
+        """Open `req`, a `urllib.request.Request` or a URL"""
+        if not isinstance(req, request.Request):
+            req = request.Request(req)
+        for key, value in (headers or {}).items():
+            req.add_header(key, value)
+        url = req.full_url
+        scheme = urlsplit(url).scheme
+        if scheme not in ("http", "https") or (
+            scheme in request.getproxies()
+            and not request.proxy_bypass(urlsplit(url).hostname)
+        ):
+            start = time.monotonic()
+            response = request.urlopen(req, timeout=self.timeout)
+            if scheme in ("http", "https"):
+                self._record(urlsplit(url).hostname, time.monotonic() - start, True)
+            return response
+
+        # `Request` capitalizes the names of headers
+        headers = dict(req.header_items())
+        if "json" in headers.get("Accept", "") and "Range" not in headers:
+            # metadata compresses well, files are transferred as they are
+            # so that their size is known and downloads can be resumed
+            headers.setdefault("Accept-encoding", "gzip")
+        for _ in range(max_redirects + 1):
+            try:
+                response = self._request(url, headers)
+            except socket.timeout as e:
+                raise URLError(e)
+            if response.status in REDIRECT_STATUSES and response.getheader("Location"):
+                location = urljoin(url, response.getheader("Location"))
+                # drain the body so that the connection can be reused
+                response.read()
+                response.close()
+                url = location
+                continue
+            if response.status >= 400:
+                body = io.BytesIO(response.read())
+                response.close()
+                raise HTTPError(
+                    url, response.status, response.reason, response.headers, body
+                )
+            return response
+        raise URLError("Too many redirects for {}".format(req.full_url))
+
+
+class Downloader:
+    """Download many files at the same time.
+
+    `urlopen(url, headers=None)` opens a URL and raises `HTTPError` for
+    error statuses. At most `workers` files are downloaded at the same time.
+    A download is attempted `retries + 1` times, each retry resumes where
+    the previous attempt stopped.
+    """
+
+    def __init__(
+        self,
+        urlopen,
+        workers=4,
+        retries=5,
+        backoff=1,
+        max_backoff=60,
+        chunk_size=1024 * 1024,
+        sleep=time.sleep,
+    ):
+        self.urlopen = urlopen
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.chunk_size = chunk_size
+        self.sleep = sleep
+        # host -> seconds to wait before the next request
+        self._delays = {}
+        self._lock = threading.Lock()
+        self.bytes_done = 0
+
+    def _wait_for_host(self, host):
+        with self._lock:
+            delay = self._delays.get(host, 0)
+        if delay:
+            self.sleep(delay)
+
+    def _throttle(self, host, retry_after=None):
+        """Wait longer before the next request to `host`"""
+        with self._lock:
+            delay = max(self._delays.get(host, 0) * 2, self.backoff)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self._delays[host] = min(delay, self.max_backoff)
+
+    def _relax(self, host):
+        """Reduce the delay for `host` after a successful request"""
+        with self._lock:
+            delay = self._delays.get(host, 0) / 2
+            if delay < 0.1:
+                self._delays.pop(host, None)
+            else:
+                self._delays[host] = delay
+
+    def _open(self, url, offset):
+        if offset:
+            return self.urlopen(url, headers={"Range": "bytes={}-".format(offset)})
+        # no extra arguments, so that simple openers work as well
+        return self.urlopen(url)
+
+    def download(self, url, dst, checksum=None):
+        """Download `url` to the file `dst`.
+
+        `checksum` is an `(algorithm, hex digest)` tuple the file is checked
+        against, a `ContentProviderException` is raised if it does not match.
+        """
+        host = urlsplit(url).hostname
+        offset = 0
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            self._wait_for_host(host)
+            try:
+                with self._open(url, offset) as src:
+                    if offset and _status(src) != 206:
+                        # the server ignored the Range header, start over
+                        offset = 0
+                    expected = src.headers.get("Content-Length")
+                    if expected is not None:
+                        expected = offset + int(expected)
+                    hasher = _hasher(checksum)
+                    if hasher is not None and offset:
+                        # hash the part downloaded by the previous attempts
+                        with open(dst, "rb") as f:
+                            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                                hasher.update(chunk)
+                    with open(dst, "ab" if offset else "wb") as f:
+                        while True:
+                            chunk = src.read(self.chunk_size)
+                            if not chunk:
+                                break
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            f.write(chunk)
+                            offset += len(chunk)
+                            with self._lock:
+                                self.bytes_done += len(chunk)
+                if expected is not None and offset != expected:
+                    raise http.client.IncompleteRead(
+                        b"", expected - offset if offset < expected else None
+                    )
+                _verify(hasher, checksum, url)
+            except HTTPError as e:
+                if e.code not in THROTTLE_STATUSES or last_attempt:
+                    raise
+                self._throttle(host, _retry_after(e))
+            except TRANSFER_ERRORS:
+                if last_attempt:
+                    raise
+                # resume after the bytes that made it to disk
+                offset = path.getsize(dst) if path.exists(dst) else 0
+                self.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+            else:
+                self._relax(host)
+                return
+
+    def open_stream(self, url, checksum=None, copy_to=None):
+        """A file object to read `url` from, interrupted transfers are resumed.
+
+        If `checksum` is given, call `verify` of the file object once done.
+        Everything that is read is also written to the file object `copy_to`.
+        """
+        return _ResumingStream(self, url, checksum, copy_to)
+
+    def download_all(self, jobs, progress_interval=2):
+        """Download all `(url, dst, name)` or `(url, dst, name, checksum)`
+        jobs, yields log lines"""
+        messages = queue.Queue()
+
+        def download(job):
+            url, dst, name = job[:3]
+            messages.put("Fetching {}\n".format(name))
+            self.download(url, dst, *job[3:])
+
+        start = time.monotonic()
+        last_progress = start
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            futures = [executor.submit(download, job) for job in jobs]
+            pending = futures
+            while pending:
+                done, pending = wait(
+                    pending, timeout=progress_interval, return_when=FIRST_EXCEPTION
+                )
+                while not messages.empty():
+                    yield messages.get()
+                for future in done:
+                    if future.exception() is not None:
+                        for other in pending:
+                            other.cancel()
+                        raise future.exception()
+                now = time.monotonic()
+                if pending and now - last_progress >= progress_interval:
+                    last_progress = now
+                    yield self._describe(len(futures) - len(pending), len(jobs), start)
+        while not messages.empty():
+            yield messages.get()
+        if len(jobs) > 1:
+            yield self._describe(len(jobs), len(jobs), start)
+
+    def _describe(self, done, total, start):
+        elapsed = max(time.monotonic() - start, 1e-6)
+        return "Downloaded {} of {} files, {} ({}/s)\n".format(
+            done,
+            total,
+            format_bytes(self.bytes_done),
+            format_bytes(self.bytes_done / elapsed),
+        )
+
+
+class _ResumingStream(io.RawIOBase):
+    """Read a URL sequentially, reconnecting after transfer errors.
+
+    After an error the transfer continues with a Range request at the
+    current position. Servers that ignore the Range header send the whole
+    file again, the part that was already read is skipped.
+    """
+
+    def __init__(self, downloader, url, checksum=None, copy_to=None):
+        super().__init__()
+        self._downloader = downloader
+        self._copy_to = copy_to
+        self._checksum = checksum
+        self._hasher = _hasher(checksum)
+        self._host = urlsplit(url).hostname
+        self._src = None
+        self._expected = None
+        self._attempt = 0
+        self.url = url
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def _open(self):
+        downloader = self._downloader
+        while True:
+            downloader._wait_for_host(self._host)
+            try:
+                src = downloader._open(self.url, self.offset)
+            except HTTPError as e:
+                if e.code not in THROTTLE_STATUSES or self._attempt >= (
+                    downloader.retries
+                ):
+                    raise
+                self._attempt += 1
+                downloader._throttle(self._host, _retry_after(e))
+                continue
+            downloader._relax(self._host)
+            break
+        skip = 0
+        if self.offset and _status(src) != 206:
+            skip = self.offset
+        expected = src.headers.get("Content-Length")
+        if expected is not None:
+            self._expected = self.offset - skip + int(expected)
+        self._src = src
+        while skip:
+            chunk = src.read(min(skip, downloader.chunk_size))
+            if not chunk:
+                raise http.client.IncompleteRead(b"", skip)
+            skip -= len(chunk)
+
+    def readinto(self, buffer):
+        downloader = self._downloader
+        while True:
+            try:
+                if self._src is None:
+                    self._open()
+                data = self._src.read(len(buffer))
+                if not data and (
+                    self._expected is not None and self.offset < self._expected
+                ):
+                    raise http.client.IncompleteRead(b"", self._expected - self.offset)
+                break
+            except HTTPError:
+                raise
+            except TRANSFER_ERRORS:
+                if self._attempt >= downloader.retries:
+                    raise
+                self._close_source()
+                downloader.sleep(
+                    min(downloader.backoff * 2 ** self._attempt, downloader.max_backoff)
+                )
+                self._attempt += 1
+        buffer[: len(data)] = data
+        if self._hasher is not None:
+            self._hasher.update(data)
+        if self._copy_to is not None:
+            self._copy_to.write(data)
+        self.offset += len(data)
+        with downloader._lock:
+            downloader.bytes_done += len(data)
+        return len(data)
+
+    def verify(self):
+        """Read the rest of the file and check its checksum"""
+        while self.read(self._downloader.chunk_size):
+            pass
+        _verify(self._hasher, self._checksum, self.url)
+
+    def _close_source(self):
+        if self._src is not None:
+            try:
+                self._src.close()
+            except TRANSFER_ERRORS:
+                pass
+            self._src = None
+
+    def close(self):
+        self._close_source()
+        super().close()
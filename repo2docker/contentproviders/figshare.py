@@ -36,6 +36,8 @@ class Figshare(DoiProvider):
                 "filepath": "files",
                 "filename": "name",
                 "download": "download_url",
+                "checksum": "computed_md5",
+                "size": "size",
             }
         ]
 
@@ -47,6 +49,7 @@ class Figshare(DoiProvider):
         # filepath (path to files in metadata), filename (path to filename in
         # metadata), download (path to file download URL), and type (path to item type in metadata)
 
+        self.use_extra_args(extra_args)
         url = self.doi2url(doi)
 
         for host in self.hosts:
@@ -85,11 +88,8 @@ class Figshare(DoiProvider):
         files = deep_get(article, host["filepath"])
         # only fetch files where is_link_only: False
         files = [file for file in files if not file["is_link_only"]]
-        only_one_file = len(files) == 1
-        for file_ref in files:
-            unzip = file_ref["name"].endswith(".zip") and only_one_file
-            for line in self.fetch_file(file_ref, host, output_dir, unzip):
-                yield line
+        unzip = len(files) == 1 and files[0]["name"].endswith(".zip")
+        yield from self.fetch_files(files, host, output_dir, unzip=unzip)
 
     @property
     def content_id(self):
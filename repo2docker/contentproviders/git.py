@@ -1,24 +1,345 @@
+import os
+import re
+import shutil
 import subprocess
 import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 from .base import ContentProvider, ContentProviderException
-from ..utils import execute_cmd, check_ref
+from ..utils import execute_cmd, check_ref, resolve_refs
+
+
+def _git_lines(cmd, cwd):
+    """The lines of the output of a git command that is allowed to fail"""
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE)
+    return proc.stdout.decode("utf-8", "replace").splitlines()
+
+
+def _list_submodules(path):
+    """Name, path and URL of the initialised submodules of the repository"""
+    gitlinks = set()
+    for line in _git_lines(["git", "ls-files", "--stage"], path):
+        mode, _, rest = line.partition(" ")
+        if mode == "160000":
+            gitlinks.add(rest.split("\t", 1)[1])
+
+    submodules = []
+    paths = _git_lines(
+        [
+            "git",
+            "config",
+            "-f",
+            ".gitmodules",
+            "--get-regexp",
+            r"^submodule\..*\.path$",
+        ],
+        path,
+    )
+    for line in paths:
+        key, _, sub_path = line.partition(" ")
+        name = key[len("submodule.") : -len(".path")]
+        if sub_path not in gitlinks:
+            continue
+        url = _git_lines(["git", "config", "submodule.{}.url".format(name)], path)
+        if url:
+            submodules.append((name, sub_path, url[0]))
+    return submodules
+
+
+# (url, ref) -> (commit, time it was resolved), shared by all Git instances
+# so that repeated builds of a repository do not ask the remote every time
+_remote_refs = {}
+_remote_refs_lock = threading.Lock()
+
+
+def _ls_remote(url, ref, ttl):
+    """Resolve `ref` to a commit hash on the remote `url` without cloning.
+
+    Works for HEAD, branches and tags. Results are cached for `ttl` seconds.
+    Returns None if `ref` does not name a branch or tag, or if the remote
+    can not be reached.
+    """
+    now = time.monotonic()
+    with _remote_refs_lock:
+        cached = _remote_refs.get((url, ref))
+    if cached is not None and now - cached[1] < ttl:
+        return cached[0]
+
+    name = ref[len("origin/") :] if ref.startswith("origin/") else ref
+    try:
+        proc = subprocess.run(
+            # annotated tags are only peeled if the pattern matches the
+            # peeled name
+            ["git", "ls-remote", url, name, name + "^{}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            # never wait for someone to type a password
+            env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+            timeout=60,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    refs = {}
+    for line in proc.stdout.decode("utf-8", "replace").splitlines():
+        sha, _, refname = line.partition("\t")
+        refs[refname] = sha
+
+    if name == "HEAD":
+        candidates = ["HEAD"]
+    else:
+        # same precedence as git
+        candidates = [
+            name,
+            "refs/{}".format(name),
+            "refs/tags/{}".format(name),
+            "refs/heads/{}".format(name),
+        ]
+    for candidate in candidates:
+        if candidate in refs:
+            # annotated tags are listed twice, peeled to the commit with ^{}
+            sha1 = refs.get(candidate + "^{}", refs[candidate])
+            with _remote_refs_lock:
+                _remote_refs[(url, ref)] = (sha1, now)
+            return sha1
+    return None
 
 
 class Git(ContentProvider):
     """Provide contents of a remote git repository."""
 
+    # depths of the fetches tried when the ref can not be fetched by name,
+    # before giving up and cloning the full history
+    fetch_depths = (50, 500)
+
+    def __init__(self):
+        super().__init__()
+        # how the contents were fetched: "mirror", "shallow", "depth <n>",
+        # "clone" or "shallow clone" (HEAD of the default branch)
+        self.fetch_strategy = None
+
     def detect(self, source, ref=None, extra_args=None):
         # Git is our content provider of last resort. This is to maintain the
         # old behaviour when git and local directories were the only supported
         # content providers. This means that this content provider will always
         # match. The downside is that the call to `fetch()` later on might fail
-        return {"repo": source, "ref": ref}
+        extra_args = extra_args or {}
+        return {
+            "repo": source,
+            "ref": ref,
+            "shallow": extra_args.get("shallow", False),
+            "mirror_cache": extra_args.get("mirror_cache"),
+            "submodule_jobs": extra_args.get("submodule_jobs", 4),
+            "submodule_depth": extra_args.get("submodule_depth", 0),
+            "ref_cache_ttl": extra_args.get("ref_cache_ttl", 60),
+        }
+
+    def resolve_content_id(self, spec):
+        """Resolve the ref to a commit with `git ls-remote`"""
+        ref = spec.get("ref") or "HEAD"
+        if re.fullmatch("[0-9a-f]{40}", ref):
+            sha1 = ref
+        else:
+            sha1 = _ls_remote(spec["repo"], ref, spec.get("ref_cache_ttl", 60))
+        if sha1 is None:
+            return None
+        self._sha1 = sha1
+        return self.content_id
 
     def fetch(self, spec, output_dir, yield_output=False):
         repo = spec["repo"]
         ref = spec.get("ref", None)
 
+        hash = None
+        if spec.get("mirror_cache") is not None:
+            hash = yield from self._clone_from_mirror(
+                spec["mirror_cache"], repo, ref, output_dir, yield_output
+            )
+        elif ref is not None and spec.get("shallow", False):
+            hash = yield from self._fetch_shallow(repo, ref, output_dir, yield_output)
+
+        if hash is not None:
+            for line in execute_cmd(
+                ["git", "reset", "--hard", hash], cwd=output_dir, capture=yield_output
+            ):
+                yield line
+            self._sha1 = hash
+        else:
+            yield from self._clone(repo, ref, output_dir, yield_output)
+        yield "Fetched {} using strategy: {}\n".format(repo, self.fetch_strategy)
+
+        # ensure that git submodules are initialised and updated
+        yield from self._update_submodules(
+            output_dir,
+            jobs=spec.get("submodule_jobs", 4),
+            depth=spec.get("submodule_depth", 0),
+            mirror_cache=spec.get("mirror_cache"),
+            yield_output=yield_output,
+        )
+
+    def _update_submodules(self, path, jobs, depth, mirror_cache, yield_output):
+        """Update the submodules of the repository at `path`, recursively.
+
+        Up to `jobs` submodules are updated at the same time. They are cloned
+        from `mirror_cache` if given, otherwise at depth `depth` (0 for the
+        full history) with a full fetch as fallback.
+        """
+        if not os.path.exists(os.path.join(path, ".gitmodules")):
+            return
+        for line in execute_cmd(
+            ["git", "submodule", "init"], cwd=path, capture=yield_output
+        ):
+            yield line
+        submodules = _list_submodules(path)
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            outputs = executor.map(
+                lambda submodule: self._update_submodule(
+                    path, *submodule, depth=depth, mirror_cache=mirror_cache
+                ),
+                submodules,
+            )
+            for output in outputs:
+                for line in output:
+                    if yield_output:
+                        yield line
+                    else:
+                        sys.stdout.write(line)
+
+        for name, sub_path, url in submodules:
+            yield from self._update_submodules(
+                os.path.join(path, sub_path), jobs, depth, mirror_cache, yield_output
+            )
+
+    def _update_submodule(self, path, name, sub_path, url, depth, mirror_cache):
+        """Update one submodule, returns the output lines of git"""
+        output = []
+        start = time.perf_counter()
+        cmd = ["git", "submodule", "update"]
+        with ExitStack() as stack:
+            if mirror_cache is not None:
+                mirror = stack.enter_context(mirror_cache.updated(url, output))
+                strategy = "mirror"
+                cmd.extend(["--reference", mirror, "--dissociate"])
+            elif depth:
+                strategy = "depth {}".format(depth)
+            else:
+                strategy = "clone"
+
+            shallow = strategy.startswith("depth")
+            try:
+                depth_args = ["--depth", str(depth)] if shallow else []
+                output.extend(
+                    execute_cmd(
+                        cmd + depth_args + ["--", sub_path], cwd=path, capture=True
+                    )
+                )
+            except subprocess.CalledProcessError:
+                if not shallow:
+                    raise
+                # the pinned commit is not within reach of a shallow fetch,
+                # get the full history of the submodule
+                strategy = "clone"
+                sub_dir = os.path.join(path, sub_path)
+                is_shallow = _git_lines(
+                    ["git", "rev-parse", "--is-shallow-repository"], sub_dir
+                )
+                if is_shallow == ["true"]:
+                    output.extend(
+                        execute_cmd(
+                            ["git", "fetch", "--unshallow"], cwd=sub_dir, capture=True
+                        )
+                    )
+                output.extend(
+                    execute_cmd(cmd + ["--", sub_path], cwd=path, capture=True)
+                )
+
+        output.append(
+            "Updated submodule {} ({}) in {:.1f}s\n".format(
+                name, strategy, time.perf_counter() - start
+            )
+        )
+        return output
+
+    def _fetch_shallow(self, repo, ref, output_dir, yield_output):
+        """Fetch only as much history as is needed to check out `ref`.
+
+        First try to fetch `ref` by name at depth 1, which works for branches,
+        tags and (if the server allows it) full commit hashes. Then fetch all
+        branches with increasingly more history until `ref` can be resolved.
+
+        Returns the hash of the commit or None if `ref` could not be found,
+        in which case `output_dir` is left without a `.git` directory.
+        """
+        for cmd in (
+            ["git", "init", "--quiet"],
+            ["git", "remote", "add", "origin", repo],
+        ):
+            for line in execute_cmd(cmd, cwd=output_dir, capture=yield_output):
+                yield line
+
+        names = [ref]
+        if ref.startswith("origin/"):
+            names.append(ref[len("origin/") :])
+        for name in names:
+            try:
+                for line in execute_cmd(
+                    ["git", "fetch", "--depth", "1", "origin", name],
+                    cwd=output_dir,
+                    capture=yield_output,
+                ):
+                    yield line
+            except subprocess.CalledProcessError:
+                continue
+            (hash,) = resolve_refs(["FETCH_HEAD"], cwd=output_dir)
+            if hash is not None:
+                self.fetch_strategy = "shallow"
+                return hash
+
+        for depth in self.fetch_depths:
+            yield "Ref {} not found, fetching {} commits of history\n".format(
+                ref, depth
+            )
+            try:
+                for line in execute_cmd(
+                    ["git", "fetch", "--depth", str(depth), "origin"],
+                    cwd=output_dir,
+                    capture=yield_output,
+                ):
+                    yield line
+            except subprocess.CalledProcessError:
+                break
+            hash = check_ref(ref, output_dir)
+            if hash is not None:
+                self.fetch_strategy = "depth {}".format(depth)
+                return hash
+
+        yield "Ref {} not found, cloning the full history\n".format(ref)
+        shutil.rmtree(os.path.join(output_dir, ".git"))
+        return None
+
+    def _clone_from_mirror(self, cache, repo, ref, output_dir, yield_output):
+        """Clone from the mirror of `repo` in `cache`, returns the commit"""
+        try:
+            yield from cache.clone(repo, output_dir, yield_output)
+        except subprocess.CalledProcessError as e:
+            msg = "Failed to mirror repository from {repo}.".format(repo=repo)
+            raise ContentProviderException(msg) from e
+        hash = check_ref(ref or "HEAD", output_dir)
+        if hash is None:
+            self.log.error(
+                "Failed to check out ref %s", ref, extra=dict(phase="failed")
+            )
+            raise ValueError("Failed to check out ref {}".format(ref))
+        self.fetch_strategy = "mirror"
+        return hash
+
+    def _clone(self, repo, ref, output_dir, yield_output):
+        """Clone the repository and check out `ref`"""
         # make a, possibly shallow, clone of the remote repository
         try:
             cmd = ["git", "clone"]
@@ -55,18 +376,10 @@ class Git(ContentProvider):
                 ["git", "reset", "--hard", hash], cwd=output_dir, capture=yield_output
             ):
                 yield line
-
-        # ensure that git submodules are initialised and updated
-        for line in execute_cmd(
-            ["git", "submodule", "update", "--init", "--recursive"],
-            cwd=output_dir,
-            capture=yield_output,
-        ):
-            yield line
-
-        cmd = ["git", "rev-parse", "HEAD"]
-        sha1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=output_dir)
-        self._sha1 = sha1.stdout.read().decode().strip()
+            self._sha1 = hash
+        else:
+            (self._sha1,) = resolve_refs(["HEAD"], cwd=output_dir)
+        self.fetch_strategy = "clone" if ref is not None else "shallow clone"
 
     @property
     def content_id(self):
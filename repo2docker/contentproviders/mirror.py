@@ -0,0 +1,242 @@
+"""
+A cache of bare mirrors of git repositories
+
+Each remote repository is mirrored once in the cache directory. Builds
+update the mirror with an incremental fetch and clone their checkout from
+it, so only new commits are transferred over the network. Mirrors that
+have not been used for a while, or that push the cache over its size
+limit, are removed again.
+
+Every mirror has a lock file next to it which is held while the mirror is
+updated and cloned, or removed, so several builds on one host can use the
+cache at the same time. Locking needs `fcntl`, on Windows mirrors are not
+locked.
+
+Credentials in the URL of a remote are never stored in a mirror, they are
+passed to git for each fetch. Remotes with different credentials get
+separate mirrors.
+"""
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+from ..utils import execute_cmd
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+
+def normalize_url(url):
+    """The canonical form of a git remote, used to find its mirror.
+
+    Different spellings of the same repository (trailing slash or `.git`,
+    case of the host name, user name and password) share one mirror.
+    """
+    if os.path.exists(url):
+        return os.path.abspath(url)
+    parts = urlsplit(url)
+    if parts.scheme and parts.netloc:
+        netloc = parts.hostname or ""
+        if parts.port:
+            netloc += ":{}".format(parts.port)
+        url = urlunsplit((parts.scheme.lower(), netloc.lower(), parts.path, "", ""))
+    url = url.rstrip("/")
+    if url.endswith(".git"):
+        url = url[: -len(".git")]
+    return url
+
+
+def _userinfo(url):
+    """The user name and password in `url`, if any"""
+    parts = urlsplit(url)
+    if parts.scheme and "@" in parts.netloc:
+        return parts.netloc.rpartition("@")[0]
+    return ""
+
+
+def strip_credentials(url):
+    """`url` without the user name and password"""
+    parts = urlsplit(url)
+    if not _userinfo(url):
+        return url
+    return urlunsplit(parts._replace(netloc=parts.netloc.rpartition("@")[2]))
+
+
+def _disk_usage(path):
+    """Number of bytes used by the files below `path`"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class MirrorCache:
+    """Bare mirrors of git repositories below `path`.
+
+    `max_size` is the total size in bytes and `max_age` the number of seconds
+    since a mirror was last used after which mirrors are evicted, least
+    recently used first. A value of 0 means no limit. The cache is checked
+    for mirrors to evict at most once every `evict_interval` seconds.
+    """
+
+    def __init__(self, path, max_size=0, max_age=0, evict_interval=300):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.log = logging.getLogger("repo2docker")
+        os.makedirs(self.path, exist_ok=True)
+
+    def mirror_path(self, url):
+        """Directory of the mirror of `url`"""
+        key = normalize_url(url)
+        name = re.sub(r"[^\w.-]", "-", key.rsplit("/", 1)[-1])[:40]
+        userinfo = _userinfo(url)
+        if userinfo:
+            # mirrors are not shared between different credentials
+            key += "\n" + userinfo
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.path, "{}-{}.git".format(name, digest))
+
+    @contextmanager
+    def lock(self, mirror, blocking=True):
+        """Lock `mirror`, yields False if `blocking` is False and it is busy"""
+        # lock files are never removed, otherwise a process waiting for the
+        # lock on a deleted file could hold it at the same time as one that
+        # created a new lock file
+        if fcntl is None:
+            yield True
+            return
+        with open(mirror + ".lock", "a") as f:
+            operation = fcntl.LOCK_EX
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, operation)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _update(self, url, mirror, yield_output):
+        """Create or update `mirror`, the caller holds its lock"""
+        if os.path.isdir(mirror):
+            # fetch from `url` rather than origin, which has no credentials
+            cmd = ["git", "fetch", "--prune", "--quiet", url, "+refs/*:refs/*"]
+            for line in execute_cmd(cmd, cwd=mirror, capture=yield_output):
+                yield line
+            return
+        # clone next to the final location so that an interrupted clone
+        # never looks like a mirror
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+        try:
+            cmd = ["git", "clone", "--mirror", "--quiet", url, tmp]
+            for line in execute_cmd(cmd, capture=yield_output):
+                yield line
+            if _userinfo(url):
+                cmd = ["git", "remote", "set-url", "origin", strip_credentials(url)]
+                for line in execute_cmd(cmd, cwd=tmp, capture=yield_output):
+                    yield line
+            os.rename(tmp, mirror)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    @contextmanager
+    def updated(self, url, output=None):
+        """Update the mirror of `url` and keep it locked, yields its path.
+
+        The output of git is appended to the list `output` if given.
+        """
+        mirror = self.mirror_path(url)
+        with self.lock(mirror):
+            for line in self._update(url, mirror, yield_output=True):
+                if output is not None:
+                    output.append(line)
+            os.utime(mirror)
+            yield mirror
+
+    def clone(self, url, output_dir, yield_output=False):
+        """Update the mirror of `url` and clone it to `output_dir`.
+
+        The clone is a local clone of the mirror without a checkout, its
+        `origin` points at `url` again so that relative submodule URLs work.
+        Yields the output of git.
+        """
+        mirror = self.mirror_path(url)
+        # the mirror stays locked until the clone is done, local clones
+        # hardlink the objects so this is quick
+        with self.lock(mirror):
+            yield from self._update(url, mirror, yield_output)
+            os.utime(mirror)
+            cmd = ["git", "clone", "--no-checkout", "--quiet", mirror, output_dir]
+            for line in execute_cmd(cmd, capture=yield_output):
+                yield line
+        cmd = ["git", "remote", "set-url", "origin", url]
+        for line in execute_cmd(cmd, cwd=output_dir, capture=yield_output):
+            yield line
+        self.evict_if_due(keep=[mirror])
+
+    def evict_if_due(self, keep=()):
+        """`evict` unless that was done less than `evict_interval` seconds
+        ago, by this or another process"""
+        if not self.max_size and not self.max_age:
+            return []
+        stamp = os.path.join(self.path, ".last-evict")
+        try:
+            if time.time() - os.stat(stamp).st_mtime < self.evict_interval:
+                return []
+        except FileNotFoundError:
+            pass
+        with open(stamp, "a"):
+            os.utime(stamp)
+        return self.evict(keep)
+
+    def evict(self, keep=()):
+        """Remove old mirrors and the least recently used ones over the limit.
+
+        Mirrors in `keep` and mirrors that are in use are left alone.
+        """
+        if not self.max_size and not self.max_age:
+            return []
+        mirrors = []
+        for name in os.listdir(self.path):
+            mirror = os.path.join(self.path, name)
+            if name.endswith(".git") and os.path.isdir(mirror):
+                mirrors.append((os.stat(mirror).st_mtime, mirror))
+        mirrors.sort()
+
+        sizes = {mirror: _disk_usage(mirror) for _, mirror in mirrors}
+        total = sum(sizes.values())
+        now = time.time()
+        removed = []
+        for last_used, mirror in mirrors:
+            too_old = self.max_age and now - last_used > self.max_age
+            too_big = self.max_size and total > self.max_size
+            if not (too_old or too_big) or mirror in keep:
+                continue
+            with self.lock(mirror, blocking=False) as locked:
+                if not locked:
+                    continue
+                self.log.info("Removing git mirror %s\n", mirror)
+                shutil.rmtree(mirror, ignore_errors=True)
+            total -= sizes[mirror]
+            removed.append(mirror)
+        return removed
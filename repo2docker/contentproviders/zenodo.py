@@ -18,6 +18,7 @@ class Zenodo(DoiProvider):
         # We need the hostname (url where records are), api url (for metadata),
         # filepath (path to files in metadata), filename (path to filename in
         # metadata), download (path to file download URL), and type (path to item type in metadata)
+        # checksum and size (paths to the checksum and size of a file in metadata) are optional
         self.hosts = [
             {
                 "hostname": ["https://zenodo.org/record/", "http://zenodo.org/record/"],
@@ -26,6 +27,8 @@ class Zenodo(DoiProvider):
                 "filename": "filename",
                 "download": "links.download",
                 "type": "metadata.upload_type",
+                "checksum": "checksum",
+                "size": "filesize",
             },
             {
                 "hostname": [
@@ -42,6 +45,7 @@ class Zenodo(DoiProvider):
 
     def detect(self, doi, ref=None, extra_args=None):
         """Trigger this provider for things that resolve to a Zenodo/Invenio record"""
+        self.use_extra_args(extra_args)
         url = self.doi2url(doi)
 
         for host in self.hosts:
@@ -65,12 +69,8 @@ class Zenodo(DoiProvider):
 
         is_software = deep_get(record, host["type"]).lower() == "software"
         files = deep_get(record, host["filepath"])
-        only_one_file = len(files) == 1
-        for file_ref in files:
-            for line in self.fetch_file(
-                file_ref, host, output_dir, is_software and only_one_file
-            ):
-                yield line
+        # a software record with only one file is an archive of the software
+        yield from self.fetch_files(files, host, output_dir, unzip=is_software)
 
     @property
     def content_id(self):
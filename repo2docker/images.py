@@ -0,0 +1,116 @@
+"""Keep track of the docker images built by repo2docker
+
+Checking if an image exists by listing all images is slow on hosts with many
+images. `ImageIndex` lists only the images built by repo2docker once and then
+follows the docker event stream to stay up to date, so that long running
+processes can answer "does this image exist?" without asking docker.
+"""
+import logging
+import threading
+
+import docker
+
+# Every image built by repo2docker carries this label
+BUILT_BY_LABEL = "repo2docker.version"
+
+
+class ImageIndex:
+    """In-process index of the tags of images built by repo2docker.
+
+    Call `start()` to populate the index and follow docker events in a
+    background thread, and `close()` to stop following them. Use `in` to
+    check if an image name (including the tag) is known. The index can only
+    be trusted while `live` is True.
+    """
+
+    def __init__(self, client, label=BUILT_BY_LABEL):
+        self.client = client
+        self.label = label
+        self.log = logging.getLogger("repo2docker")
+        self._lock = threading.Lock()
+        # image ID -> set of "name:tag" strings, and the reverse mapping
+        self._images = {}
+        self._tags = {}
+        self._events = None
+        self._thread = None
+        self.live = False
+
+    def __contains__(self, image_spec):
+        with self._lock:
+            return image_spec in self._tags
+
+    def start(self):
+        """Populate the index and start following docker events"""
+        # subscribe to events before listing images so that we do not miss
+        # changes that happen in between
+        self._events = self.client.events(filters={"type": "image"}, decode=True)
+        self.refresh()
+        self.live = True
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop following docker events"""
+        self.live = False
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+    def refresh(self):
+        """Rebuild the index from the list of images"""
+        images = {}
+        for image in self.client.images(filters={"label": self.label}):
+            images[image["Id"]] = set(image.get("RepoTags") or [])
+        with self._lock:
+            self._images = {}
+            self._tags = {}
+            for image_id, tags in images.items():
+                self._set_tags(image_id, tags)
+
+    def _set_tags(self, image_id, tags):
+        """Record the tags of an image, must be called with the lock held"""
+        for tag in self._images.pop(image_id, ()):
+            if self._tags.get(tag) == image_id:
+                del self._tags[tag]
+        if tags:
+            self._images[image_id] = tags
+            for tag in tags:
+                self._tags[tag] = image_id
+
+    def _update(self, image_id):
+        """Fetch the current tags of a single image"""
+        try:
+            image = self.client.inspect_image(image_id)
+        except docker.errors.NotFound:
+            tags = None
+        else:
+            labels = image.get("Config", {}).get("Labels") or {}
+            tags = set(image.get("RepoTags") or []) if self.label in labels else None
+        with self._lock:
+            self._set_tags(image_id, tags)
+
+    def handle_event(self, event):
+        """Update the index for one docker image event"""
+        action = event.get("Action", event.get("status"))
+        actor = event.get("Actor", {})
+        image_id = actor.get("ID", event.get("id"))
+        if not image_id:
+            return
+        if action == "delete":
+            with self._lock:
+                self._set_tags(image_id, None)
+        elif action in ("tag", "untag", "import", "load", "pull"):
+            # untag events do not say which tag was removed, and for the
+            # others we need to check the label, so look at the image itself
+            self._update(image_id)
+
+    def _watch(self):
+        events = self._events
+        try:
+            for event in events:
+                self.handle_event(event)
+        except Exception:
+            # the index is an optimisation, log and carry on without it
+            self.log.exception("Stopped following docker image events")
+        finally:
+            self.live = False
@@ -0,0 +1,131 @@
+"""Aggregate the progress events docker sends while pushing an image
+
+Docker reports progress per layer, many times a second. `PushProgress`
+keeps track of the bytes pushed for each layer and of the overall
+throughput, and hands out only the layers that changed since the last
+report so that the log does not repeat the state of every layer each time.
+"""
+import time
+
+# statuses that mean a layer is in the registry
+DONE_STATUSES = {"Pushed", "Layer already exists", "Mounted from"}
+
+
+def format_bytes(n):
+    """Human readable size of `n` bytes"""
+    for unit in ["B", "kB", "MB", "GB"]:
+        if n < 1000:
+            break
+        n /= 1000
+    else:
+        unit = "TB"
+    return "{:.1f} {}".format(n, unit)
+
+
+def describe_push(push):
+    """One line summary of the `push` part of `delta()`"""
+    text = "{} of {}, {}/s".format(
+        format_bytes(push["bytes_done"]),
+        format_bytes(push["bytes_total"]),
+        format_bytes(push["throughput"]),
+    )
+    if push["eta"] is not None:
+        text += ", about {:.0f}s left".format(push["eta"])
+    return text
+
+
+class PushProgress:
+    """Track the progress of `docker push`.
+
+    Feed each decoded event of the push stream to `update()`. When `due()`
+    returns True call `delta()` to get the layers that changed since the
+    previous call, together with a summary of the whole push.
+    """
+
+    def __init__(self, interval=1.5, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        # layer ID -> {"status": ..., "current": ..., "total": ...}
+        self.layers = {}
+        # layer ID -> last event for the layer, without the progress bar
+        self._events = {}
+        self._changed = set()
+        self._start = self._last_emit = clock()
+        # bytes that were actually uploaded, not counting existing layers
+        self.transferred = 0
+
+    def update(self, event):
+        """Record one progress event"""
+        layer_id = event.get("id")
+        if not layer_id:
+            return
+        layer = self.layers.setdefault(
+            layer_id, {"status": None, "current": 0, "total": None}
+        )
+        detail = event.get("progressDetail") or {}
+        if "current" in detail:
+            self.transferred += max(detail["current"] - layer["current"], 0)
+            layer["current"] = detail["current"]
+        if detail.get("total"):
+            layer["total"] = detail["total"]
+        status = event.get("status", "")
+        if status.startswith(tuple(DONE_STATUSES)) and layer["total"]:
+            layer["current"] = layer["total"]
+        layer["status"] = status
+        self._events[layer_id] = {k: v for k, v in event.items() if k != "progress"}
+        self._changed.add(layer_id)
+
+    @property
+    def bytes_done(self):
+        return sum(layer["current"] for layer in self.layers.values())
+
+    @property
+    def bytes_total(self):
+        """Total size of the layers whose size is known"""
+        return sum(layer["total"] or 0 for layer in self.layers.values())
+
+    @property
+    def throughput(self):
+        """Bytes uploaded per second since the push started"""
+        elapsed = self.clock() - self._start
+        if elapsed <= 0:
+            return 0.0
+        return self.transferred / elapsed
+
+    @property
+    def eta(self):
+        """Estimated number of seconds until the push is done, or None"""
+        throughput = self.throughput
+        if not throughput:
+            return None
+        return max(self.bytes_total - self.bytes_done, 0) / throughput
+
+    def due(self):
+        """True if there are changes and the last report is old enough"""
+        return bool(self._changed) and (self.clock() - self._last_emit >= self.interval)
+
+    def delta(self):
+        """The changes since the last call.
+
+        Returns a dict with `progress` (progress detail or status of each
+        changed layer), `layers` (the last event of each changed layer) and
+        `push` (bytes done and total, throughput in bytes per second and
+        ETA in seconds for the whole push).
+        """
+        changed = sorted(self._changed)
+        self._changed = set()
+        self._last_emit = self.clock()
+        progress = {}
+        for layer_id in changed:
+            event = self._events[layer_id]
+            progress[layer_id] = event.get("progressDetail") or event.get("status")
+        return {
+            "progress": progress,
+            "layers": {layer_id: self._events[layer_id] for layer_id in changed},
+            "push": {
+                "bytes_done": self.bytes_done,
+                "bytes_total": self.bytes_total,
+                "throughput": self.throughput,
+                "eta": self.eta,
+            },
+        }
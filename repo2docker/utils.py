@@ -1,19 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from functools import partial
+from functools import lru_cache
+import codecs
+import errno
 import os
 import re
+import select
+import shutil
 import subprocess
-import chardet
+import tempfile
+import threading
+import time
 
 from shutil import copystat, copy2
 
 from traitlets import Integer, TraitError
 
 
-def execute_cmd(cmd, capture=False, **kwargs):
+# Amount of output to read from a subprocess at once
+READ_SIZE = 64 * 1024
+
+# A line ends with `\r\n`, `\r` or `\n`
+_LINE_END = re.compile(rb"\r\n|\r|\n")
+
+
+def _split_lines(chunks):
+    """Split a stream of byte chunks into lines
+
+    Lines end with `\r`, `\n` or `\r\n` and include their line ending, a
+    last line without a line ending is yielded at the end.
+    """
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk
+        start = 0
+        for m in _LINE_END.finditer(data):
+            if m.end() == len(data) and m.group() == b"\r":
+                # the next chunk might start with the matching `\n`
+                break
+            yield data[start : m.end()]
+            start = m.end()
+        pending = data[start:]
+    if pending:
+        yield pending
+
+
+def _read_chunks(proc, cmd, timeout=None):
+    """Read the output of `proc` as it becomes available
+
+    Kills the process if it produces no output for `timeout` seconds.
+    """
+    fd = proc.stdout.fileno()
+    while True:
+        if timeout is not None:
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                proc.kill()
+                raise subprocess.TimeoutExpired(cmd, timeout)
+        chunk = os.read(fd, READ_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def execute_cmd(cmd, capture=False, timeout=None, progress_interval=None, **kwargs):
     """
     Call given command, yielding output line by line if capture=True.
 
+    When capturing, the command is killed if it produces no output for
+    `timeout` seconds. Progress bars redraw their line by ending it with
+    `\r`, with `progress_interval` such lines are only yielded if at least
+    that many seconds have passed since the last one.
+
     Must be yielded from.
     """
     if capture:
@@ -33,27 +91,27 @@ def execute_cmd(cmd, capture=False, **kwargs):
     # Each line will be yielded as text.
     # This should behave the same as .readline(), but splits on `\r` OR `\n`,
     # not just `\n`.
-    buf = []
-
-    def flush():
-        """Flush next line of the buffer"""
-        line = b"".join(buf).decode("utf8", "replace")
-        buf[:] = []
-        return line
-
-    c_last = ""
+    last_progress = None
     try:
-        for c in iter(partial(proc.stdout.read, 1), b""):
-            if c_last == b"\r" and buf and c != b"\n":
-                yield flush()
-            buf.append(c)
-            if c == b"\n":
-                yield flush()
-            c_last = c
+        for line in _split_lines(_read_chunks(proc, cmd, timeout)):
+            if progress_interval is not None and line.endswith(b"\r"):
+                now = time.monotonic()
+                if (
+                    last_progress is not None
+                    and now - last_progress < progress_interval
+                ):
+                    continue
+                last_progress = now
+            yield line.decode("utf8", "replace")
     finally:
+        proc.stdout.close()
         ret = proc.wait()
-        if ret != 0:
-            raise subprocess.CalledProcessError(ret, cmd)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+
+# The working directory is shared by all threads of a process
+_chdir_lock = threading.RLock()
 
 
 @contextmanager
@@ -62,30 +120,86 @@ def chdir(path):
 
     This context maanger is useful if `path` stops existing during your
     operations.
+
+    Only one thread at a time can be inside a `chdir` block, other threads
+    wait until it is left.
     """
-    old_dir = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(old_dir)
+    with _chdir_lock:
+        old_dir = os.getcwd()
+        os.chdir(path)
+        try:
+            yield
+        finally:
+            os.chdir(old_dir)
+
+
+# Byte order marks and the codec that skips them. UTF-32 comes first as its
+# little endian BOM starts with the one of UTF-16.
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+# Number of bytes at the start of a file that its encoding is guessed from
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+@lru_cache(maxsize=256)
+def _guess_encoding(path, size, mtime):
+    with open(path, "rb") as f:
+        sample = f.read(ENCODING_SAMPLE_SIZE)
+    # the sample can end in the middle of a multi-byte character
+    complete = size <= len(sample)
+
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+
+    # Most files are UTF-8 (or ASCII). Text in UTF-16 or UTF-32 without a
+    # BOM is valid UTF-8 too, but contains NUL bytes.
+    if b"\x00" not in sample:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            decoder.decode(sample, final=complete)
+            return "utf-8"
+        except UnicodeDecodeError:
+            pass
+
+    # only import chardet when we need it, it is slow to import
+    from chardet.universaldetector import UniversalDetector
+
+    detector = UniversalDetector()
+    for start in range(0, len(sample), 4096):
+        detector.feed(sample[start : start + 4096])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result["encoding"]
+
+
+def guess_encoding(path):
+    """Guess the encoding of the file at `path`
+
+    Only the first `ENCODING_SAMPLE_SIZE` bytes are looked at. Byte order
+    marks are honoured, then strict UTF-8 is tried and only if that fails
+    chardet is asked to guess. The
+    result is remembered until the size or modification time of the file
+    changes.
+    """
+    st = os.stat(path)
+    return _guess_encoding(os.path.abspath(path), st.st_size, st.st_mtime_ns)
 
 
 @contextmanager
 def open_guess_encoding(path):
     """
     Open a file in text mode, specifying its encoding,
-    that we guess using chardet.
+    that we guess using `guess_encoding`.
     """
-    detector = chardet.universaldetector.UniversalDetector()
-    with open(path, "rb") as f:
-        for line in f.readlines():
-            detector.feed(line)
-            if detector.done:
-                break
-    detector.close()
-
-    file = open(path, encoding=detector.result["encoding"])
+    file = open(path, encoding=guess_encoding(path))
     try:
         yield file
     finally:
@@ -300,6 +414,42 @@ class ByteSpecification(Integer):
             return int(float(num) * self.UNIT_SUFFIXES[suffix])
 
 
+def resolve_refs(names, cwd=None):
+    """Resolve git revisions to commit hashes with a single git process.
+
+    `names` can be anything git understands as a revision: branches, tags,
+    remote branches, abbreviated hashes, `HEAD`, ... Returns a list with the
+    full hash of the commit for each name, or None for names that do not
+    resolve to a commit or are ambiguous.
+    """
+    names = list(names)
+    if "\n" in "".join(names):
+        # one line per name, a newline would get input and output out of step
+        raise ValueError("git revisions can not contain newlines")
+    query = "".join("{}^{{commit}}\n".format(name) for name in names)
+    try:
+        proc = subprocess.run(
+            ["git", "cat-file", "--batch-check=%(objectname) %(objecttype)"],
+            input=query.encode("utf-8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return [None] * len(names)
+
+    hashes = []
+    for line in proc.stdout.decode("utf-8", "replace").splitlines():
+        # unresolved names are echoed back followed by "missing" or "ambiguous"
+        parts = line.split(" ")
+        if len(parts) == 2 and parts[1] == "commit":
+            hashes.append(parts[0])
+        else:
+            hashes.append(None)
+    return hashes
+
+
 def check_ref(ref, cwd=None):
     """Prepare a ref and ensure it works with git reset --hard."""
     # Try original ref, then trying a remote ref, then removing remote
@@ -309,17 +459,12 @@ def check_ref(ref, cwd=None):
         ref.split("/")[-1],
     ]  # In case partial commit w/ remote
 
-    hash = None
-    for i_ref in refs:
-        call = ["git", "rev-parse", "--quiet", i_ref]
-        try:
-            # If success, output will be <hash>
-            response = subprocess.check_output(call, stderr=subprocess.DEVNULL, cwd=cwd)
-            hash = response.decode().strip()
-        except Exception:
-            # We'll throw an error later if no refs resolve
-            pass
-    return hash
+    if "\n" in ref:
+        return None
+    for hash in resolve_refs(refs, cwd=cwd):
+        if hash is not None:
+            return hash
+    return None
 
 
 class Error(OSError):
@@ -415,6 +560,57 @@ def copytree(
     return dst
 
 
+def _move_or_copy(src, dst):
+    """Copy `src` to `dst` and remove `src`, used when renaming is not possible"""
+    if os.path.isdir(src) and not os.path.islink(src):
+        copytree(src, dst, symlinks=True)
+        shutil.rmtree(src)
+    else:
+        copy2(src, dst, follow_symlinks=False)
+        os.remove(src)
+
+
+def flatten_directory(path, copy_workers=4):
+    """Replace a single directory in `path` by its contents.
+
+    If `path` contains exactly one entry and that entry is a directory, its
+    contents are moved up into `path`. Entries are renamed, which costs no
+    I/O, except for those that live on a different device (like a mount
+    point) which are copied in parallel with `copy_workers` threads.
+
+    Returns True if the directory was flattened.
+    """
+    entries = os.listdir(path)
+    if len(entries) != 1:
+        return False
+    subdir = os.path.join(path, entries[0])
+    if os.path.islink(subdir) or not os.path.isdir(subdir):
+        return False
+
+    # rename the directory first, it might contain an entry of the same name
+    tmp = tempfile.mkdtemp(prefix=".flatten-", dir=path)
+    os.rename(subdir, os.path.join(tmp, "d"))
+    subdir = os.path.join(tmp, "d")
+
+    to_copy = []
+    for name in os.listdir(subdir):
+        src = os.path.join(subdir, name)
+        dst = os.path.join(path, name)
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            to_copy.append((src, dst))
+
+    if to_copy:
+        with ThreadPoolExecutor(max_workers=copy_workers) as executor:
+            # list() to raise the first error, if any
+            list(executor.map(lambda args: _move_or_copy(*args), to_copy))
+    shutil.rmtree(tmp)
+    return True
+
+
 def deep_get(dikt, path):
     """Get a value located in `path` from a nested dictionary.
 
@@ -35,9 +35,23 @@ class GenerateDataverseInstallationsFileCommand(Command):
         def get_identifier(json):
             return int(json["id"])
 
-        data["installations"].sort(key=get_identifier)
+        # only keep what repo2docker uses, one installation per line
+        installations = sorted(
+            (
+                {key: installation[key] for key in ("id", "name", "url")}
+                for installation in data["installations"]
+            ),
+            key=get_identifier,
+        )
         with open("repo2docker/contentproviders/dataverse.json", "w") as fp:
-            json.dump(data, fp, indent=4, sort_keys=True)
+            fp.write('{"installations": [\n')
+            fp.write(
+                ",\n".join(
+                    json.dumps(installation, sort_keys=True)
+                    for installation in installations
+                )
+            )
+            fp.write("\n]}\n")
 
 
 __cmdclass = versioneer.get_cmdclass()
@@ -55,6 +69,7 @@ setup(
         "ruamel.yaml>=0.15",
         "toml",
         "semver",
+        "chardet",
     ],
     python_requires=">=3.5",
     author="Project Jupyter Contributors",
@@ -8,13 +8,19 @@ return a non-zero exit code for the test to be considered a
 success.
 """
 
+import gzip
+import json
 import os
 import pipes
 import shlex
 import requests
+import socketserver
 import subprocess
+import threading
 import time
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 from tempfile import TemporaryDirectory
 
 import pytest
@@ -169,6 +175,159 @@ def repo_with_submodule():
         yield git_a_dir, sha1_a, submod_sha1_b
 
 
+class _FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.requests.append((self.command, self.path))
+        # strip the API version prefix, e.g. /v1.40/images/json
+        path = self.path.split("?")[0]
+        if path.startswith("/v1."):
+            path = "/" + path.split("/", 2)[2]
+        status, body = self.server.routes.get(path, (404, {"message": "not found"}))
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = _respond
+
+
+class _FakeDockerDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture()
+def fake_docker_daemon(tmpdir, monkeypatch):
+    """A stand-in for dockerd listening on a unix socket.
+
+    Requests are recorded in `requests`, responses are looked up by path
+    (without the API version prefix) in `routes`. `DOCKER_HOST` points at
+    the fake daemon while the fixture is active.
+    """
+    socket_path = str(tmpdir.join("docker.sock"))
+    server = _FakeDockerDaemon(socket_path, _FakeDockerHandler)
+    server.requests = []
+    server.connections = 0
+    server.compressed = 0
+    server.routes = {
+        "/version": (200, {"ApiVersion": "1.40", "Version": "19.03.0"}),
+        "/_ping": (200, "OK"),
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("DOCKER_HOST", "unix://" + socket_path)
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers.get("Range")))
+            faults = self.server.faults.get(self.path)
+            fault = faults.pop(0) if faults else None
+        if isinstance(fault, int):
+            return self._send(fault, headers={"Retry-After": "0"})
+        if fault == "stall":
+            time.sleep(1)
+            # the client has most likely given up already
+            self.close_connection = True
+            return
+        if isinstance(fault, str) and fault != "truncate":
+            return self._send(302, headers={"Location": fault})
+        if self.path not in self.server.files:
+            return self._send(404)
+
+        body = self.server.files[self.path]
+        status = 200
+        headers = {}
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes=") :].rstrip("-"))
+            headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, len(body) - 1, len(body)
+            )
+            body = body[start:]
+            status = 206
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+            with self.server.lock:
+                self.server.compressed += 1
+        if fault == "truncate":
+            # promise the whole body but hang up half way through
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        self._send(status, body, headers)
+
+
+@pytest.fixture()
+def file_server():
+    """A local HTTP server that serves `files`, a dict of path -> bytes.
+
+    Range requests are supported, bodies are gzip compressed if the client
+    accepts that. `faults` maps a path to a list of things that go wrong on
+    successive requests: a status code to answer with, "truncate" to hang up
+    half way through the body, "stall" to wait a second before answering or
+    a URL to redirect to. Requests are recorded in `requests` as (path, Range
+    header), the number of connections in `connections` and the number of
+    compressed responses in `compressed`. The base URL is `url`.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FileHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.files = {}
+    server.faults = {}
+    server.requests = []
+    server.connections = 0
+    server.compressed = 0
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 class Repo2DockerTest(pytest.Function):
     """A pytest.Item for running repo2docker"""
 
@@ -0,0 +1,118 @@
+"""
+Test extracting the archives of DOI based records
+"""
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from repo2docker.contentproviders import Zenodo
+from repo2docker.contentproviders.archive import archive_kind, extract_tar, extract_zip
+from repo2docker.contentproviders.base import ContentProviderException
+from repo2docker.contentproviders.download import HTTPConnectionPool
+
+
+def _tar(members, mode="w:gz"):
+    """A tar archive of `members`, a list of (name, contents, file mode)"""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=mode) as tar:
+        for name, contents, file_mode in members:
+            info = tarfile.TarInfo(name)
+            if contents is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            else:
+                info.size = len(contents)
+                info.mode = file_mode
+                tar.addfile(info, io.BytesIO(contents))
+    return data.getvalue()
+
+
+def test_archive_kind():
+    assert archive_kind("code.zip") == "zip"
+    assert archive_kind("code.TAR.GZ") == "tar"
+    assert archive_kind("code.tgz") == "tar"
+    assert archive_kind("code.txt") is None
+
+
+def test_extract_tar_strips_top_level_directory(tmpdir):
+    archive = _tar(
+        [
+            ("top", None, 0),
+            ("top/README", b"readme", 0o644),
+            ("top/bin/run", b"#!/bin/sh", 0o755),
+        ]
+    )
+    extract_tar(io.BytesIO(archive), str(tmpdir))
+
+    assert sorted(os.listdir(str(tmpdir))) == ["README", "bin"]
+    assert tmpdir.join("README").read() == "readme"
+    assert os.access(str(tmpdir.join("bin", "run")), os.X_OK)
+
+
+def test_extract_tar_without_top_level_directory(tmpdir):
+    archive = _tar(
+        [("a/one", b"one", 0o644), ("a/two", b"two", 0o644), ("b", b"b", 0o644)]
+    )
+    extract_tar(io.BytesIO(archive), str(tmpdir))
+
+    assert sorted(os.listdir(str(tmpdir))) == ["a", "b"]
+    assert tmpdir.join("a", "one").read() == "one"
+    assert tmpdir.join("a", "two").read() == "two"
+
+
+def test_extract_single_file(tmpdir):
+    extract_tar(io.BytesIO(_tar([("README", b"readme", 0o644)])), str(tmpdir))
+    assert os.listdir(str(tmpdir)) == ["README"]
+
+
+def test_extract_tar_outside_of_archive(tmpdir):
+    archive = _tar([("top/../../evil", b"evil", 0o644)])
+    with pytest.raises(ContentProviderException):
+        extract_tar(io.BytesIO(archive), str(tmpdir.mkdir("out")))
+    assert not tmpdir.join("evil").exists()
+
+
+def test_extract_truncated_tar(tmpdir):
+    archive = _tar([("top/data", os.urandom(100000), 0o644)], mode="w")
+    with pytest.raises(ContentProviderException):
+        extract_tar(io.BytesIO(archive[:50000]), str(tmpdir))
+
+
+def test_extract_zip(tmpdir):
+    zip_path = str(tmpdir.join("archive.zip"))
+    with zipfile.ZipFile(zip_path, "w") as zfile:
+        zfile.writestr("top/README", "readme")
+        zfile.writestr("top/sub/data", "data")
+    out = tmpdir.mkdir("out")
+
+    extract_zip(zip_path, str(out))
+
+    assert sorted(os.listdir(str(out))) == ["README", "sub"]
+    assert out.join("sub", "data").read() == "data"
+
+
+def test_zenodo_tar_extracted_while_downloading(file_server, tmpdir):
+    body = _tar([("code-1.0/setup.py", os.urandom(200000), 0o644)])
+    file_server.files["/code.tar.gz"] = body
+    file_server.faults["/code.tar.gz"] = ["truncate"]
+    zen = Zenodo()
+    zen.use_extra_args({"http_pool": HTTPConnectionPool()})
+    host = {"download": "links.download", "filename": "filename"}
+    files = [
+        {
+            "filename": "code.tar.gz",
+            "links": {"download": file_server.url + "/code.tar.gz"},
+        }
+    ]
+
+    lines = list(zen.fetch_files(files, host, str(tmpdir), unzip=True))
+
+    assert lines[0] == "Extracting code.tar.gz while downloading\n"
+    assert os.listdir(str(tmpdir)) == ["setup.py"]
+    # the interrupted transfer was resumed
+    ranges = [r for _, r in file_server.requests]
+    assert ranges == [None, "bytes={}-".format(len(body) // 2)]
@@ -0,0 +1,185 @@
+"""
+Test the cache of files downloaded for DOI based records
+"""
+import hashlib
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from repo2docker.contentproviders import Zenodo
+from repo2docker.contentproviders.base import ContentProviderException
+from repo2docker.contentproviders.cache import DownloadCache, parse_checksum
+from repo2docker.contentproviders.download import HTTPConnectionPool
+
+HOST = {
+    "download": "links.download",
+    "filename": "filename",
+    "checksum": "checksum",
+    "size": "filesize",
+}
+
+
+def _file_ref(file_server, name, body, checksum=None):
+    file_server.files["/" + name] = body
+    if checksum is None:
+        checksum = "md5:" + hashlib.md5(body).hexdigest()
+    return {
+        "filename": name,
+        "links": {"download": "{}/{}".format(file_server.url, name)},
+        "checksum": checksum,
+        "filesize": len(body),
+    }
+
+
+def _zenodo(cache=None):
+    zen = Zenodo()
+    zen.use_extra_args({"http_pool": HTTPConnectionPool(), "download_cache": cache})
+    return zen
+
+
+def test_parse_checksum():
+    digest = "d41d8cd98f00b204e9800998ecf8427e"
+    assert parse_checksum("md5:" + digest) == ("md5", digest)
+    assert parse_checksum(digest.upper()) == ("md5", digest)
+    assert parse_checksum({"type": "SHA-1", "value": "ab"}) == ("sha1", "ab")
+    assert parse_checksum("nosuchhash:ab") is None
+    assert parse_checksum("md5:not hex") is None
+    assert parse_checksum(None) is None
+
+
+def test_key(tmpdir):
+    cache = DownloadCache(str(tmpdir))
+    assert cache.key(("md5", "ab"), "https://a/1", 2) == "md5-ab"
+    assert cache.key(None, "https://a/1", 2) != cache.key(None, "https://a/1", 3)
+    assert cache.key(None, "https://a/1", None) is None
+
+
+def test_evict_least_recently_used(tmpdir):
+    cache = DownloadCache(str(tmpdir.join("cache")), max_size=250)
+    for n in range(3):
+        src = tmpdir.join(str(n))
+        src.write("x" * 100)
+        cache.add("blob-{}".format(n), str(src))
+        # make sure the modification times differ
+        os.utime(cache.blob_path("blob-{}".format(n)), (n, n))
+    assert cache.evict() == [cache.blob_path("blob-0")]
+    assert sorted(os.listdir(cache.path)) == ["blob-1", "blob-2"]
+
+    # using a blob makes it the most recently used one
+    assert cache.link("blob-1", str(tmpdir.join("used")))
+    src = tmpdir.join("3")
+    src.write("x" * 100)
+    cache.add("blob-3", str(src))
+    cache.evict(keep=[cache.blob_path("blob-3")])
+    assert sorted(os.listdir(cache.path)) == ["blob-1", "blob-3"]
+
+
+def test_fetch_from_cache(file_server, tmpdir):
+    cache = DownloadCache(str(tmpdir.join("cache")))
+    body = os.urandom(10000)
+    files = [
+        _file_ref(file_server, "data.bin", body),
+        # no checksum, cached by URL and size
+        _file_ref(file_server, "README", b"readme", checksum=""),
+    ]
+
+    first = tmpdir.join("first")
+    list(_zenodo(cache).fetch_files(files, HOST, str(first)))
+    assert len(file_server.requests) == 2
+
+    second = tmpdir.join("second")
+    lines = list(_zenodo(cache).fetch_files(files, HOST, str(second)))
+    assert len(file_server.requests) == 2
+    assert "Using cached data.bin\n" in lines
+    assert second.join("data.bin").read_binary() == body
+    assert second.join("README").read() == "readme"
+    # files with a checksum are linked from the cache, others are copied
+    blob = cache.blob_path(cache.key(("md5", hashlib.md5(body).hexdigest())))
+    assert os.path.samefile(blob, str(first.join("data.bin")))
+    assert os.path.samefile(blob, str(second.join("data.bin")))
+    assert os.stat(str(first.join("README"))).st_nlink == 1
+    assert os.stat(str(second.join("README"))).st_nlink == 1
+
+
+def test_edited_checkout_is_downloaded_again(file_server, tmpdir):
+    cache = DownloadCache(str(tmpdir.join("cache")))
+    body = b"data" * 100
+    files = [_file_ref(file_server, "data.bin", body)]
+
+    first = tmpdir.join("first")
+    list(_zenodo(cache).fetch_files(files, HOST, str(first)))
+    # the checkout is linked from the cache, editing it changes the cached file
+    with open(str(first.join("data.bin")), "r+b") as f:
+        f.write(b"edit")
+
+    second = tmpdir.join("second")
+    lines = list(_zenodo(cache).fetch_files(files, HOST, str(second)))
+    assert "Using cached data.bin\n" not in lines
+    assert len(file_server.requests) == 2
+    assert second.join("data.bin").read_binary() == body
+    blob = cache.blob_path(cache.key(("md5", hashlib.md5(body).hexdigest())))
+    with open(blob, "rb") as f:
+        assert f.read() == body
+
+
+def test_zip_downloaded_into_cache(file_server, tmpdir):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zfile:
+        zfile.writestr("code-1.0/setup.py", "setup")
+    files = [_file_ref(file_server, "code.zip", data.getvalue())]
+    cache = DownloadCache(str(tmpdir.join("cache")))
+
+    list(_zenodo(cache).fetch_files(files, HOST, str(tmpdir.join("a")), unzip=True))
+    lines = list(
+        _zenodo(cache).fetch_files(files, HOST, str(tmpdir.join("b")), unzip=True)
+    )
+
+    assert len(file_server.requests) == 1
+    assert lines[0] == "Using cached code.zip\n"
+    assert tmpdir.join("b", "setup.py").read() == "setup"
+    assert len(os.listdir(cache.path)) == 1
+
+
+def test_evict_once_per_record(file_server, tmpdir, monkeypatch):
+    cache = DownloadCache(str(tmpdir.join("cache")), max_size=10 ** 6)
+    files = [_file_ref(file_server, str(n), b"x" * 100) for n in range(5)]
+    evictions = []
+    evict = cache.evict
+    monkeypatch.setattr(
+        cache, "evict", lambda keep=(): evictions.append(keep) or evict(keep)
+    )
+
+    list(_zenodo(cache).fetch_files(files, HOST, str(tmpdir.join("out"))))
+    assert len(evictions) == 1
+    assert len(evictions[0]) == 5
+
+
+def test_tar_cached_while_extracting(file_server, tmpdir):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        info = tarfile.TarInfo("code-1.0/setup.py")
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b"setup"))
+    files = [_file_ref(file_server, "code.tar.gz", data.getvalue())]
+    cache = DownloadCache(str(tmpdir.join("cache")))
+
+    list(_zenodo(cache).fetch_files(files, HOST, str(tmpdir.join("a")), unzip=True))
+    lines = list(
+        _zenodo(cache).fetch_files(files, HOST, str(tmpdir.join("b")), unzip=True)
+    )
+
+    assert len(file_server.requests) == 1
+    assert lines[0] == "Extracting cached code.tar.gz\n"
+    assert tmpdir.join("b", "setup.py").read() == "setup"
+
+
+def test_checksum_mismatch(file_server, tmpdir):
+    cache = DownloadCache(str(tmpdir.join("cache")))
+    files = [_file_ref(file_server, "data.bin", b"data", checksum="md5:0000")]
+
+    with pytest.raises(ContentProviderException):
+        list(_zenodo(cache).fetch_files(files, HOST, str(tmpdir.join("out"))))
+    assert os.listdir(cache.path) == []
@@ -80,6 +80,14 @@ def test_detect_dataverse(test_input, expected):
         assert Dataverse().detect("https://doi.org/10.21105/joss.01277") is None
 
 
+def test_installations_loaded_once():
+    with patch("builtins.open") as fake_open:
+        hosts = Dataverse().hosts
+        assert Dataverse().hosts is hosts
+    fake_open.assert_not_called()
+    assert all(set(host) == {"id", "name", "url"} for host in hosts)
+
+
 @pytest.fixture
 def dv_files(tmpdir):
 
@@ -142,3 +150,45 @@ def test_dataverse_fetch(dv_files):
             assert os.path.isfile(
                 os.path.join(d, "directory", "subdirectory", "the-other-file.txt")
             )
+
+
+def test_dataverse_fetch_single_directory(dv_files):
+    mock_response_ds_query = BytesIO(
+        json.dumps(
+            {
+                "data": {
+                    "latestVersion": {
+                        "files": [
+                            {
+                                "dataFile": {"id": 2},
+                                "label": "some-other-file.txt",
+                                "directoryLabel": "directory",
+                            },
+                            {
+                                "dataFile": {"id": 3},
+                                "label": "the-other-file.txt",
+                                "directoryLabel": "directory/subdirectory",
+                            },
+                        ]
+                    }
+                }
+            }
+        ).encode("utf-8")
+    )
+    spec = {"host": harvard_dv, "record": "doi:10.7910/DVN/6ZXAGT"}
+
+    def mock_urlopen(self, req):
+        if isinstance(req, Request):
+            return mock_response_ds_query
+        else:
+            file_no = int(req.split("/")[-1]) - 1
+            return urlopen("file://{}".format(dv_files[file_no]))
+
+    with patch.object(Dataverse, "urlopen", new=mock_urlopen):
+        with TemporaryDirectory() as d:
+            for l in Dataverse().fetch(spec, d):
+                pass
+
+            # the only directory is replaced by its contents
+            assert set(os.listdir(d)) == {"some-other-file.txt", "subdirectory"}
+            assert os.path.isfile(os.path.join(d, "subdirectory", "the-other-file.txt"))
@@ -9,7 +9,8 @@ import logging
 from unittest.mock import patch, MagicMock, mock_open
 from zipfile import ZipFile
 
-from repo2docker.contentproviders.doi import DoiProvider
+from repo2docker.contentproviders import Dataverse, Figshare, Zenodo
+from repo2docker.contentproviders.doi import DoiProvider, DoiResolver
 from repo2docker.contentproviders.base import ContentProviderException
 
 
@@ -39,3 +40,40 @@ def test_unresolving_doi():
 
     fakedoi = "10.1/1234"
     assert doi.doi2url(fakedoi) is fakedoi
+
+
+def test_doi_resolved_once_per_run():
+    resolver = DoiResolver()
+    extra_args = {"doi_resolver": resolver}
+    with patch.object(DoiProvider, "urlopen") as fake_urlopen:
+        fake_urlopen.return_value.url = "https://zenodo.org/record/3232985"
+        for provider in [Dataverse, Figshare, Zenodo]:
+            provider().detect("10.5281/zenodo.3232985", extra_args=extra_args)
+    fake_urlopen.assert_called_once_with("https://doi.org/10.5281/zenodo.3232985")
+
+
+def test_doi_cache_file(tmpdir):
+    cache_file = str(tmpdir.join("doi-cache.json"))
+
+    def urlopen(url):
+        if url.endswith("missing"):
+            raise urllib.error.HTTPError(url, 404, "Not Found", {}, None)
+        return MagicMock(url="https://zenodo.org/record/1")
+
+    fake_urlopen = MagicMock(side_effect=urlopen)
+    resolver = DoiResolver(cache_file=cache_file)
+    assert resolver.resolve("10.5281/1", fake_urlopen) == "https://zenodo.org/record/1"
+    assert resolver.resolve("10.5281/missing", fake_urlopen) == "10.5281/missing"
+    assert fake_urlopen.call_count == 2
+    with open(cache_file) as f:
+        assert list(json.load(f)) == ["10.5281/1"]
+
+    # a new run reuses the resolved DOI
+    resolver = DoiResolver(cache_file=cache_file)
+    assert resolver.resolve("10.5281/1", fake_urlopen) == "https://zenodo.org/record/1"
+    assert fake_urlopen.call_count == 2
+
+    # unless it is too old
+    resolver = DoiResolver(cache_file=cache_file, ttl=0)
+    assert resolver.resolve("10.5281/1", fake_urlopen) == "https://zenodo.org/record/1"
+    assert fake_urlopen.call_count == 3
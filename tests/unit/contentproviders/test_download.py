@@ -0,0 +1,142 @@
+"""
+Test downloading the files of DOI based records from a local HTTP server
+"""
+import json
+import os
+from urllib.error import HTTPError, URLError
+from urllib.request import Request
+
+import pytest
+
+from repo2docker.contentproviders import Zenodo
+from repo2docker.contentproviders.download import Downloader, HTTPConnectionPool
+
+
+def _downloader(pool, **kwargs):
+    return Downloader(pool.urlopen, sleep=lambda seconds: None, **kwargs)
+
+
+def test_keep_alive_and_redirects(file_server):
+    file_server.files["/a"] = b"a" * 1000
+    file_server.faults["/moved"] = ["/a"]
+    pool = HTTPConnectionPool()
+
+    for _ in range(3):
+        with pool.urlopen(file_server.url + "/a") as resp:
+            assert resp.read() == b"a" * 1000
+    resp = pool.urlopen(file_server.url + "/moved")
+    assert resp.url == file_server.url + "/a"
+    assert resp.read() == b"a" * 1000
+
+    with pytest.raises(HTTPError) as e:
+        pool.urlopen(file_server.url + "/missing")
+    assert e.value.code == 404
+
+    assert len(file_server.requests) == 6
+    assert file_server.connections == 1
+    pool.close()
+
+
+def test_download_many_files(file_server, tmpdir):
+    jobs = []
+    for n in range(10):
+        file_server.files["/{}".format(n)] = os.urandom(100000 + n)
+        jobs.append(
+            (
+                "{}/{}".format(file_server.url, n),
+                str(tmpdir.join(str(n))),
+                "file {}".format(n),
+            )
+        )
+    pool = HTTPConnectionPool()
+
+    lines = list(_downloader(pool, workers=3).download_all(jobs))
+
+    for n in range(10):
+        assert tmpdir.join(str(n)).read_binary() == file_server.files["/{}".format(n)]
+    assert sorted(l for l in lines if l.startswith("Fetching")) == sorted(
+        "Fetching file {}\n".format(n) for n in range(10)
+    )
+    assert lines[-1].startswith("Downloaded 10 of 10 files, 1.0 MB")
+    # connections are reused by the workers
+    assert file_server.connections <= 3
+
+
+def test_resume_and_backoff(file_server, tmpdir):
+    body = os.urandom(100000)
+    file_server.files["/data"] = body
+    file_server.faults["/data"] = [429, "truncate", 503]
+    pool = HTTPConnectionPool()
+    downloader = _downloader(pool, chunk_size=1000)
+
+    downloader.download(file_server.url + "/data", str(tmpdir.join("data")))
+
+    assert tmpdir.join("data").read_binary() == body
+    ranges = [r for _, r in file_server.requests]
+    # the transfer after the truncated one resumes where it stopped
+    assert ranges == [None, None, "bytes=50000-", "bytes=50000-"]
+    assert downloader.bytes_done == len(body)
+
+
+def test_give_up(file_server, tmpdir):
+    file_server.files["/data"] = b"data"
+    file_server.faults["/data"] = [503] * 3
+    downloader = _downloader(HTTPConnectionPool(), retries=2)
+    with pytest.raises(HTTPError):
+        downloader.download(file_server.url + "/data", str(tmpdir.join("data")))
+    assert len(file_server.requests) == 3
+
+
+def test_zenodo_record_over_http(file_server, tmpdir):
+    file_server.files["/1"] = b"one"
+    file_server.files["/2"] = b"two"
+    zen = Zenodo()
+    zen.use_extra_args({"http_pool": HTTPConnectionPool(), "download_workers": 2})
+    host = {"download": "links.download", "filename": "filename"}
+    files = [
+        {"filename": "sub/one.txt", "links": {"download": file_server.url + "/1"}},
+        {"filename": "two.txt", "links": {"download": file_server.url + "/2"}},
+    ]
+
+    list(zen.fetch_files(files, host, str(tmpdir)))
+
+    assert tmpdir.join("sub", "one.txt").read() == "one"
+    assert tmpdir.join("two.txt").read() == "two"
+
+
+def test_json_metadata_is_compressed(file_server, tmpdir):
+    record = json.dumps({"files": ["a" * 1000]}).encode()
+    file_server.files["/record"] = record
+    file_server.files["/file.json"] = record
+    pool = HTTPConnectionPool()
+
+    req = Request(file_server.url + "/record", headers={"accept": "application/json"})
+    with pool.urlopen(req) as resp:
+        assert resp.read(10) + resp.read() == record
+    assert file_server.compressed == 1
+
+    # files are downloaded as they are
+    _downloader(pool).download(file_server.url + "/file.json", str(tmpdir.join("f")))
+    assert tmpdir.join("f").read_binary() == record
+    assert file_server.compressed == 1
+
+
+def test_timeout(file_server):
+    file_server.files["/slow"] = b"slow"
+    file_server.faults["/slow"] = ["stall"]
+    with pytest.raises(URLError):
+        HTTPConnectionPool(timeout=0.1).urlopen(file_server.url + "/slow")
+
+
+def test_metrics(file_server):
+    file_server.files["/a"] = b"a"
+    zen = Zenodo()
+    zen.use_extra_args({"http_pool": HTTPConnectionPool()})
+
+    for _ in range(3):
+        zen.urlopen(file_server.url + "/a").read()
+
+    metrics = zen.http_pool.metrics()["127.0.0.1"]
+    assert metrics["requests"] == 3
+    assert metrics["connections"] == 1
+    assert 0 < metrics["latency"] < 1
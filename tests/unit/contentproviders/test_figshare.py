@@ -26,8 +26,9 @@ def test_content_id(link, expected):
     with patch.object(Figshare, "urlopen") as fake_urlopen:
         fake_urlopen.return_value.url = link
         fig = Figshare()
-        fig.detect("10.6084/m9.figshare.9782777")
+        spec = fig.detect("10.6084/m9.figshare.9782777")
         assert fig.content_id == expected
+        assert fig.resolve_content_id(spec) == expected
 
 
 test_fig = Figshare()
@@ -1,8 +1,10 @@
 import os
 import pytest
 import subprocess
+from unittest.mock import patch
 from tempfile import TemporaryDirectory
 from repo2docker.contentproviders import Git
+from repo2docker.contentproviders.mirror import MirrorCache
 
 
 def test_clone(repo_with_content):
@@ -73,3 +75,164 @@ def test_always_accept():
     assert Git().detect("/etc", ref="1234")
     # a remote URL
     assert Git().detect("https://example.com/path/here")
+
+
+def _git_shallow(clone_dir):
+    out = subprocess.check_output(
+        ["git", "rev-parse", "--is-shallow-repository"], cwd=clone_dir
+    )
+    return out.decode().strip() == "true"
+
+
+@pytest.mark.parametrize("ref", ["master", "origin/master", "full-sha"])
+def test_shallow_fetch(repo_with_content, ref):
+    """Branches and full commit hashes are fetched at depth 1"""
+    upstream, sha1 = repo_with_content
+    subprocess.check_call(["git", "commit", "--allow-empty", "-m", "2"], cwd=upstream)
+    head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=upstream)
+    head = head.decode().strip()
+    if ref == "full-sha":
+        ref = head
+
+    with TemporaryDirectory() as clone_dir:
+        git_content = Git()
+        spec = {"repo": upstream, "ref": ref, "shallow": True}
+        for _ in git_content.fetch(spec, clone_dir):
+            pass
+        assert git_content.fetch_strategy == "shallow"
+        assert git_content.content_id == head[:7]
+        assert _git_shallow(clone_dir)
+        assert os.path.exists(os.path.join(clone_dir, "test"))
+
+
+def test_shallow_fetch_falls_back(repo_with_content):
+    """An abbreviated hash is found by fetching more history"""
+    upstream, sha1 = repo_with_content
+    subprocess.check_call(["git", "commit", "--allow-empty", "-m", "2"], cwd=upstream)
+
+    with TemporaryDirectory() as clone_dir:
+        git_content = Git()
+        spec = {"repo": upstream, "ref": sha1[:7], "shallow": True}
+        lines = list(git_content.fetch(spec, clone_dir, yield_output=True))
+        assert git_content.fetch_strategy == "depth 50"
+        assert git_content.content_id == sha1[:7]
+        assert any("strategy: depth 50" in line for line in lines)
+
+    with TemporaryDirectory() as clone_dir:
+        git_content = Git()
+        for _ in git_content.fetch({"repo": upstream, "ref": sha1[:7]}, clone_dir):
+            pass
+        assert git_content.fetch_strategy == "clone"
+        assert not _git_shallow(clone_dir)
+
+
+@pytest.fixture()
+def repo_with_submodules(tmpdir):
+    """A repository with two submodules, the first pinned to an old commit"""
+    parent = tmpdir.mkdir("parent")
+    subprocess.check_call(["git", "init"], cwd=str(parent))
+    pinned = []
+    for n in range(2):
+        sub = tmpdir.mkdir("sub{}".format(n))
+        subprocess.check_call(["git", "init"], cwd=str(sub))
+        for i in range(2):
+            sub.join("file").write(str(i))
+            subprocess.check_call(["git", "add", "file"], cwd=str(sub))
+            subprocess.check_call(["git", "commit", "-m", str(i)], cwd=str(sub))
+        url = "file://" + str(sub)
+        subprocess.check_call(
+            ["git", "submodule", "add", url, "sub{}".format(n)], cwd=str(parent)
+        )
+        pinned.append(
+            subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=str(sub))
+        )
+    subprocess.check_call(["git", "checkout", "HEAD~1"], cwd=str(parent.join("sub0")))
+    pinned[0] = subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=str(parent.join("sub0"))
+    )
+    subprocess.check_call(["git", "add", "."], cwd=str(parent))
+    subprocess.check_call(["git", "commit", "-m", "submodules"], cwd=str(parent))
+    return str(parent), [p.decode().strip() for p in pinned]
+
+
+def test_submodules_shallow_and_parallel(repo_with_submodules):
+    upstream, pinned = repo_with_submodules
+    with TemporaryDirectory() as clone_dir:
+        lines = list(
+            Git().fetch(
+                {"repo": upstream, "submodule_jobs": 2, "submodule_depth": 1},
+                clone_dir,
+                yield_output=True,
+            )
+        )
+        for n, sha in enumerate(pinned):
+            sub_dir = os.path.join(clone_dir, "sub{}".format(n))
+            head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=sub_dir)
+            assert head.decode().strip() == sha
+            assert _git_shallow(sub_dir)
+            assert any(
+                line.startswith("Updated submodule sub{} (depth 1)".format(n))
+                for line in lines
+            )
+
+
+def test_submodules_full_history_by_default(repo_with_submodules):
+    upstream, pinned = repo_with_submodules
+    with TemporaryDirectory() as clone_dir:
+        lines = list(Git().fetch({"repo": upstream}, clone_dir, yield_output=True))
+        for n, sha in enumerate(pinned):
+            sub_dir = os.path.join(clone_dir, "sub{}".format(n))
+            assert not _git_shallow(sub_dir)
+            assert any(
+                line.startswith("Updated submodule sub{} (clone)".format(n))
+                for line in lines
+            )
+
+
+def test_submodules_from_mirror(repo_with_submodules, tmpdir):
+    upstream, pinned = repo_with_submodules
+    cache = MirrorCache(str(tmpdir.join("mirrors")))
+    with TemporaryDirectory() as clone_dir:
+        git_content = Git()
+        spec = git_content.detect(upstream, extra_args={"mirror_cache": cache})
+        lines = list(git_content.fetch(spec, clone_dir, yield_output=True))
+        for n, sha in enumerate(pinned):
+            sub_dir = os.path.join(clone_dir, "sub{}".format(n))
+            head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=sub_dir)
+            assert head.decode().strip() == sha
+            url = "file://" + str(tmpdir.join("sub{}".format(n)))
+            assert os.path.isdir(cache.mirror_path(url))
+            assert any(
+                line.startswith("Updated submodule sub{} (mirror)".format(n))
+                for line in lines
+            )
+
+
+def test_resolve_content_id(repo_with_content):
+    upstream, sha1 = repo_with_content
+    subprocess.check_call(["git", "tag", "-a", "-m", "v1", "v1"], cwd=upstream)
+    subprocess.check_call(["git", "commit", "--allow-empty", "-m", "2"], cwd=upstream)
+    head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=upstream)
+    head = head.decode().strip()
+
+    for ref, expected in [
+        (None, head),
+        ("master", head),
+        ("origin/master", head),
+        ("v1", sha1),
+        (sha1, sha1),
+    ]:
+        git_content = Git()
+        spec = git_content.detect(upstream, ref=ref)
+        assert git_content.resolve_content_id(spec) == expected[:7], ref
+        assert git_content.content_id == expected[:7]
+
+    # abbreviated hashes can only be resolved after fetching
+    assert Git().resolve_content_id(Git().detect(upstream, ref=sha1[:7])) is None
+    assert Git().resolve_content_id(Git().detect(upstream, ref="nope")) is None
+
+    # results are cached
+    spec = Git().detect(upstream, ref="master")
+    with patch("subprocess.run") as run:
+        assert Git().resolve_content_id(spec) == head[:7]
+    run.assert_not_called()
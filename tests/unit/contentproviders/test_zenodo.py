@@ -17,8 +17,10 @@ def test_content_id():
         fake_urlopen.return_value.url = "https://zenodo.org/record/3232985"
         zen = Zenodo()
 
-        zen.detect("10.5281/zenodo.3232985")
+        spec = zen.detect("10.5281/zenodo.3232985")
         assert zen.content_id == "3232985"
+        # known before fetching
+        assert zen.resolve_content_id(spec) == "3232985"
 
 
 test_zen = Zenodo()
@@ -1,42 +1,55 @@
 import errno
 import pytest
 from tempfile import TemporaryDirectory
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import docker
 import escapism
+import requests
 
+from repo2docker.contentproviders import Figshare, Git, Zenodo
+from repo2docker.contentproviders.doi import DoiProvider
 from repo2docker.app import Repo2Docker
+from repo2docker.buildpacks import LegacyBinderDockerBuildPack
 from repo2docker.__main__ import make_r2d
 from repo2docker.utils import chdir
 
 
 def test_find_image():
-    images = [{"RepoTags": ["some-org/some-repo:latest"]}]
-
     with patch("repo2docker.app.docker.APIClient") as FakeDockerClient:
         instance = FakeDockerClient.return_value
-        instance.images.return_value = images
+        instance.inspect_image.return_value = {"Id": "sha256:1234"}
 
         r2d = Repo2Docker()
         r2d.output_image_spec = "some-org/some-repo"
         assert r2d.find_image()
 
-        instance.images.assert_called_with()
+        instance.inspect_image.assert_called_with("some-org/some-repo:latest")
+        instance.images.assert_not_called()
 
 
 def test_dont_find_image():
-    images = [{"RepoTags": ["some-org/some-image-name:latest"]}]
-
     with patch("repo2docker.app.docker.APIClient") as FakeDockerClient:
         instance = FakeDockerClient.return_value
-        instance.images.return_value = images
+        instance.inspect_image.side_effect = docker.errors.ImageNotFound("nope")
 
         r2d = Repo2Docker()
-        r2d.output_image_spec = "some-org/some-other-image-name"
+        r2d.output_image_spec = "some-org/some-other-image-name:v1"
         assert not r2d.find_image()
 
-        instance.images.assert_called_with()
+        instance.inspect_image.assert_called_with("some-org/some-other-image-name:v1")
+
+
+def test_find_image_in_index():
+    index = MagicMock(live=True)
+    index.__contains__.return_value = True
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient:
+        r2d = Repo2Docker(image_index=index)
+        r2d.output_image_spec = "some-org/some-repo"
+        assert r2d.find_image()
+
+        index.__contains__.assert_called_with("some-org/some-repo:latest")
+        FakeDockerClient.assert_not_called()
 
 
 def test_image_name_remains_unchanged():
@@ -147,3 +160,169 @@ def test_error_log_without_docker(tmpdir, capsys):
                 app.build()
                 captured = capsys.readouterr()
                 assert "Error: no Docker" in captured.err
+
+
+def test_reuse_image_with_same_context_digest(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("README.md").write("hello")
+    app = Repo2Docker(
+        repo=str(tmpdir),
+        output_image_spec="some-org/some-repo:tag",
+        reproducible_context=True,
+        user_id=1000,
+        user_name="jovyan",
+    )
+    labelled_images = []
+
+    def images(filters):
+        return labelled_images
+
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient:
+        instance = FakeDockerClient.return_value
+        instance.images.side_effect = images
+        instance.inspect_image.side_effect = docker.errors.ImageNotFound("nope")
+        instance.build.return_value = []
+        app.build()
+
+        # no image with this digest, so we build one and label it
+        instance.build.assert_called_once()
+        label_filter = instance.images.call_args[1]["filters"]["label"]
+        name, digest = label_filter.split("=")
+        assert name == "repo2docker.context-digest"
+        assert instance.build.call_args[1]["labels"] == {name: digest}
+
+        instance.build.reset_mock()
+        labelled_images.append({"Id": "sha256:1234"})
+        app.build()
+
+        # same content, the existing image is tagged instead of rebuilt
+        instance.build.assert_not_called()
+        instance.images.assert_called_with(filters={"label": label_filter})
+        instance.tag.assert_called_once_with("sha256:1234", "some-org/some-repo", "tag")
+
+
+def _pulled_images(tmpdir, **kwargs):
+    """The images pulled to build the repository in `tmpdir`"""
+    app = Repo2Docker(
+        repo=str(tmpdir),
+        output_image_spec="some-org/some-repo:tag",
+        user_id=1000,
+        user_name="jovyan",
+        **kwargs
+    )
+
+    def inspect_image(image_spec):
+        if image_spec == "some-org/present:latest":
+            return {"Id": "sha256:1234"}
+        raise docker.errors.ImageNotFound(image_spec)
+
+    def pulled():
+        return sorted((c[0][0], c[1]["tag"]) for c in instance.pull.call_args_list)
+
+    pulled_before_build = []
+
+    def build(**kwargs):
+        pulled_before_build.extend(pulled())
+        return []
+
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient:
+        instance = FakeDockerClient.return_value
+        instance.inspect_image.side_effect = inspect_image
+        instance.pull.return_value = [{"status": "Downloaded"}]
+        instance.build.side_effect = build
+        app.build()
+
+    instance.build.assert_called_once()
+    # the images are pulled before the build starts
+    assert pulled_before_build == pulled()
+    return pulled()
+
+
+def test_prefetch_images_before_build(tmpdir):
+    tmpdir.join("README.md").write("hello")
+    pulled = _pulled_images(tmpdir, cache_from=["some-org/cache:1", "some-org/present"])
+    assert pulled == [("buildpack-deps", "bionic"), ("some-org/cache", "1")]
+
+
+def test_prefetch_images_of_dockerfile_repos(tmpdir):
+    tmpdir.join("Dockerfile").write("FROM some-org/base\n")
+    assert _pulled_images(tmpdir) == []
+
+    tmpdir.join("Dockerfile").write("FROM andrewosh/binder-base\n")
+    digest = LegacyBinderDockerBuildPack.base_image.split("@")[1]
+    assert _pulled_images(tmpdir) == [("andrewosh/binder-base", digest)]
+
+
+def test_existing_image_skips_fetch(repo_with_content):
+    upstream, sha1 = repo_with_content
+    app = make_r2d(["--user-id", "1000", "--user-name", "jovyan", "file://" + upstream])
+
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient, patch.object(
+        app, "fetch"
+    ) as fetch:
+        instance = FakeDockerClient.return_value
+        instance.inspect_image.return_value = {"Id": "sha256:1234"}
+        app.build()
+
+    fetch.assert_not_called()
+    instance.build.assert_not_called()
+    instance.pull.assert_not_called()
+    assert app.output_image_spec.endswith(sha1[:7])
+
+
+def test_existing_image_skips_download():
+    app = make_r2d(
+        ["--user-id", "1000", "--user-name", "jovyan", "10.5281/zenodo.3232985"]
+    )
+
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient, patch.object(
+        Zenodo, "urlopen"
+    ) as fake_urlopen, patch.object(Zenodo, "fetch") as fetch:
+        fake_urlopen.return_value.url = "https://zenodo.org/record/3232985"
+        instance = FakeDockerClient.return_value
+        instance.inspect_image.return_value = {"Id": "sha256:1234"}
+        app.build()
+
+    fetch.assert_not_called()
+    assert app.output_image_spec.endswith("3232985")
+
+
+def test_git_url_does_not_resolve_doi():
+    app = Repo2Docker()
+    with patch.object(DoiProvider, "urlopen") as fake_urlopen, patch.object(
+        app.log, "info"
+    ) as log_info:
+        cp, spec = app.pick_content_provider("https://github.com/org/repo", "main")
+    fake_urlopen.assert_not_called()
+    assert isinstance(cp, Git)
+    timings = log_info.call_args_list[0][0][1]
+    assert timings.startswith("Zenodo skipped, Figshare skipped, Dataverse skipped")
+
+
+def test_doi_detected_with_one_request():
+    app = Repo2Docker()
+    with patch.object(DoiProvider, "urlopen") as fake_urlopen:
+        fake_urlopen.return_value.url = "https://figshare.com/articles/title/9782777"
+        cp, spec = app.pick_content_provider("10.6084/m9.figshare.9782777", None)
+    fake_urlopen.assert_called_once_with("https://doi.org/10.6084/m9.figshare.9782777")
+    assert isinstance(cp, Figshare)
+
+
+def test_failed_pull_does_not_abort_build(tmpdir):
+    tmpdir.join("README.md").write("hello")
+    app = Repo2Docker(
+        repo=str(tmpdir),
+        output_image_spec="some-org/some-repo:tag",
+        user_id=1000,
+        user_name="jovyan",
+    )
+
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient:
+        instance = FakeDockerClient.return_value
+        instance.inspect_image.side_effect = docker.errors.ImageNotFound("nope")
+        instance.pull.side_effect = requests.exceptions.ReadTimeout("slow registry")
+        instance.build.return_value = []
+        app.build()
+
+    instance.pull.assert_called_once()
+    instance.build.assert_called_once()
@@ -0,0 +1,130 @@
+"""
+Test building many repositories in one process
+"""
+import logging
+import os
+import threading
+import time
+
+from unittest.mock import MagicMock
+
+import docker
+import pytest
+
+from traitlets.config import Config
+
+from repo2docker.batch import BatchBuilder, load_jobs, summarize
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_load_reproductions():
+    jobs = load_jobs(os.path.join(HERE, "..", "external", "reproductions.repos.yaml"))
+    assert jobs
+    assert all(job["url"] and job["verify"] for job in jobs)
+    assert jobs[0]["ref"] == "origin/b8259dac9eb"
+    assert jobs[0]["verify"] == "python -c 'import matplotlib'"
+
+
+def test_load_jobs(tmpdir):
+    tmpdir.mkdir("local")
+    tmpdir.join("repos.yaml").write("- url: local\n- name: remote\n  url: https://x\n")
+    with tmpdir.as_cwd():
+        jobs = load_jobs("repos.yaml")
+    assert jobs == [
+        {
+            "name": str(tmpdir.join("local")),
+            "url": str(tmpdir.join("local")),
+            "ref": None,
+            "verify": None,
+        },
+        {"name": "remote", "url": "https://x", "ref": None, "verify": None},
+    ]
+
+    tmpdir.join("broken.yaml").write("- name: no url\n")
+    with pytest.raises(ValueError):
+        load_jobs(str(tmpdir.join("broken.yaml")))
+
+
+class _FakeDocker:
+    """Records how many builds run at the same time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.built = set()
+
+    def build(self, tag, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        if "broken" in tag:
+            yield {"error": "it broke"}
+            return
+        self.built.add(tag)
+        yield {"stream": "built {}".format(tag)}
+
+    def inspect_image(self, image):
+        if image.endswith(":latest"):
+            image = image[: -len(":latest")]
+        if image not in self.built:
+            raise docker.errors.ImageNotFound(image)
+        return {"Id": "sha256:" + image}
+
+
+def test_batch_limits_concurrent_builds(tmpdir):
+    jobs = []
+    for name in ["one", "two", "three", "broken"]:
+        path = tmpdir.mkdir(name)
+        path.join("README.md").write(name)
+        jobs.append({"name": name, "url": str(path), "ref": None, "verify": None})
+
+    fake = _FakeDocker()
+    client = MagicMock(spec=docker.APIClient)
+    client.build.side_effect = fake.build
+    client.inspect_image.side_effect = fake.inspect_image
+
+    config = Config()
+    config.Repo2Docker.user_id = 1000
+    config.Repo2Docker.user_name = "jovyan"
+    batch = BatchBuilder(config=config, workers=4, concurrent_builds=2)
+    batch.docker_client = client
+
+    cwd = os.getcwd()
+    results = batch.run(jobs)
+
+    assert os.getcwd() == cwd
+    assert fake.max_running == 2
+    assert [r["name"] for r in results] == ["one", "two", "three", "broken"]
+    for result in results[:3]:
+        assert result["success"], result["error"]
+        assert result["image_id"] == "sha256:" + result["image"]
+        assert set(result["durations"]) == {"fetch", "build", "total"}
+    assert not results[3]["success"]
+    assert "it broke" in results[3]["error"]
+
+    summary = summarize(results, 1.0)
+    assert summary["succeeded"] == 3
+    assert summary["failed"] == 1
+
+
+def test_jobs_share_logger_and_caches(tmpdir):
+    config = Config()
+    config.Repo2Docker.git_mirror_cache = str(tmpdir.join("mirrors"))
+    config.Repo2Docker.download_cache = str(tmpdir.join("downloads"))
+    log = logging.getLogger("repo2docker.test-batch")
+    batch = BatchBuilder(config=config, log=log)
+
+    job = {"name": "one", "url": str(tmpdir), "ref": None, "verify": None}
+    first = batch.make_app(job)
+    second = batch.make_app(job)
+
+    assert first.log is second.log is log
+    for name in ["http_pool", "doi_resolver", "mirror_cache", "file_cache"]:
+        assert getattr(first, name) is not None
+        assert getattr(first, name) is getattr(second, name)
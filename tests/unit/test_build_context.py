@@ -0,0 +1,208 @@
+"""
+Test the streaming build context producer
+"""
+import hashlib
+import io
+import os
+import tarfile
+
+from unittest.mock import MagicMock
+
+import docker
+import pytest
+
+from repo2docker.buildpacks import BaseImage
+from repo2docker.buildpacks.context import BuildContext, IgnoreRules
+
+
+def _make_repo(tmpdir):
+    tmpdir.join("README.md").write("hello")
+    tmpdir.mkdir("data").join("big.bin").write_binary(os.urandom(1024 * 1024 + 7))
+    os.symlink("README.md", str(tmpdir.join("link")))
+
+
+def _read_tar(chunks):
+    tar = tarfile.open(fileobj=io.BytesIO(b"".join(chunks)))
+    return {m.name: m for m in tar.getmembers()}, tar
+
+
+def test_matches_tarfile(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+
+    context = BuildContext()
+    context.add_bytes("Dockerfile", b"FROM scratch\n")
+    context.add(".", "src/")
+    members, tar = _read_tar(context)
+
+    expected = io.BytesIO()
+    with tarfile.open(fileobj=expected, mode="w") as reference:
+        reference.add(".", "src/")
+    expected.seek(0)
+    expected_members = {m.name: m for m in tarfile.open(fileobj=expected)}
+
+    assert set(members) == set(expected_members) | {"Dockerfile"}
+    assert tar.extractfile("Dockerfile").read() == b"FROM scratch\n"
+    assert members["src/link"].issym()
+    assert members["src/link"].linkname == "README.md"
+    with open("data/big.bin", "rb") as f:
+        assert tar.extractfile("src/data/big.bin").read() == f.read()
+
+
+def test_chunks_are_bounded(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+
+    context = BuildContext(chunk_size=64 * 1024)
+    context.add(".", "src/")
+    chunks = list(context)
+
+    assert len(chunks) > 1
+    assert max(len(c) for c in chunks) < 2 * 64 * 1024
+    # iterating again produces the same archive
+    assert b"".join(chunks) == b"".join(context)
+
+
+def test_filter_prunes_directories(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+
+    def _filter(tarinfo):
+        if tarinfo.name == "src/data":
+            return None
+        tarinfo.uid = 1234
+        return tarinfo
+
+    context = BuildContext()
+    context.add(".", "src/", filter=_filter)
+    members, _ = _read_tar(context)
+
+    assert "src/README.md" in members
+    assert not any(name.startswith("src/data") for name in members)
+    assert all(m.uid == 1234 for m in members.values())
+
+
+def test_build_streams_context(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join("README.md").write("hello")
+    fake_client = MagicMock(spec=docker.APIClient)
+    fake_client.build.return_value = iter([{"stream": "fake"}])
+
+    for _ in BaseImage().build(fake_client, "image-2", 100, {}, [], {}):
+        pass
+
+    called_args, called_kwargs = fake_client.build.call_args
+    assert called_kwargs["custom_context"]
+    members, tar = _read_tar(called_kwargs["fileobj"])
+    assert "Dockerfile" in members
+    assert "repo2docker-entrypoint" in members
+    assert tar.extractfile("src/README.md").read() == b"hello"
+
+
+@pytest.mark.parametrize(
+    "patterns, path, is_dir, ignored",
+    [
+        ([".git/"], ".git", True, True),
+        ([".git/"], ".git", False, False),
+        ([".git/"], "sub/.git", True, True),
+        (["*.pyc"], "a/b/c.pyc", False, True),
+        (["/data"], "data", True, True),
+        (["/data"], "sub/data", True, False),
+        (["data/*.csv"], "data/x.csv", False, True),
+        (["data/*.csv"], "sub/data/x.csv", False, False),
+        (["**/cache"], "a/b/cache", True, True),
+        (["build/**"], "build/a/b", False, True),
+        (["*.csv", "!keep.csv"], "keep.csv", False, False),
+        (["*.csv", "!keep.csv", "*.csv"], "keep.csv", False, True),
+        (["# comment", "", "file[0-9].txt"], "file3.txt", False, True),
+        (["file[!0-9].txt"], "file3.txt", False, False),
+        (["\\#notacomment"], "#notacomment", False, True),
+        (["./notebooks"], "notebooks", True, True),
+    ],
+)
+def test_ignore_rules(patterns, path, is_dir, ignored):
+    assert IgnoreRules(patterns).match(path, is_dir) == ignored
+
+
+def test_build_honours_ignore_files(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join("README.md").write("hello")
+    tmpdir.join(".r2dignore").write("*.log\n")
+    tmpdir.mkdir("binder").join(".r2dignore").write("/data/\n!keep.log\n")
+    # uses docker's rules, which differ from those of .gitignore files
+    tmpdir.join(".dockerignore").write("README.md\n")
+    tmpdir.mkdir("data").join("big.bin").write("x")
+    tmpdir.join("keep.log").write("x")
+    tmpdir.join("other.log").write("x")
+    tmpdir.mkdir(".git").join("HEAD").write("x")
+    fake_client = MagicMock(spec=docker.APIClient)
+    fake_client.build.return_value = iter([{"stream": "fake"}])
+
+    bp = BaseImage()
+    bp.ignore_patterns = [".git"]
+    for _ in bp.build(fake_client, "image-2", 100, {}, [], {}):
+        pass
+
+    called_args, called_kwargs = fake_client.build.call_args
+    members, _ = _read_tar(called_kwargs["fileobj"])
+    names = {name for name in members if name.split("/")[0] == "src"}
+    assert names == {
+        "src",
+        "src/.dockerignore",
+        "src/.r2dignore",
+        "src/README.md",
+        "src/binder",
+        "src/binder/.r2dignore",
+        "src/keep.log",
+    }
+
+
+def test_digest_matches_stream(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+
+    context = BuildContext()
+    context.add(".", "src/")
+    assert context.digest is None
+    data = b"".join(context)
+    assert context.digest == "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def test_reproducible_digest(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+
+    def digest(reproducible):
+        context = BuildContext(reproducible=reproducible)
+        context.add(".", "src/")
+        members, _ = _read_tar(context)
+        return context.digest, members
+
+    before, members = digest(reproducible=True)
+    assert all(m.mtime == 0 for m in members.values())
+    assert members["src/README.md"].mode == 0o644
+    assert members["src/data"].mode == 0o755
+    plain_before, _ = digest(reproducible=False)
+
+    os.utime("README.md", (1234567, 1234567))
+    os.chmod("README.md", 0o600)
+
+    assert digest(reproducible=True)[0] == before
+    assert digest(reproducible=False)[0] != plain_before
+
+    tmpdir.join("README.md").write("changed")
+    assert digest(reproducible=True)[0] != before
+
+
+def test_context_digest_covers_build_args(tmpdir):
+    tmpdir.join("README.md").write("hello")
+    tmpdir.chdir()
+    bp = BaseImage()
+    bp.reproducible_context = True
+    build_args = {"NB_USER": "jovyan", "NB_UID": "1000"}
+
+    digest = bp.get_context_digest(build_args)
+    assert bp.get_context_digest(dict(build_args)) == digest
+    assert bp.get_context_digest(dict(build_args, NB_USER="other")) != digest
+    assert bp.get_context_digest(dict(build_args, REPO_DIR="/srv/repo")) != digest
+    assert bp.get_context_digest(build_args, {"target": "base"}) != digest
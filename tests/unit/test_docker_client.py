@@ -0,0 +1,65 @@
+"""
+Test that repo2docker shares one docker client between all its steps
+"""
+
+from repo2docker import app
+from repo2docker.app import Repo2Docker, make_docker_client
+
+
+def _find_images(n):
+    r2d = Repo2Docker()
+    for i in range(n):
+        r2d.output_image_spec = "r2d-image-{}".format(i)
+        assert not r2d.find_image()
+
+
+def test_shared_client(fake_docker_daemon, monkeypatch):
+    monkeypatch.setattr(app, "_docker_api_versions", {})
+    fake_docker_daemon.routes["/images/r2d-image:latest/json"] = (200, {"Id": "1"})
+
+    r2d = Repo2Docker()
+    r2d.output_image_spec = "r2d-image"
+    assert r2d.find_image()
+    assert r2d.find_image()
+    # the client is kept around and reused by everything else
+    assert r2d.docker_client is r2d.docker_client
+    assert r2d._docker_high_level_client().api is r2d.docker_client
+
+    assert fake_docker_daemon.requests == [
+        ("GET", "/version"),
+        ("GET", "/v1.40/images/r2d-image:latest/json"),
+        ("GET", "/v1.40/images/r2d-image:latest/json"),
+    ]
+    # one connection to negotiate the API version, one for everything else
+    assert fake_docker_daemon.connections == 2
+
+
+def test_api_version_negotiated_once(fake_docker_daemon, monkeypatch):
+    monkeypatch.setattr(app, "_docker_api_versions", {})
+
+    first = make_docker_client()
+    second = make_docker_client()
+    assert first.api_version == second.api_version == "1.40"
+    assert fake_docker_daemon.requests.count(("GET", "/version")) == 1
+
+
+def test_shared_client_connections(fake_docker_daemon, monkeypatch):
+    # Compare ten image lookups with a fresh, version negotiating, client for
+    # each lookup (how repo2docker used to work) to a shared client.
+    monkeypatch.setattr(app, "_docker_api_versions", {})
+    n = 10
+
+    for i in range(n):
+        client = app.docker.APIClient(version="auto", **app.kwargs_from_env())
+        try:
+            client.inspect_image("r2d-image-{}:latest".format(i))
+        except app.docker.errors.NotFound:
+            pass
+        client.close()
+    fresh_connections = fake_docker_daemon.connections
+
+    _find_images(n)
+    shared_connections = fake_docker_daemon.connections - fresh_connections
+
+    assert fresh_connections == 2 * n
+    assert shared_connections == 2
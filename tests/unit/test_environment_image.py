@@ -0,0 +1,108 @@
+"""
+Test sharing environment images between repositories
+"""
+import io
+import tarfile
+
+from unittest.mock import MagicMock
+
+import docker
+
+from repo2docker.buildpacks import PythonBuildPack
+from repo2docker.buildpacks.base import ENVIRONMENT_IMAGE, ENVIRONMENT_LABEL
+
+
+BUILD_ARGS = {"NB_USER": "jovyan", "NB_UID": "1000"}
+
+
+def _make_repo(tmpdir, requirements="numpy\n", readme="hello"):
+    tmpdir.join("requirements.txt").write(requirements)
+    tmpdir.join("README.md").write(readme)
+
+
+def _fingerprint(tmpdir, build_args=BUILD_ARGS):
+    with tmpdir.as_cwd():
+        return PythonBuildPack().get_environment_fingerprint(build_args)
+
+
+def _read_tar(chunks):
+    tar = tarfile.open(fileobj=io.BytesIO(b"".join(chunks)))
+    return {m.name for m in tar.getmembers()}, tar
+
+
+def test_render_is_environment_and_repo(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+    bp = PythonBuildPack()
+
+    environment = bp.render_environment()
+    assert "COPY src/requirements.txt" in environment
+    assert "COPY src/ ${REPO_DIR}" not in environment
+    repo = bp.render_repo("env-image:tag")
+    assert repo.startswith("FROM env-image:tag\n")
+    assert "COPY src/ ${REPO_DIR}" in repo
+    assert bp.render().startswith(environment)
+
+
+def test_fingerprint(tmpdir):
+    one = tmpdir.mkdir("one")
+    two = tmpdir.mkdir("two")
+    three = tmpdir.mkdir("three")
+    _make_repo(one)
+    _make_repo(two, readme="something else")
+    _make_repo(three, requirements="pandas\n")
+
+    assert _fingerprint(one) == _fingerprint(two)
+    assert _fingerprint(one) != _fingerprint(three)
+    assert _fingerprint(one) != _fingerprint(one, dict(BUILD_ARGS, NB_UID="1001"))
+
+
+def test_build_environment_image(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+    fake_client = MagicMock(spec=docker.APIClient)
+    fake_client.inspect_image.side_effect = docker.errors.ImageNotFound("nope")
+    fake_client.build.side_effect = lambda **kwargs: iter([{"stream": "fake"}])
+
+    bp = PythonBuildPack()
+    bp.reuse_environment_images = True
+    lines = list(
+        bp.build(fake_client, "image-2", 0, BUILD_ARGS, [], {"labels": {"a": "b"}})
+    )
+
+    fingerprint = bp.get_environment_fingerprint(BUILD_ARGS)
+    environment_image = "{}:{}".format(ENVIRONMENT_IMAGE, fingerprint)
+    assert lines[0] == {
+        "stream": "Building environment image {}\n".format(environment_image)
+    }
+    assert fake_client.build.call_count == 2
+
+    environment_kwargs = fake_client.build.call_args_list[0][1]
+    assert environment_kwargs["tag"] == environment_image
+    assert environment_kwargs["labels"] == {ENVIRONMENT_LABEL: fingerprint}
+    names, _ = _read_tar(environment_kwargs["fileobj"])
+    assert "src/requirements.txt" in names
+    assert "src/README.md" not in names
+
+    repo_kwargs = fake_client.build.call_args_list[1][1]
+    assert repo_kwargs["tag"] == "image-2"
+    assert repo_kwargs["labels"] == {"a": "b"}
+    names, tar = _read_tar(repo_kwargs["fileobj"])
+    assert "src/README.md" in names
+    dockerfile = tar.extractfile("Dockerfile").read().decode()
+    assert dockerfile.startswith("FROM {}\n".format(environment_image))
+
+
+def test_reuse_environment_image(tmpdir):
+    _make_repo(tmpdir)
+    tmpdir.chdir()
+    fake_client = MagicMock(spec=docker.APIClient)
+    fake_client.build.return_value = iter([{"stream": "fake"}])
+
+    bp = PythonBuildPack()
+    bp.reuse_environment_images = True
+    lines = list(bp.build(fake_client, "image-2", 0, BUILD_ARGS, [], {}))
+
+    assert lines[0]["stream"].startswith("Reusing environment image")
+    assert fake_client.build.call_count == 1
+    assert fake_client.build.call_args[1]["tag"] == "image-2"
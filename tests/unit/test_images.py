@@ -0,0 +1,74 @@
+"""
+Test the index of images built by repo2docker
+"""
+from unittest.mock import MagicMock
+
+import docker
+
+from repo2docker.images import ImageIndex
+
+
+def _fake_client(images, events=()):
+    client = MagicMock(spec=docker.APIClient)
+    client.images.return_value = [
+        {"Id": image_id, "RepoTags": image["RepoTags"]}
+        for image_id, image in images.items()
+    ]
+
+    def inspect_image(image_id):
+        if image_id not in images:
+            raise docker.errors.ImageNotFound(image_id)
+        return dict(images[image_id], Id=image_id)
+
+    client.inspect_image.side_effect = inspect_image
+    client.events.return_value = iter(events)
+    return client
+
+
+def _image(*tags, labels=None):
+    if labels is None:
+        labels = {"repo2docker.version": "0.10"}
+    return {"RepoTags": list(tags), "Config": {"Labels": labels}}
+
+
+def test_start_lists_labelled_images():
+    client = _fake_client({"sha256:a": _image("r2d-a:latest")})
+    index = ImageIndex(client)
+    index.start()
+    index._thread.join()
+
+    assert "r2d-a:latest" in index
+    assert "r2d-b:latest" not in index
+    client.images.assert_called_once_with(filters={"label": "repo2docker.version"})
+    client.events.assert_called_once_with(filters={"type": "image"}, decode=True)
+    # the events iterator ran out, so the index is no longer trustworthy
+    assert not index.live
+
+
+def test_events_update_index():
+    images = {"sha256:a": _image("r2d-a:latest")}
+    client = _fake_client(images)
+    index = ImageIndex(client)
+    index.refresh()
+
+    # a new image is built and tagged
+    images["sha256:b"] = _image("r2d-b:latest")
+    index.handle_event({"Action": "tag", "Actor": {"ID": "sha256:b"}})
+    assert "r2d-b:latest" in index
+
+    # images not built by repo2docker are ignored
+    images["sha256:c"] = _image("other:latest", labels={})
+    index.handle_event({"Action": "pull", "Actor": {"ID": "sha256:c"}})
+    assert "other:latest" not in index
+
+    # the tag moves to a new image, and the old image is untagged
+    images["sha256:a2"] = _image("r2d-a:latest")
+    images["sha256:a"] = _image()
+    index.handle_event({"Action": "tag", "Actor": {"ID": "sha256:a2"}})
+    index.handle_event({"Action": "untag", "Actor": {"ID": "sha256:a"}})
+    assert "r2d-a:latest" in index
+
+    # deleting the image removes all its tags
+    del images["sha256:b"]
+    index.handle_event({"Action": "delete", "Actor": {"ID": "sha256:b"}})
+    assert "r2d-b:latest" not in index
@@ -0,0 +1,88 @@
+"""
+Test aggregating the progress of docker push
+"""
+from unittest.mock import patch
+
+from repo2docker.app import Repo2Docker
+from repo2docker.progress import PushProgress, describe_push, format_bytes
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def _event(layer_id, status, current=None, total=None):
+    event = {"id": layer_id, "status": status, "progress": "[=====>    ]"}
+    if current is not None:
+        event["progressDetail"] = {"current": current, "total": total}
+    else:
+        event["progressDetail"] = {}
+    return event
+
+
+def test_deltas_and_throughput():
+    clock = FakeClock()
+    progress = PushProgress(interval=1.5, clock=clock)
+
+    progress.update(_event("a", "Preparing"))
+    progress.update(_event("b", "Layer already exists"))
+    assert not progress.due()
+    clock.now += 2
+    assert progress.due()
+    delta = progress.delta()
+    assert delta["progress"] == {"a": "Preparing", "b": "Layer already exists"}
+    assert not progress.due()
+
+    progress.update(_event("a", "Pushing", 1000, 4000))
+    progress.update(_event("a", "Pushing", 2000, 4000))
+    clock.now += 2
+    delta = progress.delta()
+    # only the layer that changed, and without the progress bar
+    assert list(delta["layers"]) == ["a"]
+    assert "progress" not in delta["layers"]["a"]
+    assert delta["progress"]["a"] == {"current": 2000, "total": 4000}
+    assert delta["push"] == {
+        "bytes_done": 2000,
+        "bytes_total": 4000,
+        "throughput": 500.0,
+        "eta": 4.0,
+    }
+    assert describe_push(delta["push"]) == "2.0 kB of 4.0 kB, 500.0 B/s, about 4s left"
+
+    progress.update(_event("a", "Pushed"))
+    assert progress.delta()["push"]["bytes_done"] == 4000
+
+
+def test_format_bytes():
+    assert format_bytes(999) == "999.0 B"
+    assert format_bytes(1500000) == "1.5 MB"
+    assert format_bytes(2 * 10 ** 12) == "2.0 TB"
+
+
+def test_push_image_logs_deltas():
+    events = [
+        _event("a", "Preparing"),
+        _event("a", "Pushing", 10, 20),
+        _event("a", "Pushed"),
+    ]
+    app = Repo2Docker(output_image_spec="some-org/some-repo:tag")
+    app.push_progress_interval = 0
+    with patch("repo2docker.app.docker.APIClient") as FakeDockerClient, patch.object(
+        app.log, "info"
+    ) as info:
+        instance = FakeDockerClient.return_value
+        instance.push.return_value = iter(events)
+        app.push_image()
+
+    instance.push.assert_called_once_with(
+        "some-org/some-repo:tag", stream=True, decode=True
+    )
+    extras = [c[1]["extra"] for c in info.call_args_list]
+    pushing = [e for e in extras if "push" in e]
+    assert len(pushing) == 4
+    assert all(e["phase"] == "pushing" for e in pushing)
+    assert pushing[-1]["push"]["bytes_done"] == 20
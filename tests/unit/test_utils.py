@@ -1,13 +1,20 @@
 """
 Tests for repo2docker/utils.py
 """
+import errno
 import traitlets
 import os
 from repo2docker import utils
 import pytest
 import subprocess
+import sys
 import tempfile
 
+from functools import partial
+from unittest.mock import patch
+
+from chardet.universaldetector import UniversalDetector
+
 
 def test_capture_cmd_no_capture_success():
     # This should succeed
@@ -35,6 +42,93 @@ def test_capture_cmd_capture_fail():
             assert line == "test\n"
 
 
+def _execute_cmd_bytewise(cmd):
+    """The implementation execute_cmd used to have, reading one byte at a time"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    buf = []
+
+    def flush():
+        line = b"".join(buf).decode("utf8", "replace")
+        buf[:] = []
+        return line
+
+    c_last = ""
+    for c in iter(partial(proc.stdout.read, 1), b""):
+        if c_last == b"\r" and buf and c != b"\n":
+            yield flush()
+        buf.append(c)
+        if c == b"\n":
+            yield flush()
+        c_last = c
+    proc.wait()
+
+
+def _print_cmd(code):
+    return [
+        sys.executable,
+        "-c",
+        "import sys; sys.stdout.buffer.write({})".format(code),
+    ]
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        b"a\nb\n",
+        b"a\r\nb\r\n",
+        b"10%\r20%\r30%\rdone\n",
+        b"\r\r\n\n\r",
+        "caf\u00e9 \u2713\n".encode("utf8"),
+    ],
+)
+def test_capture_cmd_line_splitting(output):
+    cmd = _print_cmd(repr(output))
+    lines = list(utils.execute_cmd(cmd, capture=True))
+    assert "".join(lines) == output.decode("utf8")
+    # same lines as reading byte by byte, which does not return the last
+    # line if it has no line ending
+    expected = list(_execute_cmd_bytewise(cmd))
+    assert lines[: len(expected)] == expected
+
+
+def test_capture_cmd_split_across_chunks():
+    chunks = [b"abc\r", b"\ndef\r", b"ghi", b"\n", b"\r"]
+    assert list(utils._split_lines(chunks)) == [b"abc\r\n", b"def\r", b"ghi\n", b"\r"]
+
+
+def test_split_lines_at_every_chunk_boundary():
+    output = b"10%\r20%\r\ndone\r\n\nlast"
+    expected = [b"10%\r", b"20%\r\n", b"done\r\n", b"\n", b"last"]
+    for i in range(len(output) + 1):
+        for j in range(i, len(output) + 1):
+            chunks = [output[:i], output[i:j], output[j:]]
+            assert list(utils._split_lines(chunks)) == expected
+
+
+def test_capture_cmd_output_larger_than_a_read():
+    # several reads worth of git-clone like output: progress lines and
+    # normal lines
+    code = "(b'Receiving objects: 10% (1/10)\\r' * 9 + b'Resolving deltas\\n') * 1000"
+    cmd = _print_cmd(code)
+    lines = list(utils.execute_cmd(cmd, capture=True))
+    assert len(lines) == 10000
+    assert lines == list(_execute_cmd_bytewise(cmd))
+
+
+def test_capture_cmd_progress_interval():
+    cmd = _print_cmd("b'1\\r2\\r3\\rdone\\n'")
+    lines = list(utils.execute_cmd(cmd, capture=True, progress_interval=60))
+    assert lines == ["1\r", "done\n"]
+
+
+def test_capture_cmd_timeout():
+    with pytest.raises(subprocess.TimeoutExpired):
+        for line in utils.execute_cmd(
+            ["/bin/bash", "-c", "echo start; sleep 10"], capture=True, timeout=0.5
+        ):
+            assert line == "start\n"
+
+
 def test_chdir(tmpdir):
     d = str(tmpdir.mkdir("cwd"))
     cur_cwd = os.getcwd()
@@ -122,6 +216,57 @@ def test_open_guess_encoding():
             assert fd.read() == data
 
 
+@pytest.mark.parametrize(
+    "encoding, expected",
+    [
+        ("utf-8", "utf-8"),
+        ("utf-8-sig", "utf-8-sig"),
+        ("utf-16", "utf-16"),
+        ("utf-32", "utf-32"),
+    ],
+)
+def test_guess_encoding_without_chardet(tmpdir, encoding, expected):
+    data = "numpy==1.16\n# café\n"
+    path = tmpdir.join("requirements.txt")
+    path.write_binary(data.encode(encoding))
+    with patch("chardet.universaldetector.UniversalDetector") as detector:
+        assert utils.guess_encoding(str(path)) == expected
+    detector.assert_not_called()
+    with utils.open_guess_encoding(str(path)) as f:
+        assert f.read() == data
+
+
+def test_guess_encoding_is_remembered(tmpdir):
+    path = tmpdir.join("requirements.txt")
+    text = (
+        "numpy==1.16  # Paquet pour le calcul numérique, développé par la "
+        "communauté scientifique française\n"
+    )
+    path.write_binary(text.encode("latin-1"))
+    with patch(
+        "chardet.universaldetector.UniversalDetector", wraps=UniversalDetector
+    ) as detector:
+        encoding = utils.guess_encoding(str(path))
+        assert utils.guess_encoding(str(path)) == encoding
+        assert detector.call_count == 1
+        assert path.read_binary().decode(encoding) == text
+
+        # a changed file is looked at again
+        path.write_binary(b"numpy\n")
+        os.utime(str(path), ns=(0, 0))
+        assert utils.guess_encoding(str(path)) == "utf-8"
+
+
+def test_guess_encoding_from_sample(tmpdir):
+    path = tmpdir.join("requirements.txt")
+    # a two byte character across the end of the sample
+    data = b"#" * (utils.ENCODING_SAMPLE_SIZE - 1) + "é".encode("utf-8")
+    path.write_binary(data + b"\n" + b"\xff" * 10)
+    with patch("chardet.universaldetector.UniversalDetector") as detector:
+        assert utils.guess_encoding(str(path)) == "utf-8"
+    detector.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "req, is_local",
     [
@@ -137,3 +282,60 @@ def test_open_guess_encoding():
 )
 def test_local_pip_requirement(req, is_local):
     assert utils.is_local_pip_requirement(req) == is_local
+
+
+def test_flatten_directory(tmpdir):
+    # a directory that contains an entry with its own name
+    inner = tmpdir.mkdir("data")
+    inner.mkdir("data").join("file.txt").write("nested")
+    inner.join("README.md").write("hello")
+
+    assert utils.flatten_directory(str(tmpdir))
+    assert sorted(os.listdir(str(tmpdir))) == ["README.md", "data"]
+    assert tmpdir.join("data", "file.txt").read() == "nested"
+
+    # more than one entry
+    assert not utils.flatten_directory(str(tmpdir))
+    # a single file
+    assert not utils.flatten_directory(str(tmpdir.join("data")))
+
+
+def test_flatten_directory_across_devices(tmpdir):
+    inner = tmpdir.mkdir("record")
+    inner.mkdir("mounted").join("file.txt").write("copied")
+    inner.join("README.md").write("hello")
+    rename = os.rename
+
+    def fake_rename(src, dst):
+        if src.endswith("mounted"):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        return rename(src, dst)
+
+    with patch("os.rename", fake_rename):
+        assert utils.flatten_directory(str(tmpdir))
+    assert sorted(os.listdir(str(tmpdir))) == ["README.md", "mounted"]
+    assert tmpdir.join("mounted", "file.txt").read() == "copied"
+
+
+def test_resolve_refs(repo_with_content):
+    repo, sha1 = repo_with_content
+    subprocess.check_call(["git", "tag", "-a", "-m", "annotated", "v1"], cwd=repo)
+    subprocess.check_call(["git", "branch", "feature"], cwd=repo)
+
+    with patch("subprocess.run", wraps=subprocess.run) as run:
+        hashes = utils.resolve_refs(
+            ["HEAD", "feature", "v1", sha1[:7], "nope", "HEAD~5"], cwd=repo
+        )
+    # one git process for all names
+    assert run.call_count == 1
+    # the annotated tag is resolved to the commit it points at
+    assert hashes == [sha1, sha1, sha1, sha1, None, None]
+
+
+def test_check_ref(repo_with_content):
+    repo, sha1 = repo_with_content
+    assert utils.check_ref(sha1[:7], cwd=repo) == sha1
+    # remote and partial hash, resolved by its last component
+    assert utils.check_ref("origin/" + sha1[:10], cwd=repo) == sha1
+    assert utils.check_ref("does-not-exist", cwd=repo) is None
+    assert utils.check_ref("HEAD", cwd=str(tempfile.gettempdir())) is None